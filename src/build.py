@@ -3,12 +3,27 @@
 
 from __future__ import print_function
 
+import atexit
+import hashlib
+import json
 import os
 import os.path
 import platform
+import re
+import select
+import shlex
+import shutil
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from glob import iglob
 from itertools import chain
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from subprocess import check_output
 from sys import argv, exit, stdout
 from datetime import datetime
@@ -34,6 +49,52 @@ except:
     def popen2(cmd, mode='t', bufsize=0):
         return None, Readable(getoutput(cmd))
 
+# Time spent on external commands and build steps, reported when building with profile=1
+profile_events = []
+profile_start = time.time()
+
+
+def profiling():
+    """Check if a timing report should be written. Enable with profile=1 or profile=filename.json"""
+    value = build_argument('profile', '0')
+    return bool(value) and value != '0'
+
+
+def profile_event(category, name, start, end=None):
+    """Record that something in the given category took from start until end (or now)"""
+    if not profiling():
+        return
+    if isinstance(name, (list, tuple)):
+        name = " ".join(name)
+    profile_events.append((category, str(name), start, end or time.time(), threading.current_thread().ident))
+
+
+@contextmanager
+def profile_span(category, name):
+    """Time the code in a with-block. Example: with profile_span("discover", "build flags"): ..."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile_event(category, name, start)
+
+
+def profiled(category, function):
+    """Wrap a function that runs an external command, so that each call is timed"""
+    def wrapper(cmd, *args, **kwargs):
+        start = time.time()
+        try:
+            return function(cmd, *args, **kwargs)
+        finally:
+            profile_event(category, cmd, start)
+    return wrapper
+
+
+# All external commands that are run while discovering build flags go through these
+popen2 = profiled("command", popen2)
+getstatusoutput = profiled("command", getstatusoutput)
+check_output = profiled("command", check_output)
+
 
 LOCAL_COMMON_PATHS = ["common", "Common", "../common", "../Common"]
 LOCAL_INCLUDE_PATHS = [".", "include", "Include", "..", "../include", "../Include"] + LOCAL_COMMON_PATHS
@@ -41,8 +102,50 @@ PATHLIST = os.environ["PATH"].split(os.pathsep)  # split on ":"
 SPECIAL_SYMBOLS = "@@@@@"  # string that is unlikely to appear in an include line or a build flag
 # skip compilation-related packages when searching for includes
 SKIP_PACKAGES = ["glibc", "gcc", "wine"]
+# list the .pc files that belong to a package, per package manager
+PC_FILES_COMMANDS = {
+    "deb": r"LC_ALL=C /usr/bin/dpkg-query -L {} | /bin/grep '\.pc$'",
+    "arch": r'/usr/bin/pacman -Ql -- {} | /usr/bin/grep "\.pc$" | /usr/bin/cut -d" " -f2-',
+    "freebsd": r"/usr/sbin/pkg list {} | /usr/bin/grep '\.pc$'",
+}
 
 cached_pc_files = {}
+cached_owners = {}
+cached_header_indexes = {}
+cached_pc_fields = {}
+cached_pkg_config = {}
+cached_pkg_config_defaults = None
+cached_sources = {}
+cached_host_macros = {}
+cached_probes = {}
+cached_buildflags = {}
+cached_modules = {}
+# The warnings of each compilation, by object, when the object cache is used
+compiler_output = {}
+
+# Set when running as a daemon with: python3 build.py daemon
+daemon_mode = False
+DAEMON_PROTOCOL = 1
+DAEMON_IDLE_SECONDS = 3600
+
+# Generated unity files for unity=1, and their objects
+UNITY_DIR = ".cxx-unity"
+# Generated precompiled header for pch=1
+PCH_DIR = ".cxx-pch"
+# C++20 module interface units, and where clang stores the compiled module interfaces
+MODULE_EXTENSIONS = [".cppm", ".ixx", ".mpp", ".cxxm", ".c++m"]
+MODULES_DIR = ".cxx-modules"
+
+# SCons actions (unity and module builds) and the test runner may run in several threads at once,
+# serialize updates to the persistent caches
+cache_lock = threading.RLock()
+
+# Package databases and pkg-config directories. When one of these are modified, packages may have been installed or removed.
+PACKAGE_DATABASES = ["/var/lib/dpkg/status", "/var/lib/pacman/local", "/var/db/pkg", "/var/db/pkg/local.sqlite",
+                     "/usr/local/Cellar", "/opt/homebrew/Cellar", "/usr/pkg/pkgdb"]
+PC_DIRS = ["/usr/lib/pkgconfig", "/usr/lib64/pkgconfig", "/usr/share/pkgconfig", "/usr/local/lib/pkgconfig",
+           "/usr/local/share/pkgconfig", "/usr/libdata/pkgconfig", "/usr/local/libdata/pkgconfig", "/usr/pkg/lib/pkgconfig",
+           "/usr/X11R7/lib/pkgconfig", "/opt/homebrew/lib/pkgconfig"] + sorted(iglob("/usr/lib/*/pkgconfig"))
 
 
 def hints(missing_includes):
@@ -95,6 +198,139 @@ def which(program):
     return None
 
 
+def build_argument(name, default=""):
+    """Get an argument given on the scons command line (like nocache=1).
+    Arguments given to cxx are passed on to scons by the Makefile, in SCONS_ARGS."""
+    return ARGUMENTS.get(name, default)
+
+
+def cache_dir():
+    """Return the directory where cxx keeps persistent caches, typically ~/.cache/cxx"""
+    base = os.environ.get("XDG_CACHE_HOME", "")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cxx")
+
+
+def use_cache():
+    """Check if the persistent caches should be used. They can be disabled with nocache=1"""
+    try:
+        return not int(build_argument('nocache', 0))
+    except ValueError:
+        return True
+
+
+def load_cache(name):
+    """Load the named cache from the cache directory. Returns an empty dict if it does not exist or is broken."""
+    if not use_cache():
+        return {}
+    try:
+        with open(os.path.join(cache_dir(), name + ".json")) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return data
+    except (IOError, OSError, ValueError):
+        pass
+    return {}
+
+
+def save_cache(name, data):
+    """Write the named cache to the cache directory. Not being able to write the cache is not an error."""
+    if not use_cache():
+        return
+    directory = cache_dir()
+    with cache_lock:
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary file first, so that concurrent builds never read a half-written cache
+            tmp_filename = os.path.join(directory, name + ".json." + str(os.getpid()))
+            with open(tmp_filename, "w") as f:
+                json.dump(data, f)
+            os.rename(tmp_filename, os.path.join(directory, name + ".json"))
+        except (IOError, OSError):
+            pass
+
+
+def fingerprint(path):
+    """Return a string that changes when the given file or directory changes, or an empty string if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    return repr(st.st_mtime) + ":" + str(st.st_size)
+
+
+def packages_fingerprint():
+    """Return a string that changes when packages are installed or removed"""
+    return hashlib.sha1(" ".join(fingerprint(path) for path in PACKAGE_DATABASES).encode("utf-8")).hexdigest()[:12]
+
+
+def compiler_identity(cxx):
+    """Identify the given compiler by path, size and modification time, so that upgrades are detected"""
+    if not cxx:
+        return ""
+    path = which(cxx.split(" ")[0])
+    if not path:
+        return cxx
+    realpath = os.path.realpath(path)
+    return cxx + "=" + realpath + ":" + fingerprint(realpath)
+
+
+def probe(program, name, cmd):
+    """Run a command that asks the given program, typically a compiler, about itself, and return the output.
+    The output is stored in the cache directory for as long as the program binary is unchanged.
+    name identifies the question, like "-dumpmachine"."""
+    identity = compiler_identity(program)
+    key = identity + "\n" + name
+    if key in cached_probes:
+        return cached_probes[key]
+    # Only store the output if the program was found, and could be identified by its size and modification time
+    persist = "=" in identity and use_cache()
+    if persist:
+        cache = load_cache("compilers")
+        if name in cache.get(identity, {}):
+            cached_probes[key] = cache[identity][name]
+            return cached_probes[key]
+    output = popen2(cmd)[1].read()
+    cached_probes[key] = output
+    if persist:
+        with cache_lock:
+            # Load the cache again, in case another build has written to it in the meantime
+            cache = load_cache("compilers")
+            # Forget compilers that have been upgraded or removed, if there are many
+            for old_identity in list(cache.keys())[:max(0, len(cache) - 64)]:
+                del cache[old_identity]
+            cache.setdefault(identity, {})[name] = output
+            save_cache("compilers", cache)
+    return output
+
+
+def dumpmachine(cxx):
+    """Return the machine name (target triple) of the given compiler, like "x86_64-linux-gnu", or an empty string"""
+    if not (cxx and which(cxx.split(" ")[0])):
+        return ""
+    try:
+        return probe(cxx, "-dumpmachine", cxx + " -dumpmachine").strip()
+    except OSError:
+        return ""
+
+
+def compiler_include_dirs(cxx, language=""):
+    """Return the system include directories that the given compiler searches automatically.
+    The language can be given, like "c++", to also get the directories of the C++ standard library."""
+    option = " -x " + language if language else ""
+    # The compiler also searches the directories in these variables, so they are part of the probe name
+    paths = "".join(" " + name + "=" + os.environ[name] for name in ("CPATH", "C_INCLUDE_PATH", "CPLUS_INCLUDE_PATH")
+                    if os.environ.get(name))
+    try:
+        output = probe(cxx, option + " -E -Wp,-v" + paths, "echo | " + cxx + option + " -E -Wp,-v - 2>&1")
+    except OSError:
+        return []
+    return [line.strip().split()[0] for line in output.split("\n")
+            if line.strip().startswith("/") and os.path.exists(line.strip().split()[0])]
+
+
 def split_cxxflags(given_cxxflags, win64):
     """Split a list of flags into includes (-I...), defines (-D...), libs (-l...), lib paths (-L...), linkflags (-Wl,) and other flags (-p, -F, -framework)"""
     includes = " "
@@ -114,8 +350,8 @@ def split_cxxflags(given_cxxflags, win64):
             if " " + flag[2:] + " " not in defines:
                 defines += flag[2:] + " "
         elif flag.startswith("-l"):
-            if " " + flag[2:] + " " not in libs:
-                libs += flag[2:] + " "
+            # Keep the last occurrence, so that libraries stay before the libraries they depend on
+            libs = libs.replace(" " + flag[2:] + " ", " ") + flag[2:] + " "
         elif flag.startswith("-L"):
             if " " + flag + " " not in libpaths:
                 libpaths += flag + " "
@@ -169,6 +405,188 @@ def split_cxxflags(given_cxxflags, win64):
     return includes.strip(), defines.strip(), libs.strip(), libpaths.strip(), linkflags.strip(), other.strip()
 
 
+def pkg_config_defaults():
+    """Ask pkg-config once for the default search path and the system include and library directories.
+    Returns three lists of directories."""
+    global cached_pkg_config_defaults
+    if cached_pkg_config_defaults is None:
+        cmd = "for v in pc_path pc_system_includedirs pc_system_libdirs; do pkg-config --variable $v pkg-config 2>/dev/null || echo; done"
+        # The answers depend on the pkg-config binary, and may depend on these environment variables
+        name = "defaults " + " ".join(os.environ.get(var, "") for var in ("PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR", "PKG_CONFIG_SYSROOT_DIR"))
+        try:
+            lines = probe("pkg-config", name, cmd).split("\n")
+        except OSError:
+            lines = []
+        lines = [[d for d in line.strip().split(os.pathsep) if d] for line in lines + ["", "", ""]]
+        pc_path = lines[0] or [d for d in PC_DIRS if os.path.isdir(d)]
+        system_includedirs = lines[1] or ["/usr/include"]
+        system_libdirs = lines[2] or ["/usr/lib", "/lib"]
+        cached_pkg_config_defaults = pc_path, system_includedirs, system_libdirs
+    return cached_pkg_config_defaults
+
+
+def pkg_config_search_path(extra_dirs=None):
+    """Return the directories where .pc files are searched for, in the same order as pkg-config.
+    extra_dirs are searched first, like when they are given in PKG_CONFIG_PATH."""
+    dirs = list(extra_dirs or [])
+    dirs += [d for d in os.environ.get("PKG_CONFIG_PATH", "").split(os.pathsep) if d]
+    if "PKG_CONFIG_LIBDIR" in os.environ:
+        dirs += [d for d in os.environ["PKG_CONFIG_LIBDIR"].split(os.pathsep) if d]
+    else:
+        dirs += pkg_config_defaults()[0]
+    return dirs
+
+
+def parse_pc_file(pc_file):
+    """Parse a .pc file and return a dict with the fields (like Cflags and Libs), with all variables expanded.
+    Returns None if the file can not be read."""
+    if pc_file in cached_pc_fields:
+        return cached_pc_fields[pc_file]
+    try:
+        with open(pc_file) as f:
+            data = f.read()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+    sysroot = os.environ.get("PKG_CONFIG_SYSROOT_DIR", "")
+    variables = {"pcfiledir": os.path.dirname(pc_file), "pc_sysrootdir": sysroot or "/"}
+    fields = {}
+
+    def expand(value):
+        # Expand ${variable} references, and $$ to a single $
+        return re.sub(r"\$\$|\$\{([^}]*)\}", lambda m: "$" if m.group(0) == "$$" else variables.get(m.group(1), ""), value)
+
+    for line in data.replace("\\\n", " ").split("\n"):
+        line = line.split("#", 1)[0].strip()
+        m = re.match(r"^([A-Za-z0-9_.]+)\s*([:=])\s*(.*)$", line)
+        if not m:
+            continue
+        key, separator, value = m.group(1), m.group(2), expand(m.group(3).strip())
+        if separator == "=":
+            variables[key] = value
+        else:
+            # The field names are case insensitive, ie. both "Cflags" and "CFlags" are in use
+            fields[key.lower()] = value
+    cached_pc_fields[pc_file] = fields
+    return fields
+
+
+def split_pc_flags(value):
+    """Split the flags in a Cflags or Libs field like a shell would"""
+    try:
+        return shlex.split(value)
+    except ValueError:
+        return value.split()
+
+
+def pc_unique_libs(flags):
+    """Remove duplicate linker flags, keeping the last occurrence of each flag, like pkg-config does.
+    This keeps libraries before the libraries that they depend on."""
+    unique = []
+    for flag in reversed(flags):
+        if flag not in unique:
+            unique.append(flag)
+    unique.reverse()
+    return unique
+
+
+def pc_requires(value):
+    """Return the package names from a Requires field, like "glib-2.0 >= 2.50, gobject-2.0", without the version constraints"""
+    names = []
+    skip_next = False
+    for word in value.replace(",", " ").split():
+        if skip_next:
+            skip_next = False
+        elif word in ("<", "<=", "=", "!=", ">=", ">"):
+            # The next word is a version number
+            skip_next = True
+        else:
+            names.append(word)
+    return names
+
+
+def pkg_config(names, extra_dirs=None):
+    """Interpret .pc files directly, instead of running "pkg-config --cflags --libs" for the given space separated package names.
+    Variables, Requires and Requires.private, PKG_CONFIG_PATH, PKG_CONFIG_LIBDIR and PKG_CONFIG_SYSROOT_DIR are handled.
+    Like pkg-config, an empty string is returned if one of the packages (or one of their requirements) is missing."""
+    key = (names, tuple(extra_dirs or []))
+    if key in cached_pkg_config:
+        return cached_pkg_config[key]
+    search_path = pkg_config_search_path(extra_dirs)
+    _, system_includedirs, system_libdirs = pkg_config_defaults()
+    if "PKG_CONFIG_SYSTEM_INCLUDE_PATH" in os.environ:
+        system_includedirs = os.environ["PKG_CONFIG_SYSTEM_INCLUDE_PATH"].split(os.pathsep)
+    if "PKG_CONFIG_SYSTEM_LIBRARY_PATH" in os.environ:
+        system_libdirs = os.environ["PKG_CONFIG_SYSTEM_LIBRARY_PATH"].split(os.pathsep)
+    for variable in ("CPATH", "C_INCLUDE_PATH", "CPLUS_INCLUDE_PATH"):
+        system_includedirs = system_includedirs + [d for d in os.environ.get(variable, "").split(os.pathsep) if d]
+    allow_system_cflags = "PKG_CONFIG_ALLOW_SYSTEM_CFLAGS" in os.environ
+    allow_system_libs = "PKG_CONFIG_ALLOW_SYSTEM_LIBS" in os.environ
+    sysroot = os.environ.get("PKG_CONFIG_SYSROOT_DIR", "")
+
+    cflags = []
+    expanded = {}
+
+    def visit(name, private, requiring=()):
+        """Collect the cflags for the given package and its requirements, and return the libs of the package
+        followed by the libs of its requirements, without duplicates. Returns None if a package is missing."""
+        if (name, private) in expanded:
+            return expanded[(name, private)]
+        if name in requiring:
+            # Packages that require each other
+            return []
+        fields = None
+        for pc_dir in search_path:
+            pc_file = os.path.join(pc_dir, name + ".pc")
+            if os.path.exists(pc_file):
+                fields = parse_pc_file(pc_file)
+                break
+        if fields is None:
+            return None
+        for flag in split_pc_flags(fields.get("cflags", "")):
+            if sysroot and flag.startswith("-I/"):
+                flag = "-I" + sysroot + flag[2:]
+            if flag.startswith("-I") and not allow_system_cflags and os.path.normpath(flag[2:]) in system_includedirs:
+                continue
+            if flag not in cflags:
+                cflags.append(flag)
+        libs = []
+        if not private:
+            words = split_pc_flags(fields.get("libs", ""))
+            while words:
+                flag = words.pop(0)
+                if flag == "-framework" and words:
+                    # Keep "-framework Name" together when removing duplicates
+                    flag += " " + words.pop(0)
+                if sysroot and flag.startswith("-L/"):
+                    flag = "-L" + sysroot + flag[2:]
+                if flag.startswith("-L") and not allow_system_libs and os.path.normpath(flag[2:]) in system_libdirs:
+                    continue
+                libs.append(flag)
+        for required in pc_requires(fields.get("requires", "")):
+            required_libs = visit(required, private, requiring + (name,))
+            if required_libs is None:
+                return None
+            libs += required_libs
+        # The cflags of privately required packages are also needed
+        for required in pc_requires(fields.get("requires.private", "")):
+            if visit(required, True, requiring + (name,)) is None:
+                return None
+        expanded[(name, private)] = pc_unique_libs(libs)
+        return expanded[(name, private)]
+
+    flags = ""
+    libs = []
+    for name in names.split():
+        package_libs = visit(name, False)
+        if package_libs is None:
+            break
+        libs += package_libs
+    else:
+        flags = " ".join(cflags + pc_unique_libs(libs))
+    cached_pkg_config[key] = flags
+    return flags
+
+
 def generic_include_path_to_cxxflags(include_path):
     """Takes a path to a header file and returns cxxflags, or an empty string.
     For unfamiliar Linux distros where a package manager and pkg-config are not available."""
@@ -206,6 +624,122 @@ def generic_include_path_to_cxxflags(include_path):
     return ""
 
 
+def version_sort_key(path):
+    """Sort key that orders numbers by value, like "sort -V". Example: "qt5" < "qt10" """
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+
+def header_index(root, maxdepth=3, followlinks=False):
+    """Index the files and directories below root, up to maxdepth levels deep (like find -maxdepth).
+    Returns a dict that maps all path suffixes ("SDL.h", "SDL2/SDL.h" etc.) to lists of full paths, and a list of directories.
+    The list of files is stored in the cache directory, and is only rebuilt when one of the indexed directories is modified."""
+    key = root + ":" + str(maxdepth) + ":" + str(followlinks)
+    if key in cached_header_indexes:
+        return cached_header_indexes[key]
+    cache = load_cache("headers")
+    entry = cache.get(key)
+    if not (entry and entry.get("dirs") and all(fingerprint(d) == fp for d, fp in entry["dirs"].items())):
+        dirs = {}
+        files = []
+        if os.path.isdir(root):
+            for dirpath, dirnames, filenames in os.walk(root, followlinks=followlinks):
+                depth = 0 if dirpath == root else os.path.relpath(dirpath, root).count(os.path.sep) + 1
+                dirs[dirpath] = fingerprint(dirpath)
+                # Files in this directory are at depth + 1
+                files += [os.path.relpath(os.path.join(dirpath, filename), root) for filename in filenames
+                          if os.path.isfile(os.path.join(dirpath, filename))]
+                if depth + 1 >= maxdepth:
+                    # Don't descend any further
+                    del dirnames[:]
+        entry = {"dirs": dirs, "files": files}
+        with cache_lock:
+            # Load the cache again, in case another build has written to it in the meantime
+            cache = load_cache("headers")
+            cache[key] = entry
+            save_cache("headers", cache)
+    suffixes = {}
+    for relpath in entry["files"]:
+        parts = relpath.split(os.path.sep)
+        full_path = os.path.join(root, relpath)
+        for i in range(len(parts)):
+            suffixes.setdefault("/".join(parts[i:]), []).append(full_path)
+    index = suffixes, sorted(entry["dirs"].keys())
+    cached_header_indexes[key] = index
+    return index
+
+
+def find_header(root, include, maxdepth=3, followlinks=False):
+    """Find the given include file below root, up to maxdepth levels deep, by looking it up in the header index.
+    If there are several matches, the one with the highest version number is returned. Returns an empty string if not found."""
+    include = include.replace("\\", "/").lstrip("/")
+    paths = header_index(root, maxdepth, followlinks)[0].get(include, [])
+    if not paths:
+        return ""
+    return sorted(paths, key=version_sort_key)[-1]
+
+
+def run_concurrently(cmds):
+    """Run the given shell commands in a thread pool sized to the number of CPUs, and return their output, in the same order.
+    The output of a command that could not be started is None. Used for package manager queries, that spend their time waiting."""
+    def run(cmd):
+        try:
+            return popen2(cmd)[1].read()
+        except OSError:
+            return None
+    if len(cmds) < 2:
+        return [run(cmd) for cmd in cmds]
+    pool = ThreadPool(min(cpu_count(), len(cmds)))
+    try:
+        return pool.map(run, cmds)
+    finally:
+        pool.terminate()
+
+
+def prefetch_owners(include_paths, package_manager):
+    """Find the packages that own the given include paths with a single package manager query per batch of paths,
+    instead of one query per path. The results are stored in cached_owners, with an empty string for paths no package owns.
+    The .pc files of the owning packages are then listed concurrently, one query per package, and stored in cached_pc_files.
+    package_manager is "deb", "arch" or "freebsd"."""
+    if package_manager not in PC_FILES_COMMANDS:
+        return
+    include_paths = [path for path in sorted(set(include_paths)) if path not in cached_owners and os.path.exists(path)]
+    # Keep the command lines at a reasonable length
+    batches = [include_paths[i:i + 256] for i in range(0, len(include_paths), 256)]
+    cmds = []
+    for batch in batches:
+        quoted_paths = " ".join(shlex.quote(path) for path in batch)
+        if package_manager == "deb":
+            cmds.append("LC_ALL=C /usr/bin/dpkg-query -S " + quoted_paths + " 2>/dev/null")
+        elif package_manager == "arch":
+            cmds.append("LC_ALL=C /usr/bin/pacman -Qo -- " + quoted_paths + " 2>/dev/null")
+        else:
+            cmds.append("/usr/sbin/pkg which " + quoted_paths + " 2>/dev/null")
+    for batch, output in zip(batches, run_concurrently(cmds)):
+        if output is None:
+            # Let the paths be looked up one by one
+            continue
+        for path in batch:
+            cached_owners[path] = ""
+        for line in output.strip().split("\n"):
+            if package_manager == "deb" and ": " in line and not line.startswith("diversion by "):
+                # Example: "libsdl2-dev:amd64: /usr/include/SDL2/SDL.h"
+                packages, path = line.rsplit(": ", 1)
+                cached_owners[path.strip()] = packages.split(":")[0].strip()
+            elif package_manager == "arch" and " is owned by " in line:
+                # Example: "/usr/include/SDL2/SDL.h is owned by sdl2 2.0.22-1"
+                path, owner = line.split(" is owned by ", 1)
+                cached_owners[path.strip()] = owner.split(" ")[0]
+            elif package_manager == "freebsd" and " was installed by package " in line:
+                # Example: "/usr/local/include/SDL2/SDL.h was installed by package sdl2-2.0.22"
+                path, owner = line.split(" was installed by package ", 1)
+                cached_owners[path.strip()] = owner.strip()
+    # The *_include_path_to_cxxflags functions would otherwise list the files of each package one after the other
+    packages = sorted(set(cached_owners.get(path) for path in include_paths) - set([None, ""]) - set(SKIP_PACKAGES) - set(cached_pc_files))
+    outputs = run_concurrently([PC_FILES_COMMANDS[package_manager].format(package) for package in packages])
+    for package, output in zip(packages, outputs):
+        if output is not None:
+            cached_pc_files[package] = [x for x in output.strip().split(os.linesep) if x]
+
 def arch_recommend_package(missing_include):
     """Given a missing include file, print out a message for a package that could be installed and exit with error code 1, or else just return."""
     if missing_include == "":
@@ -244,17 +778,20 @@ def arch_include_path_to_cxxflags(include_path):
     if not os.path.exists(include_path):
         return ""
     # Find the package that owns the include directory in question
-    cmd = 'LC_ALL=C /usr/bin/pacman -Qo -- ' + include_path + ' | /usr/bin/cut -d" " -f5'
-    try:
-        package = popen2(cmd)[1].read().strip()
-    except OSError:
-        package = ""
+    if include_path in cached_owners:
+        package = cached_owners[include_path]
+    else:
+        cmd = 'LC_ALL=C /usr/bin/pacman -Qo -- ' + include_path + ' | /usr/bin/cut -d" " -f5'
+        try:
+            package = popen2(cmd)[1].read().strip()
+        except OSError:
+            package = ""
     if not package:
         print("error: No package owns: " + include_path)
         exit(1)
     if package in SKIP_PACKAGES:
         return ""
-    cmd = fr'/usr/bin/pacman -Ql -- {package} | /usr/bin/grep "\\.pc$" | /usr/bin/cut -d" " -f2-'
+    cmd = PC_FILES_COMMANDS["arch"].format(package)
     if package in cached_pc_files:
         pc_files = cached_pc_files[package]
     else:
@@ -284,24 +821,15 @@ def arch_include_path_to_cxxflags(include_path):
         if package not in ["boost", "qt5-base", "qt6-base"]:  # these are "special"
             print("WARNING: No pkg-config files for: " + package)
         return ""
-    # TODO: Consider interpreting the .pc files directly, for speed
     all_cxxflags = ""
     for pc_file in pc_files:
         pc_name = os.path.splitext(os.path.basename(pc_file))[0]
-        cmd = '/usr/bin/pkg-config --cflags --libs ' + pc_name + ' 2>/dev/null'
-        # Get the cxxflags as defined by pkg-config
-        cxxflags = ""
-        try:
-            cxxflags = popen2(cmd)[1].read().strip()
-        except OSError:
-            pass
+        # Get the cxxflags as defined by the .pc file
+        cxxflags = pkg_config(pc_name, [os.path.dirname(pc_file)])
         # TODO: Do a better check for if pkg-config returns an empty string, for the case of glm this is correct
         if not cxxflags and pc_name != "glm" and pc_name != "libglvnd" and pc_name != "RapidJSON":
-            # pkg-config did not work (or returned an empty string)! Print a warning and just guess the flag.
-            if cmd.endswith("2>/dev/null"):
-                cmd = cmd[:-11]
-            # Output the pkg-config command
-            print("warning: this command gave no results:\n" + cmd)
+            # The .pc file did not work (or gave an empty string)! Print a warning and just guess the flag.
+            print("warning: this command gave no results:\npkg-config --cflags --libs " + pc_name)
             # Just guess the library flag
             cxxflags = "-l" + pc_name
         if cxxflags:
@@ -345,11 +873,14 @@ def freebsd_include_path_to_cxxflags(include_path):
     if not os.path.exists(include_path):
         return ""
     # Find the package that owns the include directory in question
-    cmd = '/usr/sbin/pkg which -q ' + include_path + ' | cut -d- -f1-'
-    try:
-        package = popen2(cmd)[1].read().strip()
-    except OSError:
-        package = ""
+    if include_path in cached_owners:
+        package = cached_owners[include_path]
+    else:
+        cmd = '/usr/sbin/pkg which -q ' + include_path + ' | cut -d- -f1-'
+        try:
+            package = popen2(cmd)[1].read().strip()
+        except OSError:
+            package = ""
     if not package:
         print("error: No package owns: " + include_path)
         exit(1)
@@ -358,7 +889,7 @@ def freebsd_include_path_to_cxxflags(include_path):
     if package in cached_pc_files:
         pc_files = cached_pc_files[package]
     else:
-        cmd = fr"/usr/sbin/pkg list {package} | /usr/bin/grep '\.pc$'"
+        cmd = PC_FILES_COMMANDS["freebsd"].format(package)
         try:
             pc_files = [x for x in popen2(cmd)[1].read().strip().split(os.linesep) if x]
             cached_pc_files[package] = pc_files
@@ -380,25 +911,15 @@ def freebsd_include_path_to_cxxflags(include_path):
         if package not in ["boost", "qt5-base", "qt6-base"]:  # these are "special"
             print("WARNING: No pkg-config files for: " + package)
         return ""
-    # TODO: Consider interpreting the .pc files directly, for speed
     all_cxxflags = ""
     for pc_file in pc_files:
         pc_name = os.path.splitext(os.path.basename(pc_file))[0]
-        cmd = '/usr/local/bin/pkg-config --cflags --libs ' + pc_name + ' 2>/dev/null'
-        # Get the cxxflags as defined by pkg-config
-        cxxflags = ""
-        try:
-            cxxflags = popen2(cmd)[1].read().strip()
-        except OSError:
-            # Let cxxflags remain empty
-            pass
+        # Get the cxxflags as defined by the .pc file
+        cxxflags = pkg_config(pc_name, [os.path.dirname(pc_file)])
         # TODO: Do a better check for if pkg-config returns an empty string, for the case of glm this is correct
         if not cxxflags and pc_name != "glm" and pc_name != "libglvnd" and pc_name != "RapidJSON":
-            # pkg-config did not work! Print a warning and just guess the flag.
-            if cmd.endswith("2>/dev/null"):
-                cmd = cmd[:-11]
-            # Output the pkg-config command
-            print("warning: this command gave no results:\n" + cmd)
+            # The .pc file did not work (or gave an empty string)! Print a warning and just guess the flag.
+            print("warning: this command gave no results:\npkg-config --cflags --libs " + pc_name)
             # Just guess the library flag
             cxxflags = "-l" + pc_name
         if cxxflags:
@@ -452,25 +973,15 @@ def openbsd_include_path_to_cxxflags(include_path):
         if package not in ["boost", "qt5-base", "qt6-base"]:  # these are "special"
             print("WARNING: No pkg-config files for: " + package)
         return ""
-    # TODO: Consider interpreting the .pc files directly, for speed
     all_cxxflags = ""
     for pc_file in pc_files:
         pc_name = os.path.splitext(os.path.basename(pc_file))[0]
-        cmd = '/usr/bin/pkg-config --cflags --libs ' + pc_name + ' 2>/dev/null'
-        # Get the cxxflags as defined by pkg-config
-        cxxflags = ""
-        try:
-            cxxflags = popen2(cmd)[1].read().strip()
-        except OSError:
-            # Let cxxflags remain empty
-            pass
+        # Get the cxxflags as defined by the .pc file
+        cxxflags = pkg_config(pc_name, [os.path.dirname(pc_file)])
         # TODO: Do a better check for if pkg-config returns an empty string, for the case of glm this is correct
         if not cxxflags and pc_name != "glm" and pc_name != "libglvnd" and pc_name != "RapidJSON":
-            # pkg-config did not work! Print a warning and just guess the flag.
-            if cmd.endswith("2>/dev/null"):
-                cmd = cmd[:-11]
-            # Output the pkg-config command
-            print("warning: this command gave no results:\n" + cmd)
+            # The .pc file did not work (or gave an empty string)! Print a warning and just guess the flag.
+            print("warning: this command gave no results:\npkg-config --cflags --libs " + pc_name)
             # Just guess the library flag
             cxxflags = "-l" + pc_name
         if cxxflags:
@@ -513,17 +1024,20 @@ def deb_include_path_to_cxxflags(include_path, cxx="g++"):
     if not os.path.exists(include_path):
         return ""
     # Find the package that owns the include directory in question
-    cmd = 'LC_ALL=C /usr/bin/dpkg-query -S ' + include_path + ' | /usr/bin/cut -d: -f1'
-    try:
-        package = popen2(cmd)[1].read().strip()
-    except OSError:
-        package = ""
+    if include_path in cached_owners:
+        package = cached_owners[include_path]
+    else:
+        cmd = 'LC_ALL=C /usr/bin/dpkg-query -S ' + include_path + ' | /usr/bin/cut -d: -f1'
+        try:
+            package = popen2(cmd)[1].read().strip()
+        except OSError:
+            package = ""
     if not package:
         print("error: No package owns: " + include_path)
         exit(1)
     if package in SKIP_PACKAGES:
         return ""
-    cmd = fr"LC_ALL=C /usr/bin/dpkg-query -L {package} | /bin/grep '\.pc$'"
+    cmd = PC_FILES_COMMANDS["deb"].format(package)
     if package in cached_pc_files:
         pc_files = cached_pc_files[package]
     else:
@@ -533,7 +1047,7 @@ def deb_include_path_to_cxxflags(include_path, cxx="g++"):
         except OSError:
             pc_files = []
     if not pc_files:
-        machine_name = popen2(cxx + " -dumpmachine")[1].read().strip()
+        machine_name = dumpmachine(cxx)
         # Example: Extract "boost_filesystem" from "/usr/include/boost/filesystem.h"
         booststyle = os.path.splitext("_".join(include_path.split("/")[-2:]))[0]
         # If a library in one of the library paths matches the name of the package without .pc files, link with that
@@ -554,24 +1068,15 @@ def deb_include_path_to_cxxflags(include_path, cxx="g++"):
         if package not in ["boost", "qt5-base", "qt6-base"]:  # these are "special"
             print("WARNING: No pkg-config files for: " + package)
         return ""
-    # TODO: Consider interpreting the .pc files directly, for speed
     all_cxxflags = ""
     for pc_file in pc_files:
         pc_name = os.path.splitext(os.path.basename(pc_file))[0]
-        cmd = '/usr/bin/pkg-config --cflags --libs ' + pc_name + ' 2>/dev/null'
-        # Get the cxxflags as defined by pkg-config
-        cxxflags = ""
-        try:
-            cxxflags = popen2(cmd)[1].read().strip()
-        except OSError:
-            pass
+        # Get the cxxflags as defined by the .pc file
+        cxxflags = pkg_config(pc_name, [os.path.dirname(pc_file)])
         # TODO: Do a better check for if pkg-config returns an empty string, for the case of glm this is correct
         if not cxxflags and pc_name != "glm" and pc_name != "libglvnd" and pc_name != "RapidJSON":
-            # pkg-config did not work! Print a warning and just guess the flag.
-            if cmd.endswith("2>/dev/null"):
-                cmd = cmd[:-11]
-            # Output the pkg-config command
-            print("warning: this command gave no results:\n" + cmd)
+            # The .pc file did not work (or gave an empty string)! Print a warning and just guess the flag.
+            print("warning: this command gave no results:\npkg-config --cflags --libs " + pc_name)
             # Just guess the library flag
             cxxflags = "-l" + pc_name
         if cxxflags:
@@ -638,25 +1143,15 @@ def brew_include_path_to_cxxflags(include_path):
         if package not in ["boost", "qt5-base", "qt6-base"]:  # these are "special"
             print("WARNING: No pkg-config files for: " + package)
         return ""
-    # TODO: Consider interpreting the .pc files directly, for speed
     all_cxxflags = ""
     for pc_file in pc_files:
         pc_name = os.path.splitext(os.path.basename(pc_file))[0]
-        pc_dir = os.path.dirname(pc_file)
-        cmd = 'PKG_CONFIG_PATH="' + pc_dir + '" pkg-config --cflags --libs ' + pc_name + ' 2>/dev/null'
-        # Get the cxxflags as defined by pkg-config
-        cxxflags = ""
-        try:
-            cxxflags = popen2(cmd)[1].read().strip()
-        except OSError:
-            pass
+        # Get the cxxflags as defined by the .pc file
+        cxxflags = pkg_config(pc_name, [os.path.dirname(pc_file)])
         # TODO: Do a better check for if pkg-config returns an empty string, for the case of glm this is correct
         if not cxxflags and pc_name != "glm" and pc_name != "libglvnd" and pc_name != "RapidJSON":
-            # pkg-config did not work! Print a warning and just guess the flag.
-            if cmd.endswith("2>/dev/null"):
-                cmd = cmd[:-11]
-            # Output the pkg-config command
-            print("warning: this command gave no results:\n" + cmd)
+            # The .pc file did not work (or gave an empty string)! Print a warning and just guess the flag.
+            print("warning: this command gave no results:\npkg-config --cflags --libs " + pc_name)
             # Just guess the library flag
             cxxflags = "-l" + pc_name
         if cxxflags:
@@ -666,40 +1161,296 @@ def brew_include_path_to_cxxflags(include_path):
     return all_cxxflags.strip()
 
 
+def buildflags_cache_key(sourcefilename, system_include_dirs, win64, compiler_includes, cxx):
+    """Return a key for the persistent build flag cache, or an empty string if the source file can not be read.
+    The key covers the includes of the source file, the compiler, the relevant build arguments and the state
+    of the package databases and pkg-config directories on the system."""
+    scanned = scan_source(sourcefilename)
+    if scanned is None:
+        return ""
+    includes = sorted(set(scanned[0]))
+    # Which includes are found locally changes which includes are looked up on the system
+    local_includes = [os.path.join(local_include_path, include) for include in includes
+                      for local_include_path in LOCAL_INCLUDE_PATHS if os.path.exists(os.path.join(local_include_path, include))]
+    key_parts = [
+        platform.system(),
+        compiler_identity(cxx),
+        str(win64),
+        " ".join(str(ARGUMENTS.get(name, 0)) for name in ("strict", "sloppy", "clang", "zap")),
+        " ".join(system_include_dirs),
+        " ".join(compiler_includes),
+        os.environ.get("PKG_CONFIG_PATH", ""),
+        " ".join(includes),
+        " ".join(local_includes),
+        str(scanned[2]),  # OpenGL applications that mention glu are also linked with glu
+    ]
+    key_parts += [path + "=" + fingerprint(path) for path in PACKAGE_DATABASES + PC_DIRS]
+    return hashlib.sha1("\n".join(key_parts).encode("utf-8")).hexdigest()
+
+
 def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes, cxx=None):
     """Given a source file, try to extract the relevant includes and get pkg-config to output relevant --cflags and --libs.
+    The results are cached in the cache directory, since discovering the flags may be slow.
     Returns includes, defines, libs, lib paths, linkflags and other cxx flags"""
-
-    if type(system_include_dirs) == type(""):
-        print("error: system_include_dirs is supposed to be a list")
-        sys.exit(1)
-
     if sourcefilename == "":
         return "", "", "", "", "", ""
+    return discover_all_buildflags([sourcefilename], system_include_dirs, win64, compiler_includes, cxx)[sourcefilename]
 
-    # Check if pkg-config is in the PATH
-    has_pkg_config = bool(which("pkg-config"))
-    has_package_manager = False
 
-    # if 'run' not in ARGUMENTS:
-    #    print("Discovering build flags for {}... ".format(sourcefilename), end="")
-    #    stdout.flush()
+def host_macros():
+    """Return a dict with the macros that are predefined by the C preprocessor on this system, like __linux__ and __x86_64__"""
+    if cached_host_macros:
+        return cached_host_macros
+    macros = {}
+    try:
+        output = probe("cpp", "-dM", "cpp -dM -E - < /dev/null 2>/dev/null")
+    except OSError:
+        output = ""
+    for line in output.split("\n"):
+        fields = line.split(" ", 2)
+        if len(fields) >= 2 and fields[0] == "#define" and "(" not in fields[1]:
+            macros[fields[1]] = fields[2] if len(fields) > 2 else ""
+    if not macros:
+        # No working cpp, guess the most common platform macros
+        system = platform.system()
+        if system == "Linux":
+            macros.update({"__linux__": "1", "__linux": "1", "linux": "1", "__unix__": "1", "__unix": "1", "unix": "1"})
+        elif system == "Darwin":
+            macros.update({"__APPLE__": "1", "__MACH__": "1"})
+        elif system.endswith("BSD"):
+            macros.update({"__" + system + "__": "1", "__unix__": "1", "__unix": "1"})
+        elif system == "Windows":
+            macros.update({"_WIN32": "1"})
+        macros["__GNUC__"] = "4"
+    macros["__STDC__"] = "1"
+    cached_host_macros.update(macros)
+    return cached_host_macros
+
+
+def strip_comments(source):
+    """Replace comments with a space and join lines that end with a backslash, leaving string literals alone"""
+    source = source.replace("\r\n", "\n").replace("\\\n", "")
+
+    def replace(match):
+        if match.group(0).startswith("/"):
+            # Keep newlines, so that multi-line comments do not join preprocessor directives
+            return " " + "\n" * match.group(0).count("\n")
+        return match.group(0)
+
+    return re.sub(r'//[^\n]*|/\*.*?(?:\*/|$)|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', replace, source, flags=re.DOTALL)
+
+
+def eval_condition(expression, macros, include_dirs):
+    """Evaluate the expression of an #if or #elif directive, given a dict of defined macros.
+    Identifiers that are not defined count as 0, like in the C preprocessor.
+    __has_include is answered by looking in the given include directories.
+    Returns False if the expression can not be evaluated."""
+
+    def has_include(match):
+        for include_dir in include_dirs:
+            if os.path.exists(os.path.join(include_dir, match.group(1))):
+                return " 1 "
+        return " 0 "
+
+    expression = re.sub(r'\bdefined\s*\(\s*(\w+)\s*\)|\bdefined\s+(\w+)',
+                        lambda match: " 1 " if (match.group(1) or match.group(2)) in macros else " 0 ", expression)
+    expression = re.sub(r'\b__has_include(?:_next)?\s*\(\s*[<"]([^>"]+)[>"]\s*\)', has_include, expression)
+    token_pattern = re.compile(r"\d+[\w.]*|\w+|&&|\|\||==|!=|<=|>=|<<|>>|'(?:\\.|[^'\\])+'|\S")
+    tokens = token_pattern.findall(expression)
+
+    # Expand object-like macros, and let any other identifiers (and function-like macro calls) count as 0
+    expanded = []
+    expansions = 0
+    while tokens:
+        token = tokens.pop(0)
+        if token[0].isalpha() or token[0] == "_":
+            if tokens and tokens[0] == "(":
+                # Skip the arguments of a function-like macro, the result is not known
+                depth = 0
+                while tokens:
+                    if tokens[0] == "(":
+                        depth += 1
+                    elif tokens[0] == ")":
+                        depth -= 1
+                    tokens.pop(0)
+                    if depth == 0:
+                        break
+            elif token in macros and expansions < 1000:
+                expansions += 1
+                tokens = token_pattern.findall(macros[token]) + tokens
+                continue
+            expanded.append("1" if token == "true" else "0")
+        else:
+            expanded.append(token)
+    tokens = expanded
+
+    binary_operators = {"*": 10, "/": 10, "%": 10, "+": 9, "-": 9, "<<": 8, ">>": 8, "<": 7, "<=": 7, ">": 7, ">=": 7,
+                        "==": 6, "!=": 6, "&": 5, "^": 4, "|": 3, "&&": 2, "||": 1}
+    operations = {
+        "*": lambda a, b: a * b,
+        "/": lambda a, b: int(float(a) / b),  # rounds towards zero, like in C
+        "%": lambda a, b: a - b * int(float(a) / b),
+        "+": lambda a, b: a + b,
+        "-": lambda a, b: a - b,
+        "<<": lambda a, b: a << b,
+        ">>": lambda a, b: a >> b,
+        "<": lambda a, b: int(a < b),
+        "<=": lambda a, b: int(a <= b),
+        ">": lambda a, b: int(a > b),
+        ">=": lambda a, b: int(a >= b),
+        "==": lambda a, b: int(a == b),
+        "!=": lambda a, b: int(a != b),
+        "&": lambda a, b: a & b,
+        "^": lambda a, b: a ^ b,
+        "|": lambda a, b: a | b,
+        "&&": lambda a, b: int(bool(a) and bool(b)),
+        "||": lambda a, b: int(bool(a) or bool(b)),
+    }
+
+    def peek():
+        return tokens[0] if tokens else ""
+
+    def number(token):
+        if token.startswith("'"):
+            return ord(token[1:-1].replace("\\", "")[-1:] or "\0")
+        token = token.rstrip("uUlL")
+        if len(token) > 1 and token[0] == "0" and token[1] not in "xXbB":
+            return int(token, 8)
+        return int(token, 0)
+
+    def unary():
+        token = tokens.pop(0)
+        if token == "(":
+            value = conditional()
+            if tokens.pop(0) != ")":
+                raise ValueError(expression)
+            return value
+        if token == "!":
+            return int(not unary())
+        if token == "-":
+            return -unary()
+        if token == "+":
+            return unary()
+        if token == "~":
+            return ~unary()
+        return number(token)
+
+    def binary(min_precedence):
+        left = unary()
+        while peek() in binary_operators and binary_operators[peek()] >= min_precedence:
+            operator = tokens.pop(0)
+            left = operations[operator](left, binary(binary_operators[operator] + 1))
+        return left
+
+    def conditional():
+        value = binary(1)
+        if peek() == "?":
+            tokens.pop(0)
+            if_true = conditional()
+            if tokens.pop(0) != ":":
+                raise ValueError(expression)
+            if_false = conditional()
+            return if_true if value else if_false
+        return value
 
-    # Filter out include lines, then run cpp
-    cmd = "LC_CTYPE=C && LANG=C && sed 's/^#include/" + SPECIAL_SYMBOLS + "include/g' < \"" + \
-        sourcefilename + "\" | cpp -E -P -w -pipe | sed 's/^" + SPECIAL_SYMBOLS + "include/#include/g'"
     try:
-        source_lines = popen2(cmd)[1].read().split(os.linesep)[:-1]
-    except:
-        print("WARNING: Command failed: " + cmd)
-        return "", "", "", "", "", ""
+        value = conditional()
+        return not tokens and bool(value)
+    except (ValueError, IndexError, ZeroDivisionError, TypeError, OverflowError):
+        return False
+
+
+def scan_source(fname):
+    """Scan the preprocessor directives of the given source file, without running the preprocessor.
+    Conditional blocks are evaluated with the macros that are predefined on this system and the ones defined in the file.
+    Returns a list of all includes, a list of the "local" includes and True if "glu" is mentioned in the source,
+    or None if the file can not be read. The results are kept for as long as the file is unchanged."""
+    fp = fingerprint(fname)
+    if fname in cached_sources and cached_sources[fname][0] == fp:
+        return cached_sources[fname][1]
+    try:
+        with open(fname) as f:
+            source = f.read()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+    macros = dict(host_macros())
+    if not fname.endswith(".c"):
+        macros["__cplusplus"] = "201703L"
+    include_dirs = [os.path.dirname(fname) or "."] + LOCAL_INCLUDE_PATHS + ["/usr/include", "/usr/local/include"]
     includes = []
-    for line in source_lines:
-        if line.strip().startswith("#include"):
-            if line.count("<") == 1 and line.count(">") == 1:
-                includes.append(line.strip().split("<")[1].split(">")[0])
-            elif line.count("\"") == 2:
-                includes.append(line.strip().split("\"")[1].split("\"")[0])
+    local_includes = []
+    also_glu = False
+    # Each entry is: is the enclosing block active, has a branch been taken, is the current branch active
+    stack = []
+    active = True
+    for line in strip_comments(source).split("\n"):
+        stripped = line.strip()
+        if not stripped.startswith("#"):
+            if active and "glu" in line:
+                also_glu = True
+            continue
+        fields = stripped[1:].strip().split(None, 1)
+        directive = fields[0] if fields else ""
+        argument = fields[1].strip() if len(fields) > 1 else ""
+        if directive in ("if", "ifdef", "ifndef"):
+            if not active:
+                condition = False
+            elif directive == "ifdef":
+                condition = argument.split("(")[0].strip() in macros
+            elif directive == "ifndef":
+                condition = argument.split("(")[0].strip() not in macros
+            else:
+                condition = eval_condition(argument, macros, include_dirs)
+            stack.append((active, condition))
+            active = condition
+        elif directive == "elif" and stack:
+            parent_active, taken = stack[-1]
+            active = parent_active and not taken and eval_condition(argument, macros, include_dirs)
+            stack[-1] = (parent_active, taken or active)
+        elif directive == "else" and stack:
+            parent_active, taken = stack[-1]
+            active = parent_active and not taken
+            stack[-1] = (parent_active, True)
+        elif directive == "endif" and stack:
+            active = stack.pop()[0]
+        elif not active:
+            continue
+        elif directive == "define" and argument:
+            name = re.match(r"\w+", argument)
+            if name:
+                value = argument[name.end():]
+                if value.startswith("("):
+                    # Function-like macros are only used for #ifdef
+                    macros[name.group(0)] = "0"
+                else:
+                    macros[name.group(0)] = value.strip()
+        elif directive == "undef":
+            macros.pop(argument.split(" ")[0], None)
+        elif directive == "include":
+            if "glu" in line:
+                also_glu = True
+            if argument.startswith("<") and ">" in argument:
+                includes.append(argument[1:].split(">")[0])
+            elif argument.startswith("\"") and argument.count("\"") >= 2:
+                includes.append(argument.split("\"")[1])
+                local_includes.append(argument.split("\"")[1])
+    result = (includes, local_includes, also_glu)
+    cached_sources[fname] = (fp, result)
+    return result
+
+
+def resolve_includes(includes, also_glu, system_include_dirs, win64, compiler_includes, cxx=None):
+    """Find the build flags for each of the given includes, by asking pkg-config, the package manager and the file system.
+    The includes may come from several source files, each distinct include is only resolved once.
+    Returns a dict from includes to flags, a dict from includes to -I flags and the set of includes that were searched for."""
+
+    if type(system_include_dirs) == type(""):
+        print("error: system_include_dirs is supposed to be a list")
+        exit(1)
+
+    # Check if pkg-config is in the PATH
+    has_pkg_config = bool(which("pkg-config"))
+    has_package_manager = False
 
     # Skip C99, C++, C++20 and deprecated C++ headers + more
     skiplist = ("assert.h", "complex.h", "ctype.h", "errno.h", "fenv.h", "float.h", "inttypes.h", "iso646.h", "limits.h", "locale.h", "math.h", "setjmp.h", "signal.h", "stdalign.h", "stdarg.h", "stdatomic.h", "stdbool.h", "stddef.h", "stdint.h", "stdio.h", "stdlib.h", "stdnoreturn.h", "string.h", "tgmath.h", "threads.h", "time.h", "uchar.h", "wchar.h", "wctype.h", "cstdlib", "csignal", "csetjmp", "cstdarg", "typeinfo", "typeindex", "type_traits", "bitset", "functional", "utility", "ctime", "chrono", "cstddef", "initializer_list", "tuple", "any", "optional", "variant", "new", "memory", "scoped_allocator", "memory_resource", "climits", "cfloat", "cstring", "cctype",
@@ -779,11 +1530,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                         first_word = include.lower()
                         if os.path.sep in include:
                             first_word = include.split(os.path.sep)[0].lower()
-                        cmd = "pkg-config --cflags --libs " + first_word + " 2>/dev/null"
-                        try:
-                            new_flags = popen2(cmd)[1].read().strip()
-                        except OSError:
-                            new_flags = ""
+                        new_flags = pkg_config(first_word)
                         if new_flags:
                             if include in flag_dict:
                                 flag_dict[include] += " " + new_flags
@@ -860,6 +1607,9 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
     # Using the include_lines, find the correct CFLAGS on Debian/Ubuntu
     if has_pkg_config and exe("/usr/bin/dpkg-query") and not exe("/usr/bin/pacman"):
         has_package_manager = True
+        # Find the packages that own the include paths with as few package manager queries as possible
+        prefetch_owners([os.path.join(system_include_dir, include) for include in includes if include not in flag_dict
+                         for system_include_dir in system_include_dirs], "deb")
         for include in includes:
             if include in flag_dict:
                 continue
@@ -872,28 +1622,30 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                     else:
                         flag_dict[include] = new_flags
         # Try the same with dpkg-query, but now using find to search deeper in system_include_dir
+        found_include_paths = []
         for include in includes:
             if include in flag_dict:
                 continue
             # Search system_include_dir
             for system_include_dir in system_include_dirs:
-                cmd = '/usr/bin/find ' + system_include_dir + ' -maxdepth 3 -type f -wholename "*' + \
-                    include + '" | /usr/bin/sort -V | /usr/bin/tail -1'
-                try:
-                    include_path = popen2(cmd)[1].read().strip()
-                except OSError:
-                    include_path = ""
+                include_path = find_header(system_include_dir, include)
                 if include_path:
-                    new_flags = deb_include_path_to_cxxflags(include_path, cxx)
-                    if new_flags:
-                        if include in flag_dict:
-                            flag_dict[include] += " " + new_flags
-                        else:
-                            flag_dict[include] = new_flags
+                    found_include_paths.append((include, include_path))
+        prefetch_owners([include_path for _, include_path in found_include_paths], "deb")
+        for include, include_path in found_include_paths:
+            new_flags = deb_include_path_to_cxxflags(include_path, cxx)
+            if new_flags:
+                if include in flag_dict:
+                    flag_dict[include] += " " + new_flags
+                else:
+                    flag_dict[include] = new_flags
 
     # Using the include_lines, find the correct CFLAGS on Arch Linux
     if has_pkg_config and exe("/usr/bin/pacman"):
         has_package_manager = True
+        # Find the packages that own the include paths with as few package manager queries as possible
+        prefetch_owners([os.path.join(system_include_dir, include) for include in includes if include not in flag_dict
+                         for system_include_dir in system_include_dirs], "arch")
         for include in includes:
             if include in flag_dict:
                 continue
@@ -916,15 +1668,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                     include_path = os.path.join(system_include_dir, include)
                     break
                 else:
-                    cmd = '/usr/bin/find ' + system_include_dir + ' -maxdepth 3 -type f -wholename "*/' + include + '" | /usr/bin/sort -V'
-                    try:
-                        possible_include_paths = sorted(popen2(cmd)[1].read().splitlines())
-                        include_path = ""
-                        for possible_include_path in possible_include_paths[::-1]:
-                            include_path = possible_include_path.strip()
-                            break
-                    except OSError:
-                        include_path = ""
+                    include_path = find_header(system_include_dir, include)
                 if include_path:
                     new_flags = arch_include_path_to_cxxflags(include_path)
                     if new_flags:
@@ -936,6 +1680,9 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
     # Using the include_lines, find the correct CFLAGS on FreeBSD
     if has_pkg_config and exe("/usr/sbin/pkg"):
         has_package_manager = True
+        # Find the packages that own the include paths with as few package manager queries as possible
+        prefetch_owners([os.path.join(system_include_dir, include) for include in includes if include not in flag_dict
+                         for system_include_dir in system_include_dirs], "freebsd")
         for include in includes:
             if include in flag_dict:
                 continue
@@ -952,12 +1699,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 continue
             # Search system_include_dir
             for system_include_dir in system_include_dirs:
-                cmd = '/usr/bin/find ' + system_include_dir + ' -maxdepth 3 -type f -wholename "*' + \
-                    include + '" | /usr/bin/sort -V | /usr/bin/tail -1'
-                try:
-                    include_path = popen2(cmd)[1].read().strip()
-                except OSError:
-                    include_path = ""
+                include_path = find_header(system_include_dir, include)
                 if include_path:
                     new_flags = freebsd_include_path_to_cxxflags(include_path)
                     if new_flags:
@@ -985,13 +1727,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 continue
             # Search system_include_dir
             for system_include_dir in system_include_dirs:
-                cmd = '/usr/bin/find ' + system_include_dir + ' -maxdepth 3 -type f -path "*' + \
-                    include + '" | /usr/bin/sort -V | /usr/bin/tail -1'
-                try:
-                    include_path = popen2(cmd)[1].read().strip()
-                except OSError:
-                    include_path = ""
-                include_path = os.path.dirname(include_path)
+                include_path = os.path.dirname(find_header(system_include_dir, include))
                 if include_path and os.path.exists(include_path):
                     new_flags = openbsd_include_path_to_cxxflags(include_path)
                     if new_flags:
@@ -1008,20 +1744,13 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 continue
             # Homebrew does not support finding the package that owns a file, search /usr/local/include instead
             for system_include_dir in system_include_dirs:
-                cmd = 'find -s -L ' + system_include_dir + ' -type f -wholename "*' + include + '" -maxdepth 4 | tail -1'
-                try:
-                    include_path = popen2(cmd)[1].read().strip()
-                except OSError:
-                    include_path = ""
+                include_path = find_header(system_include_dir, include, 4, True)
                 if not include_path:
                     # Could not find the include file in the system include dir, try searching /usr/local/Cellar for frameworks, and then headers
                     # This is much faster than searching for the header file directly, and it makes
                     # sense to look for the latest framework version before searching all of them.
-                    cmd = 'find /usr/local/Cellar/ -name Frameworks -type d -maxdepth 3 | sort -V'
-                    try:
-                        framework_dirs = popen2(cmd)[1].read().strip().split(os.linesep)
-                    except OSError:
-                        framework_dirs = []
+                    framework_dirs = sorted([d for d in header_index("/usr/local/Cellar", 4)[1] if os.path.basename(d) == "Frameworks"],
+                                            key=version_sort_key)
                     # If directories named "Frameworks" were found, sort them by version number and then search
                     # the directories of the ones with the highest version numbers for the include file
                     if framework_dirs:
@@ -1034,11 +1763,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                         # Loop over the framework directories belonging to the latest versions of the frameworks
                         # and look for the include file in question:
                         for framework_dir in framework_dict.values():
-                            cmd = 'find -L "' + framework_dir + '" -type f -maxdepth 4 -name "' + include + '" | tail -1'
-                            try:
-                                include_path = popen2(cmd)[1].read().strip()
-                            except OSError:
-                                include_path = ""
+                            include_path = find_header(framework_dir, include, 4, True)
                             if include_path:
                                 # Now use the existing function for getting build flags from a found include file
                                 new_flags = brew_include_path_to_cxxflags(include_path)
@@ -1123,11 +1848,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                     flag_dict[include] = new_flags
             if has_pkg_config:
                 # Try pkg-config
-                cmd = "pkg-config --cflags --libs gl 2>/dev/null"
-                try:
-                    new_flags = popen2(cmd)[1].read().strip()
-                except OSError:
-                    new_flags = ""
+                new_flags = pkg_config("gl")
                 if new_flags:
                     if include in flag_dict:
                         flag_dict[include] += " " + new_flags
@@ -1136,8 +1857,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
 
         # If one of the includes just mention something with OpenGL, GLUT or GLFW: add build flags for OpenGL
         if ("opengl" in include.lower()) or include.startswith("GL/") or include.startswith("GLUT/") or include.startswith("GLFW/"):
-            # Also check if "glu" is mentioned in the sourcefile, since we'll also have to link with glu then
-            also_glu = bool([line for line in source_lines if "glu" in line])
+            # also_glu is set if "glu" is mentioned in the sourcefile, since we'll also have to link with glu then
             new_flags = ""
             # Check if the macOS Frameworks path exists
             if os.path.exists("/Library/Frameworks") and not win64:
@@ -1151,7 +1871,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             elif win64:
                 new_flags = "-lopengl32"
@@ -1160,22 +1880,19 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             if has_pkg_config:
                 # Try pkg-config
-                cmd = "pkg-config --cflags --libs gl 2>/dev/null"
+                names = "gl"
                 if also_glu:
-                    cmd = cmd.replace(" gl ", " gl glu ")
-                try:
-                    new_flags = popen2(cmd)[1].read().strip()
-                except OSError:
-                    new_flags = ""
+                    names = "gl glu"
+                new_flags = pkg_config(names)
                 if new_flags:
                     if include in flag_dict:
                         if new_flags not in flag_dict[include]:
                             flag_dict[include] += " " + new_flags
-                    elif new_flags not in flag_dict.values():
+                    else:
                         flag_dict[include] = new_flags
             else:
                 # if the libGL library is in /usr/lib, /usr/lib/x86_64-linux-gnu, /usr/local/lib or /usr/pkg/lib, link with that
@@ -1187,7 +1904,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                         if include in flag_dict:
                             if new_flags not in flag_dict[include]:
                                 flag_dict[include] += " " + new_flags
-                        elif new_flags not in flag_dict.values():
+                        else:
                             flag_dict[include] = new_flags
                         break
 
@@ -1206,27 +1923,23 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             elif win64:
                 new_flags = "-lopenal32"
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             if has_pkg_config:
                 # Try pkg-config
-                cmd = "pkg-config --cflags --libs openal 2>/dev/null"
-                try:
-                    new_flags = popen2(cmd)[1].read().strip()
-                except OSError:
-                    new_flags = ""
+                new_flags = pkg_config("openal")
                 if new_flags:
                     if include in flag_dict:
                         if new_flags not in flag_dict[include]:
                             flag_dict[include] += " " + new_flags
-                    elif new_flags not in flag_dict.values():
+                    else:
                         flag_dict[include] = new_flags
             else:
                 # if the libopenal library is in /usr/lib, /usr/lib/x86_64-linux-gnu, /usr/local/lib or /usr/pkg/lib, link with that
@@ -1236,7 +1949,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                         if include in flag_dict:
                             if new_flags not in flag_dict[include]:
                                 flag_dict[include] += " " + new_flags
-                        elif new_flags not in flag_dict.values():
+                        else:
                             flag_dict[include] = new_flags
                         break
 
@@ -1247,7 +1960,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
 
         # If one of the includes mentions "SDL2/SDL_*", add flags for "SDL2_*"
@@ -1255,16 +1968,12 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
             word = "SDL2_" + include[9:].split(".")[0]
             if has_pkg_config:
                 # Try pkg-config
-                cmd = "pkg-config --cflags --libs " + word + " 2>/dev/null"
-                try:
-                    new_flags = popen2(cmd)[1].read().strip()
-                except OSError:
-                    new_flags = ""
+                new_flags = pkg_config(word)
                 if new_flags:
                     if include in flag_dict:
                         if new_flags not in flag_dict[include]:
                             flag_dict[include] += " " + new_flags
-                    elif new_flags not in flag_dict.values():
+                    else:
                         flag_dict[include] = new_flags
 
             else:
@@ -1275,7 +1984,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                         if include in flag_dict:
                             if new_flags not in flag_dict[include]:
                                 flag_dict[include] += " " + new_flags
-                        elif new_flags not in flag_dict.values():
+                        else:
                             flag_dict[include] = new_flags
                         break
 
@@ -1294,69 +2003,55 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             elif win64:
                 new_flags = "-lglu32"
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             else:
                 # if the libglut library is in /usr/lib, /usr/lib/x86_64-linux-gnu, /usr/local/lib or
                 # /usr/X11R7/lib, /usr/lib + machine_name, or /usr/pkg/lib; link with that
-                machine_name = ""
-                if cxx and which(cxx):
-                    machine_name = popen2(cxx + " -dumpmachine")[1].read().strip()
+                machine_name = dumpmachine(cxx)
                 for libpath in ["/usr/lib", "/usr/lib/x86_64-linux-gnu", "/usr/local/lib", "/usr/X11R7/lib", "/usr/lib/" + machine_name, "/usr/pkg/lib"]:
                     if os.path.exists(os.path.join(libpath, "libglut.so")):
                         new_flags = "-lglut"  # Only configuration required for ie. freeglut
                         if include in flag_dict:
                             if new_flags not in flag_dict[include]:
                                 flag_dict[include] += " " + new_flags
-                        elif new_flags not in flag_dict.values():
+                        else:
                             flag_dict[include] = new_flags
                         break
             if has_pkg_config:
                 # Try pkg-config
 
-                cmd = "pkg-config --cflags --libs glu 2>/dev/null"
-                try:
-                    new_flags = popen2(cmd)[1].read().strip()
-                except OSError:
-                    new_flags = ""
+                new_flags = pkg_config("glu")
                 if new_flags:
                     if include in flag_dict:
                         if new_flags not in flag_dict[include]:
                             flag_dict[include] += " " + new_flags
-                    elif new_flags not in flag_dict.values():
+                    else:
                         flag_dict[include] = new_flags
                 else:
                     # Try pkg-config with freeglut and glut first. Needed on NetBSD.
-                    cmd = "pkg-config --cflags --libs freeglut glut 2>/dev/null"
-                    try:
-                        new_flags = popen2(cmd)[1].read().strip()
-                    except OSError:
-                        new_flags = ""
+                    new_flags = pkg_config("freeglut glut")
                     if new_flags:
                         if include in flag_dict:
                             if new_flags not in flag_dict[include]:
                                 flag_dict[include] += " " + new_flags
-                        elif new_flags not in flag_dict.values():
+                        else:
                             flag_dict[include] = new_flags
                     else:
                         # Try pkg-config with just freeglut
-                        cmd = "pkg-config --cflags --libs freeglut 2>/dev/null"
-                        try:
-                            new_flags = popen2(cmd)[1].read().strip()
-                        except OSError:
-                            new_flags = ""
+                        new_flags = pkg_config("freeglut")
                         if new_flags:
                             if include in flag_dict:
                                 if new_flags not in flag_dict[include]:
                                     flag_dict[include] += " " + new_flags
-                            elif new_flags not in flag_dict.values():
+                            else:
                                 flag_dict[include] = new_flags
 
         # If one of the includes mention GLEW, add flags for GLEW
@@ -1368,20 +2063,16 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
             if has_pkg_config:
                 # Try pkg-config
-                cmd = "pkg-config --cflags --libs glew 2>/dev/null"
-                try:
-                    new_flags = popen2(cmd)[1].read().strip()
-                except OSError:
-                    new_flags = ""
+                new_flags = pkg_config("glew")
                 if new_flags:
                     if include in flag_dict:
                         if new_flags not in flag_dict[include]:
                             flag_dict[include] += " " + new_flags
-                    elif new_flags not in flag_dict.values():
+                    else:
                         flag_dict[include] = new_flags
 
         if include.startswith("Q"):
@@ -1398,7 +2089,7 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
                 if include in flag_dict:
                     if new_flags not in flag_dict[include]:
                         flag_dict[include] += " " + new_flags
-                elif new_flags not in flag_dict.values():
+                else:
                     flag_dict[include] = new_flags
 
         if include.startswith("glm/"):
@@ -1409,13 +2100,24 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
             if include in flag_dict:
                 if new_flags not in flag_dict[include]:
                     flag_dict[include] += " " + new_flags
-            elif new_flags not in flag_dict.values():
+            else:
                 flag_dict[include] = new_flags
 
+    return flag_dict, global_flag_dict, set(includes)
+
+
+def include_buildflags(includes, resolved, win64):
+    """Given the includes of one source file and the flags that were resolved for them by resolve_includes,
+    return the build flags for the source file: includes, defines, libs, lib paths, linkflags and other cxx flags.
+    Exits with an error if an include is missing, unless sloppy=1."""
+    flag_dict, global_flag_dict, searched_includes = resolved
+    # The special cases in resolve_includes use "/" instead of "\\" in the include paths
+    wanted = set(includes) | set([include.replace("\\", "/") for include in includes])
+
     # List includes that were not found. "linux" is sometimes replaced with "1", which may cause issues.
     # Qt includes are special.
     missing_includes = [
-        include for include in includes if include not in flag_dict and include not in global_flag_dict and not include.startswith("1/") and not include.startswith("Q")]
+        include for include in includes if include in searched_includes and include not in flag_dict and include not in global_flag_dict and not include.startswith("1/") and not include.startswith("Q")]
 
     if missing_includes:
         hints(missing_includes)
@@ -1441,9 +2143,9 @@ def get_buildflags(sourcefilename, system_include_dirs, win64, compiler_includes
             print("[{}] ".format(dirname), end='\n')
             # print("OK")
 
-    # Collect and return all the flags in flag_dict
-    all_cxxflags = (" ".join(flag_dict.values()) + " " +
-                    " ".join(global_flag_dict.values())).strip()
+    # Collect and return all the flags for the includes of this source file
+    all_cxxflags = (" ".join([flags for include, flags in flag_dict.items() if include in wanted]) + " " +
+                    " ".join([flags for include, flags in global_flag_dict.items() if include in wanted])).strip()
 
     if all_cxxflags:
         return split_cxxflags(all_cxxflags, win64)
@@ -1535,10 +2237,262 @@ def strip_ext(filenames):
     return [os.path.splitext(fname)[0] for fname in filenames]
 
 
-def add_flags(env, src_file, system_include_dirs, win64, compiler_includes):
-    """Add build flags to the environment"""
-    includes, defines, libs, libpaths, linkflags, other_cxxflags = get_buildflags(
-        src_file, system_include_dirs, win64, compiler_includes, str(env["CXX"]))
+def local_includes(filename, graph):
+    """Return the local "..." includes of the given file, or None if it can not be read.
+    graph maps absolute filenames to fingerprints and local includes, and is updated if the file has changed."""
+    key = os.path.abspath(filename)
+    fp = fingerprint(filename)
+    entry = graph.get(key)
+    if entry and entry[0] == fp:
+        return entry[1]
+    scanned = scan_source(filename)
+    if scanned is None:
+        return None
+    graph[key] = [fp, scanned[1]]
+    return scanned[1]
+
+
+def local_dep_sources(main_source_file, dep_src):
+    """Find all header files in the local include directories that are included by the main source file or dep_src,
+    directly or indirectly, and add the corresponding source files in the local common directories to dep_src.
+    The local includes of each file are stored in the cache directory, and files are only scanned again when changed."""
+    graph = load_cache("sources")
+    unchanged_graph = dict(graph)
+    dep_src = list(dep_src)
+    dep_src_lower = set([x.lower() for x in dep_src])
+    examined = set()
+    includes = set()
+    queue = [main_source_file] + dep_src
+    while queue:
+        filename = queue.pop(0)
+        if filename.lower() in examined:
+            continue
+        examined.add(filename.lower())
+        if not os.path.exists(filename):
+            continue
+        new_includes = local_includes(filename, graph)
+        if new_includes is None:
+            print("Can not read " + filename)
+            exit(1)
+        for new_include in [os.path.relpath(x) for x in new_includes]:
+            if new_include in includes:
+                continue
+            includes.add(new_include)
+            # The included header may include other headers
+            for include_path in LOCAL_INCLUDE_PATHS:
+                queue.append(os.path.join(include_path, new_include))
+            # Look for a source file with the same name as the header
+            for common_path in LOCAL_COMMON_PATHS:
+                for ext in [".cpp", ".cc", ".cxx", ".c"]:
+                    source_filename = os.path.join(common_path, new_include.rsplit(".", 1)[0] + ext)
+                    if os.path.exists(source_filename) and source_filename.lower() not in dep_src_lower:
+                        dep_src.append(source_filename)
+                        dep_src_lower.add(source_filename.lower())
+                        queue.append(source_filename)
+    save_source_graph(graph, unchanged_graph)
+    return dep_src
+
+
+def save_source_graph(graph, unchanged_graph):
+    """Store the local includes of the scanned files in the cache directory, if any of them have changed"""
+    if graph == unchanged_graph:
+        return
+    with cache_lock:
+        # Load the cache again, in case another build has written to it in the meantime
+        cache = load_cache("sources")
+        cache.update(graph)
+        # Don't let the cache grow without bounds, forget the oldest entries
+        for old_key in list(cache.keys())[:max(0, len(cache) - 65536)]:
+            del cache[old_key]
+        save_cache("sources", cache)
+
+
+def source_closure(filename, graph):
+    """Return the local files that the given source file depends on: the file itself, the local headers that it
+    includes, directly or indirectly, and the source files with the same name as these headers, in the current
+    directory or in the local common directories, together with what they depend on"""
+    closure = set()
+    queue = [filename]
+    while queue:
+        filename = os.path.normpath(queue.pop(0))
+        if filename in closure or not os.path.isfile(filename):
+            continue
+        closure.add(filename)
+        for new_include in [os.path.relpath(x) for x in local_includes(filename, graph) or []]:
+            for include_path in LOCAL_INCLUDE_PATHS:
+                queue.append(os.path.join(include_path, new_include))
+            for source_path in ["."] + LOCAL_COMMON_PATHS:
+                for ext in [".cpp", ".cc", ".cxx", ".c"]:
+                    queue.append(os.path.join(source_path, new_include.rsplit(".", 1)[0] + ext))
+    return closure
+
+
+def test_closures(main_source_file, test_sources, dep_src):
+    """Find the local files that each test depends on. Returns a dict from test source to closure, and the "orphan"
+    sources in dep_src that no main or test source reaches through a header. Since it is not known which tests
+    use the orphans, they are linked with all tests, and all tests depend on them."""
+    graph = load_cache("sources")
+    unchanged_graph = dict(graph)
+    closures = dict((test_src, source_closure(test_src, graph)) for test_src in test_sources)
+    reached = set(chain(*closures.values()))
+    if main_source_file:
+        reached |= source_closure(main_source_file, graph)
+    orphans = [src_file for src_file in dep_src if os.path.normpath(src_file) not in reached]
+    orphan_closure = set()
+    for orphan in orphans:
+        orphan_closure |= source_closure(orphan, graph)
+    for test_src in closures:
+        closures[test_src] |= orphan_closure
+    save_source_graph(graph, unchanged_graph)
+    return closures, orphans
+
+
+def test_arguments():
+    """Return the build arguments that change the tests, as a string. Tests that passed with other arguments are run again."""
+    skip = ("changed", "shard", "test_jobs", "test_timeout", "junit", "test_json", "jobs", "nodaemon", "profile")
+    return " ".join(sorted(key + "=" + value for key, value in ARGUMENTS.items() if key not in skip))
+
+
+def git_changed_files(ref):
+    """Return the absolute paths of the files that have changed since the given git ref, including files that are
+    not committed or not tracked yet, or None if this is not a git repository or the ref is unknown"""
+    status, root = getstatusoutput("git rev-parse --show-toplevel 2>/dev/null")
+    if status != 0 or not root.strip():
+        return None
+    status, changed = getstatusoutput("git diff --name-only " + shlex.quote(ref) + " -- 2>/dev/null")
+    if status != 0:
+        return None
+    untracked = getstatusoutput("git ls-files --others --exclude-standard --full-name 2>/dev/null")[1]
+    return set(os.path.normpath(os.path.join(root.strip(), line.strip()))
+               for line in (changed + "\n" + untracked).split("\n") if line.strip())
+
+
+def changed_tests(test_elves, closures, changed):
+    """Return the tests that are affected by changes. changed=1 selects the tests where any file that the test depends
+    on has changed since the test last passed, or that have not passed yet. changed=REF selects the tests that
+    depend on files that have changed since the given git ref, like changed=HEAD or changed=origin/main."""
+    if changed in ("1", "yes", "true"):
+        state = load_cache("tests").get(os.getcwd(), {})
+        if state.get("arguments") != test_arguments():
+            return test_elves
+        passed = state.get("passed", {})
+        return [test_elf for test_elf in test_elves
+                if passed.get(test_elf) != dict((fn, fingerprint(fn)) for fn in closures.get(test_elf, []))]
+    changed_files = git_changed_files(changed)
+    if changed_files is None:
+        print("WARNING: could not find the files that changed since " + changed + ", running all tests")
+        return test_elves
+    return [test_elf for test_elf in test_elves
+            if changed_files & set(os.path.abspath(fn) for fn in closures.get(test_elf, []))]
+
+
+def record_test_results(results, fingerprints):
+    """Remember which files each passed test depended on, and how they looked, for changed=1"""
+    with cache_lock:
+        cache = load_cache("tests")
+        state = cache.get(os.getcwd(), {})
+        if state.get("arguments") != test_arguments():
+            state = {"arguments": test_arguments(), "passed": {}}
+        for result in results:
+            if result["status"] == "passed" and result["name"] in fingerprints:
+                state["passed"][result["name"]] = fingerprints[result["name"]]
+            else:
+                state["passed"].pop(result["name"], None)
+        cache[os.getcwd()] = state
+        # Forget the oldest projects, if there are many
+        for old_key in list(cache.keys())[:max(0, len(cache) - 1024)]:
+            del cache[old_key]
+        save_cache("tests", cache)
+
+
+def discover_all_buildflags(src_files, system_include_dirs, win64, compiler_includes, cxx=None):
+    """Discover the build flags for all the given source files.
+    The includes of all the sources are scanned first, and then the union of the includes is resolved,
+    so that includes that are shared by many source files are only looked up once.
+    The results are cached in the cache directory, per source file.
+    Returns a dict from source filename to the build flags returned by get_buildflags."""
+    src_files = [src_file for src_file in src_files if src_file]
+    if use_daemon():
+        # Let the daemon answer, if there is one. Fall back to discovering the flags here if not.
+        answer = ask_daemon({
+            "cwd": os.getcwd(),
+            "sources": src_files,
+            "system_include_dirs": system_include_dirs,
+            "win64": win64,
+            "compiler_includes": compiler_includes,
+            "cxx": cxx,
+            "arguments": dict(ARGUMENTS),
+            "environment": daemon_environment(),
+        })
+        if answer and "buildflags" in answer:
+            stdout.write(answer["output"])
+            if answer["exit"] is not None:
+                exit(answer["exit"])
+            return dict((src_file, tuple(buildflags)) for src_file, buildflags in answer["buildflags"].items())
+    all_buildflags = {}
+    keys = {}
+    if use_cache():
+        cache = None
+        for src_file in src_files:
+            key = buildflags_cache_key(src_file, system_include_dirs, win64, compiler_includes, cxx)
+            if key and key not in cached_buildflags:
+                if cache is None:
+                    cache = load_cache("buildflags")
+                if key in cache and len(cache[key]) == 6:
+                    cached_buildflags[key] = tuple(cache[key])
+            if key in cached_buildflags:
+                if 'run' not in ARGUMENTS:
+                    print("[{}] ".format(os.path.basename(os.getcwd())), end='\n')
+                all_buildflags[src_file] = cached_buildflags[key]
+            elif key:
+                keys[src_file] = key
+    src_files = [src_file for src_file in src_files if src_file not in all_buildflags]
+    if not src_files:
+        return all_buildflags
+
+    # Scan the includes of the sources. This is done in-process, without running cpp.
+    with profile_span("discover", "scan includes"):
+        scanned = [scan_source(src_file) for src_file in src_files]
+
+    # Resolve the union of the includes. OpenGL includes resolve differently when glu is mentioned in the source.
+    resolved = {}
+    for also_glu in (False, True):
+        includes = []
+        for result in scanned:
+            if result and result[2] == also_glu:
+                includes += [include for include in result[0] if include not in includes]
+        if includes:
+            with profile_span("discover", "resolve includes"):
+                resolved[also_glu] = resolve_includes(includes, also_glu, system_include_dirs, win64, compiler_includes, cxx)
+
+    # Then derive the build flags for each source file, in the given order
+    for src_file, result in zip(src_files, scanned):
+        if result is None:
+            all_buildflags[src_file] = ("", "", "", "", "", "")
+            continue
+        includes, _, also_glu = result
+        all_buildflags[src_file] = include_buildflags(includes, resolved.get(also_glu, ({}, {}, set())), win64)
+
+    if keys:
+        with cache_lock:
+            # Load the cache again, in case another build has written to it in the meantime
+            cache = load_cache("buildflags")
+            # Don't let the cache grow without bounds, forget the oldest entries
+            for old_key in list(cache.keys())[:max(0, len(cache) + len(keys) - 4096)]:
+                del cache[old_key]
+            for src_file, key in keys.items():
+                cache[key] = list(all_buildflags[src_file])
+                cached_buildflags[key] = all_buildflags[src_file]
+            save_cache("buildflags", cache)
+    return all_buildflags
+
+
+def add_flags(env, src_file, system_include_dirs, win64, compiler_includes, buildflags=None):
+    """Add build flags to the environment.
+    The build flags may be given if they have already been discovered with discover_all_buildflags."""
+    if buildflags is None:
+        buildflags = get_buildflags(src_file, system_include_dirs, win64, compiler_includes, str(env["CXX"]))
+    includes, defines, libs, libpaths, linkflags, other_cxxflags = buildflags
     if includes:
         if "CPPPATH" in env:
             newincs = [inc for inc in includes.split(" ") if inc.lower() not in str(env["CPPPATH"]).lower()]
@@ -1573,18 +2527,1686 @@ def add_flags(env, src_file, system_include_dirs, win64, compiler_includes):
         env.Append(CXXFLAGS=" " + other_cxxflags)
 
 
+def internal_names(fname):
+    """Find the names that a source file declares with internal linkage (static, const, constexpr or in an
+    anonymous namespace), and the macros it defines. When several source files are compiled as one unity file,
+    these are shared between the files and may clash. Returns a set of names and a list of macros."""
+    try:
+        with open(fname) as f:
+            source = strip_comments(f.read())
+    except (IOError, OSError, UnicodeDecodeError):
+        return set(), []
+    macros = []
+    lines = []
+    for line in source.split("\n"):
+        if line.strip().startswith("#"):
+            match = re.match(r"\s*#\s*define\s+(\w+)", line)
+            if match and match.group(1) not in macros:
+                macros.append(match.group(1))
+            continue
+        lines.append(line)
+    code = re.sub(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', '""', "\n".join(lines))
+
+    names = set()
+    scopes = []  # "namespace", "anonymous" or "block", for each open brace
+    statement = ""
+    for token in re.findall(r"[{};]|[^{};]+", code):
+        if token == "}":
+            if scopes:
+                scopes.pop()
+            statement = ""
+            continue
+        if token != "{" and token != ";":
+            statement += token
+            continue
+        declaration = " ".join(statement.split())
+        statement = ""
+        if "block" in scopes:
+            # Inside a function, class or initializer
+            if token == "{":
+                scopes.append("block")
+            continue
+        if token == "{" and re.match(r"^(inline )?namespace$", declaration):
+            scopes.append("anonymous")
+            continue
+        if token == "{" and re.match(r'^(inline )?namespace [\w:]+$|^extern ""$', declaration):
+            scopes.append("namespace")
+            continue
+        if token == "{":
+            scopes.append("block")
+        # Skip attributes and template parameters, then find the declared name
+        declaration = re.sub(r"^(\[\[.*?\]\] ?|template ?<.*?> ?)+", "", declaration)
+        if not ("anonymous" in scopes or re.match(r"(static|const|constexpr)\b", declaration)):
+            continue
+        match = re.match(r"^(?:class|struct|union|enum(?: class| struct)?) (\w+)|^using (\w+) ?=", declaration)
+        if match:
+            names.add(match.group(1) or match.group(2))
+            continue
+        if declaration.startswith("using ") or declaration.startswith("static_assert"):
+            continue
+        match = re.search(r"(\w+)\s*$", re.split(r"[=(\[]", declaration, 1)[0])
+        if match and match.group(1) not in ("operator", "const", "static", "constexpr", "inline", "auto"):
+            names.add(match.group(1))
+    return names, macros
+
+
+def unity_build():
+    """Check if the sources in common/ should be compiled as a few unity files. Enable with unity=1"""
+    try:
+        return bool(int(build_argument('unity', 0)))
+    except ValueError:
+        return False
+
+
+def unity_groups(dep_src, count):
+    """Divide the C++ sources in dep_src into at most count groups of similar size, so that sources that declare
+    the same internal names end up in different groups. Sources that did not compile as part of a unity file before,
+    and have not changed since, are left out. Returns the groups and a list of the detected conflicts."""
+    failed = load_cache("unity")
+    groups = [[] for _ in range(max(1, count))]
+    sizes = [0] * len(groups)
+    declared = [{} for _ in groups]  # internal names in each group, and which source file declares them
+    conflicts = []
+    for src_file in dep_src:
+        if os.path.splitext(src_file)[1].lower() not in (".cpp", ".cc", ".cxx"):
+            continue
+        if failed.get(os.path.abspath(src_file)) == fingerprint(src_file):
+            continue
+        names, _ = internal_names(src_file)
+        candidates = []
+        clashes = []
+        for i in range(len(groups)):
+            names_in_group = sorted(names & set(declared[i]))
+            if names_in_group:
+                clashes.append("{} and {} both declare {}".format(declared[i][names_in_group[0]], src_file, ", ".join(names_in_group)))
+            else:
+                candidates.append(i)
+        if not candidates:
+            conflicts += [clash + ", compiling " + src_file + " separately" for clash in clashes]
+            continue
+        conflicts += [clash + ", compiling them as part of different unity files" for clash in clashes]
+        i = min(candidates, key=lambda i: sizes[i])
+        groups[i].append(src_file)
+        sizes[i] += os.path.getsize(src_file)
+        for name in names:
+            declared[i][name] = src_file
+    # Keep the sources in each group in the original order, and only use groups of two or more
+    return [sorted(group, key=dep_src.index) for group in groups if len(group) > 1], conflicts
+
+
+def unity_contents(group):
+    """Return the contents of a unity file in UNITY_DIR that includes the given source files"""
+    lines = ["// Generated by cxx for unity=1. Do not edit."]
+    for src_file in group:
+        lines.append('#include "{}"'.format(os.path.relpath(src_file, UNITY_DIR).replace(os.sep, "/")))
+        # Macros defined in a source file are not visible to the other source files when compiled separately
+        lines += ["#undef " + macro for macro in internal_names(src_file)[1]]
+    return "\n".join(lines) + "\n"
+
+
+def unity_try_compile(env, target, source, extra_flags=""):
+    """Compile a unity file without showing the output of the compiler. Returns the exit status and the output."""
+    cmd = env.subst("$CXXCOM", target=target, source=source) + extra_flags
+    environment = dict((name, str(value)) for name, value in env["ENV"].items())
+    process = Popen(cmd, shell=True, env=environment, stdout=PIPE, stderr=PIPE)
+    output = process.communicate()
+    return process.returncode, (output[0] + output[1]).decode("utf-8", "replace")
+
+
+def unity_clashes(env, unity_file, members):
+    """Find the source files that do not compile together with the other source files of a unity file.
+    Longer and longer runs of the members are compiled with -fsyntax-only, bisecting to the first member that makes
+    the run fail. That member is set aside, and this is repeated until the rest compiles together."""
+    scratch = os.path.splitext(unity_file)[0] + "_bisect.cpp"
+    scratch_node = [env.File(scratch)]
+    scratch_target = [env.File(os.path.splitext(scratch)[0] + env.subst("$OBJSUFFIX"))]
+
+    def compiles(group):
+        with open(scratch, "w") as f:
+            f.write(unity_contents(group))
+        return unity_try_compile(env, scratch_target, scratch_node, " -fsyntax-only")[0] == 0
+
+    together = list(members)
+    clashes = []
+    try:
+        while len(together) > 1 and not compiles(together):
+            # The first member compiles on its own, and all of them together do not
+            good, bad = 1, len(together)
+            while bad - good > 1:
+                middle = (good + bad) // 2
+                if compiles(together[:middle]):
+                    good = middle
+                else:
+                    bad = middle
+            clashes.append(together.pop(bad - 1))
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+    return clashes
+
+
+def unity_compile(target, source, env):
+    """Compile a unity file. If it does not compile, compile the included source files one by one instead,
+    combine the objects into the target with a relocatable link, and remember to compile the source files that
+    clash with the others separately next time."""
+    # The command has already been shown by unity_compile_string
+    status, output = unity_try_compile(env, target, source[:1])
+    if status == 0:
+        if output.strip():
+            # Warnings
+            stdout.write(output)
+        return 0
+    members = source[1:]
+    errors = [line for line in output.split("\n") if "error" in line]
+    print("[unity] {} did not compile ({}), compiling {} separately".format(
+        source[0], (errors or output.strip().split("\n") or [""])[0].strip(), ", ".join(str(member) for member in members)))
+    objects = []
+    for member in members:
+        obj = os.path.join(UNITY_DIR, "separate", re.sub(r"[^\w.]", "_", os.path.splitext(str(member))[0]) + env.subst("$OBJSUFFIX"))
+        if not os.path.isdir(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj))
+        objects.append(env.File(obj))
+        status = Action("$CXXCOM")(objects[-1:], [member], env)
+        if status:
+            return status
+    # Only the source files that clash with the others are left out of the unity files next time
+    clashes = unity_clashes(env, str(source[0]), [str(member) for member in members])
+    if clashes:
+        print("[unity] {} will be compiled separately until changed".format(", ".join(clashes)))
+    with cache_lock:
+        failed = load_cache("unity")
+        for member in clashes:
+            failed[os.path.abspath(member)] = fingerprint(member)
+        save_cache("unity", failed)
+    return Action("$CXX -nostdlib -r -o $TARGET $SOURCES")(target, objects, env)
+
+
+def unity_compile_string(target, source, env):
+    return env.subst("$CXXCOM", target=target, source=source[:1])
+
+
+def unity_objects(env, dep_src):
+    """With unity=1, compile the C++ sources in dep_src as a few generated unity files in .cxx-unity/,
+    that each include several of the sources. The number of unity files can be set with unity_groups=N.
+    Returns the objects and sources that should be built instead of dep_src."""
+    try:
+        count = int(build_argument('unity_groups', 0))
+    except ValueError:
+        count = 0
+    if count < 1:
+        # One unity file per job, but with at least four source files in each
+        count = max(1, min(GetOption('num_jobs'), len(dep_src) // 4))
+    groups, conflicts = unity_groups(dep_src, count)
+    if 'run' not in ARGUMENTS:
+        for conflict in conflicts:
+            print("[unity] " + conflict)
+
+    if not os.path.isdir(UNITY_DIR):
+        os.makedirs(UNITY_DIR)
+    unity_files = []
+    objects = []
+    grouped = set()
+    for i, group in enumerate(groups):
+        unity_file = os.path.join(UNITY_DIR, "unity_{}.cpp".format(i + 1))
+        unity_files.append(unity_file)
+        contents = unity_contents(group)
+        # Only write the unity file if it changed, so that it is not needlessly rebuilt
+        try:
+            with open(unity_file) as f:
+                unchanged = f.read() == contents
+        except (IOError, OSError):
+            unchanged = False
+        if not unchanged:
+            with open(unity_file, "w") as f:
+                f.write(contents)
+        action = Action(unity_compile, unity_compile_string, varlist=["CXX", "CXXCOM", "CXXFLAGS", "CCFLAGS", "_CCCOMCOM"])
+        objects += env.Command(os.path.splitext(unity_file)[0] + env.subst("$OBJSUFFIX"), [unity_file] + group, action)
+        grouped.update(group)
+    # Remove unity files that are left from builds with more groups
+    for fn in iglob(os.path.join(UNITY_DIR, "unity_*.cpp")):
+        if fn not in unity_files:
+            os.remove(fn)
+    return objects + [src_file for src_file in dep_src if src_file not in grouped]
+
+
+def library_name():
+    """Return the name of the library that is built with lib=static or lib=shared, like "foo" for libfoo.a.
+    The name can be given with libname=..., or else it is the name of the project directory."""
+    name = build_argument('libname', '')
+    if not name:
+        directory = os.path.normpath(os.getcwd())
+        if os.path.basename(directory) == "src":
+            directory = os.path.dirname(directory)
+        name = os.path.basename(directory)
+        if name.startswith("lib") and len(name) > 3:
+            name = name[3:]
+    return re.sub(r"[^A-Za-z0-9_.+-]", "_", name)
+
+
+def library_kind():
+    """Return "static" or "shared" if a library should be built with lib=..., or an empty string"""
+    kind = build_argument('lib', '')
+    if kind in ("", "0", "no", "false"):
+        return ""
+    if kind in ("1", "a", "static"):
+        return "static"
+    if kind in ("so", "dylib", "dll", "shared"):
+        return "shared"
+    print("WARNING: unknown library type: " + kind + " (use lib=static or lib=shared)")
+    return ""
+
+
+def build_library(env, kind, dep_objects):
+    """Build the dependencies of the main executable and the tests, typically the sources in common/,
+    as a static or shared library that the main executable and the tests are linked with.
+    A pkg-config file is written for the library. Returns the library node, as a list."""
+    name = library_name()
+    objects = [env.Object(obj)[0] if isinstance(obj, str) else obj for obj in dep_objects]
+    # Objects with link-time optimization must be archived with the archiver of the compiler
+    if "-flto" in str(env["CXXFLAGS"]):
+        if is_clang(str(env["CXX"])):
+            archiver, indexer = "llvm-ar", "llvm-ranlib"
+        else:
+            archiver, indexer = "gcc-ar", "gcc-ranlib"
+        if which(archiver) and which(indexer):
+            env.Replace(AR=archiver, RANLIB=indexer)
+    if kind == "shared":
+        # The objects are compiled with -fPIC, so they can be used for both kinds of libraries
+        env['STATIC_AND_SHARED_OBJECTS_ARE_THE_SAME'] = 1
+        library = env.SharedLibrary(name, objects)
+        if platform.system() == "Darwin":
+            env.Append(LINKFLAGS=" -Wl,-rpath,@executable_path -Wl,-rpath,@executable_path/../lib")
+        else:
+            # Let the executables find the library in the same directory, or in ../lib when installed
+            env.Append(LINKFLAGS=" -Wl,-rpath,'$$ORIGIN:$$ORIGIN/../lib'")
+    else:
+        library = env.StaticLibrary(name, objects)
+    env.NoCache(library)
+    write_pc_file(name, env)
+    return library
+
+
+def export_macro(name):
+    """Return the macro that marks the functions and classes that are exported from a shared library
+    built with visibility=hidden, like FOO_EXPORT for libfoo.so"""
+    return re.sub(r"[^A-Z0-9_]", "_", name.upper()) + "_EXPORT"
+
+
+def write_pc_file(name, env):
+    """Write a pkg-config file for the library, for projects that use the installed library.
+    The file is only written if it has changed."""
+    libs = ["-l" + str(lib) for lib in env.get("LIBS", [])]
+    libs += [flag for flag in str(env["LINKFLAGS"]).split() if flag.startswith("-l") and flag not in libs]
+    lines = [
+        "prefix=" + build_argument('PREFIX', '/usr/local'),
+        "exec_prefix=${prefix}",
+        "libdir=${exec_prefix}/lib",
+        "includedir=${prefix}/include",
+        "",
+        "Name: " + name,
+        "Description: The " + name + " library",
+        "Version: " + build_argument('version', '1.0.0'),
+        "Cflags: -I${includedir}/" + name,
+        "Libs: -L${libdir} -l" + name,
+    ]
+    if libs:
+        lines.append("Libs.private: " + " ".join(libs))
+    contents = "\n".join(lines) + "\n"
+    try:
+        with open(name + ".pc") as f:
+            if f.read() == contents:
+                return
+    except (IOError, OSError):
+        pass
+    with open(name + ".pc", "w") as f:
+        f.write(contents)
+
+
+def static_linkflags(cxx, libs):
+    """Return the flags for linking a static executable with static=1, if the compiler can link static executables
+    and there are static versions of the given libraries. Otherwise, only libstdc++ and libgcc are linked statically,
+    and the libraries without a static version are listed."""
+    missing = []
+    # Which static libraries exist depends on the installed packages, not only on the compiler
+    packages = " packages=" + packages_fingerprint()
+    for lib in libs:
+        archive = "lib" + lib + ".a"
+        try:
+            found = probe(cxx, "-print-file-name=" + archive + packages, cxx + " -print-file-name=" + archive).strip()
+        except OSError:
+            found = archive
+        # The compiler prints the given name if it can not find the file
+        if not os.path.isabs(found) or not os.path.exists(found):
+            missing.append(lib)
+    if not missing and links(cxx, "-static", packages=True):
+        return "-static"
+    if missing:
+        print("WARNING: no static libraries for: " + ", ".join(missing) + ", linking them dynamically")
+    else:
+        print("WARNING: " + cxx + " can not link static executables, linking libc dynamically")
+    if is_clang(cxx):
+        return "-static-libstdc++"
+    return "-static-libstdc++ -static-libgcc"
+
+
+def is_clang(cxx):
+    """Check if the given compiler is clang, also when it is installed as c++ or g++"""
+    try:
+        return "clang" in probe(cxx, "--version", cxx + " --version 2>&1")
+    except OSError:
+        return False
+
+
+def prelude_includes(fname):
+    """Return the system headers that the given source file includes before anything else,
+    like the <iostream> and <string> in a file that starts with #include <iostream> and #include <string>.
+    Including these first in a precompiled header does not change the meaning of the source file."""
+    try:
+        with open(fname) as f:
+            source = strip_comments(f.read())
+    except (IOError, OSError, UnicodeDecodeError):
+        return []
+    headers = []
+    for line in source.split("\n"):
+        line = line.strip()
+        if not line or re.match(r"#\s*pragma\s+once$", line):
+            continue
+        match = re.match(r"#\s*include\s*<([^>]+)>", line)
+        if not match:
+            break
+        header = match.group(1)
+        # Skip local headers that are included with <>
+        if not any(os.path.exists(os.path.join(path, header)) for path in LOCAL_INCLUDE_PATHS):
+            headers.append(header)
+    return headers
+
+
+def precompiled_headers():
+    """Check if commonly included system headers should be precompiled. Enable with pch=1"""
+    try:
+        return bool(int(build_argument('pch', 0)))
+    except ValueError:
+        return False
+
+
+def precompiled_header(env, src_files):
+    """Find the longest list of system headers that at least half of the C++ sources start by including, and set up
+    .cxx-pch/pch.h to be precompiled with the same flags as the sources. It is only included first in the sources
+    that start with these headers, so that the meaning of the other sources does not change.
+    Returns the node of the precompiled header and the sources that use it, or None and an empty list."""
+    src_files = [src_file for src_file in src_files if src_file and os.path.splitext(src_file)[1].lower() in (".cpp", ".cc", ".cxx")]
+    preludes = dict((src_file, tuple(prelude_includes(src_file))) for src_file in src_files)
+    counts = {}
+    for prelude in preludes.values():
+        for i in range(1, len(prelude) + 1):
+            counts[prelude[:i]] = counts.get(prelude[:i], 0) + 1
+    candidates = [prefix for prefix, count in counts.items() if count * 2 >= len(src_files)]
+    if not candidates:
+        return None, []
+    headers = list(max(candidates, key=lambda prefix: (len(prefix), counts[prefix])))
+    users = [src_file for src_file in src_files if list(preludes[src_file][:len(headers)]) == headers]
+
+    # The precompiled header is rebuilt when the flags change, since they are part of the command.
+    # It must also be rebuilt when the headers change, so add their fingerprints to pch.h.
+    cxx = env.subst("$CXX")
+    include_dirs = [flag[2:] for flag in env.subst("$CXXFLAGS $_CPPINCFLAGS").split() if flag.startswith("-I")]
+    include_dirs += compiler_include_dirs(cxx, "c++")
+    fingerprints = hashlib.sha1()
+    for header in headers:
+        for include_dir in include_dirs:
+            if os.path.exists(os.path.join(include_dir, header)):
+                fingerprints.update((header + fingerprint(os.path.join(include_dir, header))).encode("utf-8"))
+                break
+    for database in PACKAGE_DATABASES:
+        fingerprints.update(fingerprint(database).encode("utf-8"))
+    contents = "// Generated by cxx for pch=1. Do not edit.\n// Fingerprint of the headers: " + fingerprints.hexdigest() + "\n"
+    contents += "".join("#include <" + header + ">\n" for header in headers)
+
+    header_file = os.path.join(PCH_DIR, "pch.h")
+    if not os.path.isdir(PCH_DIR):
+        os.makedirs(PCH_DIR)
+    try:
+        with open(header_file) as f:
+            unchanged = f.read() == contents
+    except (IOError, OSError):
+        unchanged = False
+    if not unchanged:
+        with open(header_file, "w") as f:
+            f.write(contents)
+
+    # With -include, both GCC and clang look for a precompiled header next to the header, named .gch or .pch
+    clang = is_clang(cxx)
+    pch = env.Command(header_file + (".pch" if clang else ".gch"), header_file,
+                      "$CXX -x c++-header -o $TARGET -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCES")
+    flags = "-include " + header_file + ("" if clang else " -Winvalid-pch")
+    using = set(os.path.abspath(src_file) for src_file in users)
+
+    def pch_flags(target, source, env, for_signature):
+        # Only for the sources that start with the precompiled headers
+        if source and os.path.abspath(str(source[0])) in using:
+            return flags
+        return ""
+
+    env["PCHFLAGS"] = pch_flags
+    if "$PCHFLAGS" not in env["CXXCOM"]:
+        env["CXXCOM"] = env["CXXCOM"].replace("$CXXFLAGS", "$PCHFLAGS $CXXFLAGS", 1)
+    return pch, users
+
+
+def module_sources():
+    """Find the C++20 module interface units (like math.cppm or math.ixx) in the current and local common directories"""
+    found = []
+    for directory in ["."] + LOCAL_COMMON_PATHS:
+        if os.path.isdir(directory):
+            for ext in MODULE_EXTENSIONS:
+                found += sorted(os.path.normpath(fn) for fn in iglob(os.path.join(directory, "*" + ext)))
+    return found
+
+
+def scan_module_declarations(fname):
+    """Find the module that the given source file declares, the modules it imports and the headers that it imports
+    as header units (like "<vector>"), by looking for module and import declarations.
+    Returns a tuple (provides, requires, header units), or None if the file can not be read."""
+    try:
+        with open(fname) as f:
+            source = strip_comments(f.read())
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+    provides = ""
+    module = ""
+    requires = []
+    header_units = []
+    for export, keyword, name in re.findall(r'^\s*(export\s+)?(module|import)\s+([\w.:]+|<[^>]+>|"[^"]+")\s*(?:\[\[.*?\]\]\s*)?;',
+                                            source, re.MULTILINE):
+        if keyword == "module":
+            module = name.split(":")[0]
+            if export or ":" in name:
+                # An interface unit, or a module partition
+                provides = name
+            else:
+                # A module implementation unit, that implicitly imports the module interface
+                requires.append(name)
+        elif name[0] in "<\"":
+            header_units.append(name)
+        elif name.startswith(":"):
+            # A partition of the current module
+            requires.append(module + name)
+        else:
+            requires.append(name)
+    return provides, requires, header_units
+
+
+def p1689_module_declarations(fname, cxx, flags, clang):
+    """Ask the compiler which modules the given source file provides and requires, in the P1689 format,
+    with GCC 14 or later, or with clang-scan-deps. Returns (provides, requires), or None if this is not supported."""
+    if clang:
+        scanner = which("clang-scan-deps")
+        if not scanner:
+            return None
+        output = popen2(scanner + " -format=p1689 -- " + cxx + " " + flags + " -x c++ -c " + fname + " -o " + fname + ".o 2>/dev/null")[1].read()
+    else:
+        test = " -std=c++20 -fmodules-ts -x c++ -E -fdeps-format=p1689r5 -fdeps-file=/dev/null -fdeps-target=x.o -MD -MF /dev/null -o /dev/null"
+        if probe(cxx, "-fdeps-format=p1689r5", "echo | " + cxx + test + " - >/dev/null 2>&1 && echo YES || echo NO").strip() != "YES":
+            return None
+        depsfile = os.path.join(cache_dir(), "p1689." + str(os.getpid()) + "." + str(threading.current_thread().ident) + ".json")
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        popen2(cxx + " " + flags + " -fmodules-ts -x c++ -E -fdeps-format=p1689r5 -fdeps-file=" + depsfile +
+               " -fdeps-target=" + fname + ".o -MD -MF /dev/null -o /dev/null " + fname + " 2>/dev/null")[1].read()
+        try:
+            with open(depsfile) as f:
+                output = f.read()
+            os.remove(depsfile)
+        except (IOError, OSError):
+            return None
+    try:
+        rule = json.loads(output)["rules"][0]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+    provides = [entry["logical-name"] for entry in rule.get("provides", [])]
+    # Header units are looked up by how they are spelled in the source, so only keep the named modules here
+    requires = [entry["logical-name"] for entry in rule.get("requires", []) if "lookup-method" not in entry]
+    return (provides[0] if provides else ""), requires
+
+
+def mentions_modules(fname):
+    """Check if the given source file has a line that starts like a module or import declaration.
+    This is a quick check for skipping the module scan, comments and preprocessor conditions are not considered."""
+    try:
+        with open(fname) as f:
+            return re.search(r"^\s*(export\s+)?(module|import)\b", f.read(), re.MULTILINE) is not None
+    except (IOError, OSError, UnicodeDecodeError):
+        return False
+
+
+def module_declarations(fnames, cxx, flags, clang):
+    """Return a dict from each of the given source files to the modules it provides and requires, and the headers
+    that it imports as header units. The compiler is asked first, since it evaluates the preprocessor conditions.
+    If it can't answer, the module and import declarations are found by scan_module_declarations.
+    Files that can not be read are left out. The results are stored in the cache directory, which is loaded
+    and saved at most once per call, and files are only scanned again when changed."""
+    declarations = {}
+    new_entries = {}
+    cache = None
+    for fname in fnames:
+        key = os.path.abspath(fname) + "\n" + fingerprint(fname) + "\n" + compiler_identity(cxx) + "\n" + flags
+        if key not in cached_modules:
+            if cache is None:
+                cache = load_cache("modules")
+            if key in cache:
+                cached_modules[key] = tuple(cache[key])
+        if key in cached_modules:
+            declarations[fname] = cached_modules[key]
+            continue
+        scanned = scan_module_declarations(fname)
+        if scanned is None:
+            continue
+        answer = p1689_module_declarations(fname, cxx, flags, clang)
+        if answer is not None:
+            scanned = (answer[0], answer[1], scanned[2])
+        cached_modules[key] = scanned
+        new_entries[key] = list(scanned)
+        declarations[fname] = scanned
+    if new_entries:
+        with cache_lock:
+            # Load the cache again, in case another build has written to it in the meantime
+            cache = load_cache("modules")
+            # Don't let the cache grow without bounds, forget the oldest entries
+            for old_key in list(cache.keys())[:max(0, len(cache) + len(new_entries) - 4096)]:
+                del cache[old_key]
+            cache.update(new_entries)
+            save_cache("modules", cache)
+    return declarations
+
+
+def header_unit_path(header, importer, include_dirs):
+    """Find the header that is imported as a header unit, like "<vector>" or "\"config.h\"", from the given source file.
+    Returns the path to the header, or an empty string if it can not be found."""
+    name = header[1:-1]
+    search = include_dirs
+    if header.startswith('"'):
+        search = [os.path.dirname(importer) or "."] + include_dirs
+    for include_dir in search:
+        path = os.path.join(include_dir, name)
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+    return ""
+
+
+def module_units(env, sources, module_src, clang):
+    """Set up the builds of the C++20 module interface units and header units that the given sources use.
+    The module interface units are built before the sources that import them, and the compiled module interfaces
+    (BMIs) are kept in gcm.cache/ for GCC and in .cxx-modules/ for clang. Since they are build targets,
+    they are stored in and retrieved from the object cache, like the objects.
+    Returns the objects of the module interface units, the source files of the module interface units
+    and a dict from the absolute path of each source file to the BMIs it needs."""
+    src_files = [src_file for src_file in sources if src_file] + [src_file for src_file in module_src if src_file not in sources]
+    # Without module interface units, there is nothing to scan unless a source declares or imports a module
+    if not module_src and not any(mentions_modules(src_file) for src_file in src_files):
+        return [], [], {}
+
+    cxx = env.subst("$CXX")
+    flags = env.subst("$CXXFLAGS $CCFLAGS $_CCCOMCOM")
+    include_dirs = [flag[2:] for flag in flags.split() if flag.startswith("-I")] + compiler_include_dirs(cxx, "c++")
+
+    declarations = module_declarations(src_files, cxx, flags, clang)
+    if not any(provides or requires or header_units for provides, requires, header_units in declarations.values()):
+        return [], [], {}
+
+    if clang:
+        env["MODULEFLAGS"] = "-fprebuilt-module-path=" + MODULES_DIR
+    else:
+        env["MODULEFLAGS"] = "-fmodules-ts"
+    if "$MODULEFLAGS" not in env["CXXCOM"]:
+        env["CXXCOM"] = env["CXXCOM"].replace("$CXXFLAGS", "$MODULEFLAGS $CXXFLAGS", 1)
+
+    # Header units, built once for all sources that import them
+    bmis = {}
+    header_unit_flags = []
+    for src_file, (_, _, header_units) in declarations.items():
+        for header in header_units:
+            path = header_unit_path(header, src_file, include_dirs)
+            if not path or header in bmis:
+                continue
+            if clang:
+                bmi = os.path.join(MODULES_DIR, re.sub(r"[^\w.]", "_", header[1:-1]) + ".pcm")
+                kind = "system" if header.startswith("<") else "user"
+                bmis[header] = env.Command(bmi, path, "$CXX $CXXFLAGS $CCFLAGS $_CCCOMCOM -fmodule-header=" + kind +
+                                           " -xc++-header --precompile " + header[1:-1] + " -o $TARGET")
+                header_unit_flags.append("-fmodule-file=" + bmi)
+            elif header.startswith("<") and os.path.isabs(path):
+                # GCC names the BMI of a system header after where it was found
+                bmi = os.path.join("gcm.cache", path.lstrip("/") + ".gcm")
+                bmis[header] = env.Command(bmi, path, "$CXX -fmodules-ts $CXXFLAGS $CCFLAGS $_CCCOMCOM -x c++-system-header " + header[1:-1])
+            else:
+                # GCC names the BMI of a user header after its relative path, with ".." written as ",,"
+                relative = "/".join(",," if part == ".." else part for part in os.path.relpath(path).split(os.sep))
+                bmi = os.path.join("gcm.cache", ",", relative + ".gcm")
+                bmis[header] = env.Command(bmi, path, "$CXX -fmodules-ts $CXXFLAGS $CCFLAGS $_CCCOMCOM -x c++-header " + os.path.relpath(path))
+    if header_unit_flags:
+        env.Append(MODULEFLAGS=" " + " ".join(header_unit_flags))
+
+    # Named modules and module partitions
+    objects = []
+    builds = {}
+    for src_file, (provides, _, _) in declarations.items():
+        if not provides:
+            continue
+        if provides in bmis:
+            print("error: the module " + provides + " is declared by more than one source file, including " + src_file)
+            exit(1)
+        obj = os.path.splitext(src_file)[0] + env.subst("$OBJSUFFIX")
+        if clang:
+            bmi = os.path.join(MODULES_DIR, provides.replace(":", "-") + ".pcm")
+            bmis[provides] = env.Command(bmi, src_file, "$CXX $MODULEFLAGS $CXXFLAGS $CCFLAGS $_CCCOMCOM -x c++-module --precompile $SOURCES -o $TARGET")
+            builds[src_file] = bmis[provides] + env.Command(obj, bmi, "$CXX -o $TARGET -c $CXXFLAGS $CCFLAGS $SOURCES")
+        else:
+            bmi = os.path.join("gcm.cache", provides.replace(":", "-") + ".gcm")
+            nodes = env.Command([obj, bmi], src_file, "$CXX -o $TARGET -c $MODULEFLAGS $CXXFLAGS $CCFLAGS $_CCCOMCOM -x c++ $SOURCES")
+            bmis[provides] = nodes[1:]
+            builds[src_file] = nodes
+        objects.append(builds[src_file][-1] if clang else builds[src_file][0])
+
+    # Build the BMIs before the sources and module units that import them
+    needs = {}
+    for src_file, (provides, requires, header_units) in declarations.items():
+        needs[os.path.abspath(src_file)] = [bmis[name] for name in requires + header_units if name in bmis and name != provides]
+        if src_file in builds:
+            for bmi in needs[os.path.abspath(src_file)]:
+                env.Depends(builds[src_file], bmi)
+    return objects, sorted(builds), needs
+
+
+def object_cache_dir():
+    """Return the directory of the cache of compiled objects, or an empty string if it is not used.
+    Looking up an object costs a run of the preprocessor, so the cache is only used with objcache=1,
+    or with cachedir=..., for instance a directory on NFS that is shared between machines. nocache=1 turns it off."""
+    if not use_cache():
+        return ""
+    if build_argument("cachedir", ""):
+        return build_argument("cachedir", "")
+    if int(build_argument("objcache", 0)):
+        return os.path.join(cache_dir(), "objects")
+    return ""
+
+
+def compiler_digest(cxx):
+    """Identify the given compiler by its version and a hash of its binary. Unlike compiler_identity, this does not
+    depend on when and where the compiler was installed, so that compiled objects can be shared between machines."""
+    path = which(cxx.split(" ")[0]) if cxx else ""
+    if not path:
+        return cxx
+    # The hash is stored by probe, for as long as the compiler binary is unchanged
+    digest = probe(cxx, "sha1", shlex.quote(sys.executable) + " -c 'import hashlib, sys; " +
+                   "print(hashlib.sha1(open(sys.argv[1], \"rb\").read()).hexdigest())' " + shlex.quote(os.path.realpath(path)))
+    return probe(cxx, "--version", cxx + " --version 2>&1") + digest.strip()
+
+
+def object_cache_key(node):
+    """Return a key for the compiled object, made from the preprocessed source, the full compile command
+    and the compiler identity, like ccache does. Returns an empty string if the node is not a compiled object."""
+    sources = [str(source) for source in node.sources]
+    if len(sources) != 1 or os.path.splitext(sources[0])[1].lower() not in (".cpp", ".cc", ".cxx", ".c"):
+        return ""
+    env = node.get_build_env()
+    if not str(node).endswith(env.subst("$OBJSUFFIX")):
+        return ""
+    # Objects that import C++20 modules are cached by their SCons build signature, which includes the module interfaces
+    if [dependency for dependency in node.depends if os.path.splitext(str(dependency))[1] in (".gcm", ".pcm")]:
+        return ""
+    if sources[0].lower().endswith(".c"):
+        compiler, command, preprocess = "$CC", "$CCCOM", "$CC -E -P $CFLAGS $CCFLAGS $_CCCOMCOM $SOURCES"
+    else:
+        compiler, command, preprocess = "$CXX", "$CXXCOM", "$CXX -E -P $PCHFLAGS $MODULEFLAGS $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCES"
+    command = env.subst(command, target=[node], source=node.sources)
+    try:
+        preprocessed = check_output(env.subst(preprocess, target=[node], source=node.sources), shell=True)
+    except Exception:
+        return ""
+    key = hashlib.sha1()
+    key.update(compiler_digest(env.subst(compiler)).encode("utf-8"))
+    key.update(command.encode("utf-8"))
+    # Objects that are optimized with recorded profiles change when the profiles change
+    key.update(profile_fingerprint(command).encode("utf-8"))
+    if "-g" in command.split() or "-ggdb" in command.split():
+        # Debug information contains the current directory
+        key.update(os.getcwd().encode("utf-8"))
+    key.update(preprocessed)
+    return key.hexdigest()
+
+
+def compiler_output_spawn(spawn):
+    """Wrap the SPAWN function of a SCons environment, so that the warnings of each compilation are kept in
+    compiler_output, by object, for storing them with the object in the object cache"""
+    def wrapper(sh, escape, cmd, args, env):
+        if "-c" not in args or "-o" not in args[:-1]:
+            return spawn(sh, escape, cmd, args, env)
+        # The arguments are already quoted by SCons
+        target = os.path.normpath(args[args.index("-o") + 1].strip("'\""))
+        process = Popen([sh, "-c", " ".join(args)], env=env, close_fds=True, stderr=PIPE)
+        output = process.communicate()[1].decode("utf-8", "replace")
+        sys.stderr.write(output)
+        compiler_output[target] = output
+        return process.returncode
+    return wrapper
+
+
+def object_cache_class():
+    """Return a SCons CacheDir class where objects are keyed by object_cache_key, and where each retrieval
+    updates the modification time of the cached file, so that the least recently used objects can be removed.
+    The warnings of the compilation are stored next to the object, in a .stderr file, and shown again when it is retrieved."""
+    import SCons.CacheDir
+
+    class ObjectCache(SCons.CacheDir.CacheDir):
+        def __init__(self, path):
+            SCons.CacheDir.CacheDir.__init__(self, path)
+            self.keys = {}
+            self.keys_lock = threading.Lock()
+
+        def cachepath(self, node):
+            if not self.is_enabled():
+                return None, None
+            with self.keys_lock:
+                key = self.keys.get(str(node))
+            if key is None:
+                key = object_cache_key(node)
+                with self.keys_lock:
+                    self.keys[str(node)] = key
+            if not key:
+                return SCons.CacheDir.CacheDir.cachepath(self, node)
+            cachedir = os.path.join(self.path, key[:self.config['prefix_len']].upper())
+            return cachedir, os.path.join(cachedir, key)
+
+        @classmethod
+        def copy_from_cache(cls, env, src, dst):
+            try:
+                os.utime(src, None)
+            except OSError:
+                pass
+            return super(ObjectCache, cls).copy_from_cache(env, src, dst)
+
+        def retrieve(self, node):
+            if not self.is_enabled():
+                return False
+            # Show the compile command, like when building, instead of "Retrieved `main.o' from cache"
+            if SCons.CacheDir.CacheRetrieveSilent(node, [], node.get_build_env(), execute=1) != 0:
+                return False
+            node.build(presub=0, execute=0)
+            try:
+                with open(self.cachepath(node)[1] + ".stderr") as f:
+                    sys.stderr.write(f.read())
+            except (IOError, OSError):
+                pass
+            return True
+
+        def push(self, node):
+            if self.is_readonly() or not self.is_enabled():
+                return None
+            output = compiler_output.get(os.path.normpath(str(node)), "")
+            cachedir, cachefile = self.cachepath(node)
+            if output and cachefile and not os.path.exists(cachefile):
+                # Store the warnings before the object, so that the object is never retrieved without them
+                try:
+                    if not os.path.isdir(cachedir):
+                        os.makedirs(cachedir)
+                    with open(cachefile + ".stderr." + str(os.getpid()), "w") as f:
+                        f.write(output)
+                    os.rename(cachefile + ".stderr." + str(os.getpid()), cachefile + ".stderr")
+                except (IOError, OSError):
+                    return None
+            return SCons.CacheDir.CacheDir.push(self, node)
+
+    return ObjectCache
+
+
+def prune_object_cache(path, max_bytes):
+    """Remove the least recently used files from the object cache, until it is smaller than max_bytes"""
+    files = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if dirpath == path or ".stderr" in filename:
+                # The configuration file of the cache, or warnings that are removed together with their object
+                continue
+            filename = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+    if total <= max_bytes:
+        return
+    # Remove files until there is some room, so that this does not have to be done for every build
+    for mtime, size, filename in sorted(files):
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(filename)
+            total -= size
+        except OSError:
+            pass
+        try:
+            os.remove(filename + ".stderr")
+        except OSError:
+            pass
+
+
+def finish_object_cache(env):
+    """Record the hit and miss statistics of the object cache, and keep it within cachesize=MiB (default 1024)"""
+    cache = env.get_CacheDir()
+    requests, hits = getattr(cache, "requests", 0), getattr(cache, "hits", 0)
+    if not requests:
+        return
+    with cache_lock:
+        stats = load_cache("objectcache")
+        stats["hits"] = stats.get("hits", 0) + hits
+        stats["misses"] = stats.get("misses", 0) + requests - hits
+        save_cache("objectcache", stats)
+    if requests > hits:
+        try:
+            max_mib = int(build_argument("cachesize", 1024))
+        except ValueError:
+            max_mib = 1024
+        prune_object_cache(object_cache_dir(), max_mib * 1024 * 1024)
+
+
+def profiled_spawn(spawn):
+    """Wrap the SPAWN function of a SCons environment, so that each compilation and link step is timed"""
+    def wrapper(sh, escape, cmd, args, env):
+        start = time.time()
+        try:
+            return spawn(sh, escape, cmd, args, env)
+        finally:
+            # The arguments are already quoted by SCons
+            target = args[args.index("-o") + 1].strip("'\"") if "-o" in args[:-1] else " ".join(args)
+            if "-c" in args:
+                profile_event("compile", target, start)
+            elif "-o" in args:
+                profile_event("link", target, start)
+            else:
+                profile_event("run", target, start)
+    return wrapper
+
+
+def profile_filename():
+    """Return the filename of the timing report, cxx-profile.json unless profile=filename.json is given"""
+    value = build_argument('profile', '0')
+    if value in ('1', 'yes', 'true'):
+        return "cxx-profile.json"
+    return value
+
+
+def write_profile():
+    """Write the recorded timings as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev),
+    and output the slowest steps and the time spent per category"""
+    end = time.time()
+    events = list(profile_events) + [("total", "cxx " + " ".join(COMMAND_LINE_TARGETS or ["build"]), profile_start, end, 0)]
+    trace = []
+    for category, name, start, stop, tid in events:
+        trace.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": tid,
+                      "ts": int((start - profile_start) * 1000000), "dur": int((stop - start) * 1000000)})
+    try:
+        with open(profile_filename(), "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+    except (IOError, OSError) as e:
+        print("WARNING: could not write " + profile_filename() + ": " + str(e))
+        return
+
+    try:
+        top = int(build_argument('profile_top', 15))
+    except ValueError:
+        top = 15
+    print("")
+    print("Slowest steps:")
+    for category, name, start, stop, _ in sorted(profile_events, key=lambda e: e[2] - e[3])[:top]:
+        if len(name) > 100:
+            name = name[:97] + "..."
+        print("{:9.3f}s  {:<9} {}".format(stop - start, category, name))
+    print("")
+    print("Time per category (steps that run in parallel or within other steps are counted in full):")
+    totals = {}
+    for category, _, start, stop, _ in profile_events:
+        totals[category] = totals.get(category, 0.0) + stop - start
+    for category, total in sorted(totals.items(), key=lambda item: -item[1]):
+        print("{:9.3f}s  {}".format(total, category))
+    print("{:9.3f}s  {}".format(end - profile_start, "wall clock, in total"))
+    print("")
+    print("Wrote " + profile_filename())
+
+
+def test_shard(test_elves, shard):
+    """Return the test executables that belong to the given shard, like "2/4" for the second of four shards.
+    The tests are divided by their sorted position, so that every CI node gets the same division."""
+    if not shard:
+        return test_elves
+    try:
+        index, count = [int(x) for x in shard.split("/")]
+    except ValueError:
+        print("WARNING: shard must be given as i/n, like shard=1/4")
+        return test_elves
+    if count < 1 or not 1 <= index <= count:
+        print("WARNING: shard " + shard + " is out of range, the first shard is 1/" + str(max(1, count)))
+        return test_elves
+    return [test_elf for i, test_elf in enumerate(sorted(test_elves)) if i % count == index - 1]
+
+
+def run_test(test_elf, timeout):
+    """Run one test executable, and stop it if it takes more than timeout seconds (0 for no timeout).
+    Returns a dict with the name, status ("passed", "failed" or "timeout"), exit code, seconds and output.
+    The test is started in its own process group, so that processes it starts are also stopped at the timeout."""
+    from subprocess import Popen, PIPE
+    start = time.time()
+    try:
+        process = Popen([os.path.join(".", test_elf)], stdout=PIPE, stderr=PIPE, start_new_session=(os.name == "posix"))
+    except OSError as e:
+        # Like the shell, report a test that can not be started with exit code 127
+        return {
+            "name": test_elf,
+            "status": "failed",
+            "returncode": 127,
+            "seconds": round(time.time() - start, 3),
+            "stdout": "",
+            "stderr": "{}: {}".format(test_elf, e.strerror or e),
+        }
+    timed_out = []
+    timer = None
+    if timeout > 0:
+        def stop():
+            timed_out.append(True)
+            try:
+                if os.name == "posix":
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    process.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, stop)
+        timer.start()
+    try:
+        out, err = process.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    status = "timeout" if timed_out else ("passed" if process.returncode == 0 else "failed")
+    return {
+        "name": test_elf,
+        "status": status,
+        "returncode": process.returncode,
+        "seconds": round(time.time() - start, 3),
+        "stdout": out.decode("utf-8", "replace"),
+        "stderr": err.decode("utf-8", "replace"),
+    }
+
+
+def run_tests(test_elves, jobs, timeout):
+    """Run the test executables, jobs at a time, and print the output and result of each test as it finishes.
+    All tests are run, also after a failure. Returns the results in the same order as test_elves."""
+    results = {}
+    remaining = list(test_elves)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                test_elf = remaining.pop(0)
+            result = run_test(test_elf, timeout)
+            with lock:
+                results[test_elf] = result
+                output = (result["stdout"] + result["stderr"]).strip()
+                if output:
+                    print(output)
+                if result["status"] == "timeout":
+                    print("TIMEOUT: {} (after {} seconds)".format(test_elf, timeout))
+                elif result["status"] == "failed":
+                    print("FAILED: {} (exit code {}, {:.2f}s)".format(test_elf, result["returncode"], result["seconds"]))
+                stdout.flush()
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(jobs, len(test_elves))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[test_elf] for test_elf in test_elves]
+
+
+def xml_text(s):
+    """Escape a string for use in XML, and remove the control characters that XML does not allow"""
+    s = re.sub(u"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", s)
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\"", "&quot;")
+
+
+def write_junit(filename, results, suite_name):
+    """Write the test results as JUnit XML, which most CI systems can show"""
+    failures = len([result for result in results if result["status"] == "failed"])
+    errors = len([result for result in results if result["status"] == "timeout"])
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<testsuite name="{}" tests="{}" failures="{}" errors="{}" time="{:.3f}">'.format(
+                 xml_text(suite_name), len(results), failures, errors, sum(result["seconds"] for result in results))]
+    for result in results:
+        lines.append('  <testcase classname="{}" name="{}" time="{:.3f}">'.format(
+            xml_text(suite_name), xml_text(result["name"]), result["seconds"]))
+        if result["status"] == "failed":
+            lines.append('    <failure message="exit code {}"/>'.format(result["returncode"]))
+        elif result["status"] == "timeout":
+            lines.append('    <error message="timed out"/>')
+        if result["stdout"]:
+            lines.append('    <system-out>' + xml_text(result["stdout"]) + '</system-out>')
+        if result["stderr"]:
+            lines.append('    <system-err>' + xml_text(result["stderr"]) + '</system-err>')
+        lines.append('  </testcase>')
+    lines.append('</testsuite>')
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_test_json(filename, results, seconds):
+    """Write the status and timing of each test as JSON"""
+    report = {
+        "seconds": round(seconds, 3),
+        "tests": [dict((key, result[key]) for key in ("name", "status", "returncode", "seconds")) for result in results],
+    }
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def pgo_mode():
+    """Return how profile guided optimization should be used, given with pgo=...:
+    "generate" for building instrumented executables, "use" for building with the recorded profile,
+    "off" for not using profiles, or "" for using the recorded profile if there is one for the current sources"""
+    value = build_argument('pgo', '')
+    if value in ('0', 'no', 'false'):
+        return "off"
+    return value
+
+
+def pgo_compiler():
+    """Return the compiler that will be used, as far as can be told from the build arguments alone"""
+    if ARGUMENTS.get('CXX', ''):
+        return ARGUMENTS['CXX']
+    if int(ARGUMENTS.get('clang', 0)):
+        return "clang++"
+    if int(ARGUMENTS.get('zap', 0)):
+        return "zapcc++"
+    return "g++"
+
+
+def pgo_directory(src_files):
+    """Return the directory where the profiles for the given sources are kept.
+    The directory is named after the contents of the sources and local headers, the compiler and the build arguments
+    that change the generated code, so that a profile is only used for the code it was recorded with."""
+    key = hashlib.sha1()
+    headers = []
+    for include_path in LOCAL_INCLUDE_PATHS:
+        for ext in (".h", ".hh", ".hpp", ".hxx", ".h++", ".inl"):
+            headers += sorted(iglob(os.path.join(include_path, "*" + ext)))
+    for filename in [src_file for src_file in src_files if src_file] + headers:
+        try:
+            with open(filename, "rb") as f:
+                key.update(filename.encode("utf-8") + b"\0" + f.read() + b"\0")
+        except (IOError, OSError):
+            pass
+    key.update(compiler_identity(pgo_compiler()).encode("utf-8"))
+    for name in ("clang", "zap", "win64", "std", "opt", "lto", "small", "tiny", "debug", "strict", "sloppy", "static", "lib",
+                 "visibility", "CXXFLAGS"):
+        # The Makefile gives 0 for the flags that are not set, but "scons" alone gives nothing
+        if str(ARGUMENTS.get(name, "")).strip() not in ("", "0"):
+            key.update((name + "=" + str(ARGUMENTS[name]).strip() + "\n").encode("utf-8"))
+    return os.path.join(cache_dir(), "pgo", key.hexdigest())
+
+
+def llvm_profdata(cxx):
+    """Find the llvm-profdata that belongs to the given clang compiler"""
+    match = re.search(r"clang version (\d+)", probe(cxx, "--version", cxx + " --version 2>&1"))
+    if match and which("llvm-profdata-" + match.group(1)):
+        return which("llvm-profdata-" + match.group(1))
+    if which("llvm-profdata"):
+        return which("llvm-profdata")
+    if platform.system() == "Darwin" and which("xcrun"):
+        return "xcrun llvm-profdata"
+    return ""
+
+
+def merge_profiles(cxx, profile_dir):
+    """Merge the raw profiles that clang has recorded in profile_dir into default.profdata.
+    Returns the path to the merged profile, or an empty string if there were no profiles or they could not be merged."""
+    profraws = sorted(iglob(os.path.join(profile_dir, "*.profraw")))
+    if not profraws:
+        return ""
+    profdata = os.path.join(profile_dir, "default.profdata")
+    tool = llvm_profdata(cxx)
+    if not tool:
+        print("WARNING: llvm-profdata is needed for merging the recorded profiles")
+        return ""
+    status, output = getstatusoutput(tool + " merge -output=" + profdata + " " + " ".join(profraws))
+    if status != 0:
+        print(output.strip())
+        return ""
+    for profraw in profraws:
+        os.remove(profraw)
+    return profdata
+
+
+def pgo_flags(env, profile_dir, mode):
+    """Add the flags for building instrumented executables (mode "generate") or for building with the profile
+    in profile_dir (mode "use"). Returns True if flags were added."""
+    cxx = str(env["CXX"])
+    clang = is_clang(cxx)
+    if mode == "generate":
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        env.Append(CXXFLAGS=' -fprofile-generate=' + profile_dir)
+        env.Append(LINKFLAGS=' -fprofile-generate=' + profile_dir)
+        if not clang:
+            # Let the executables record their profiles correctly, also when they have several threads
+            env.Append(CXXFLAGS=' -fprofile-update=prefer-atomic')
+        return True
+    if clang:
+        profdata = os.path.join(profile_dir, "default.profdata")
+        if not os.path.exists(profdata):
+            return False
+        env.Append(CXXFLAGS=' -fprofile-use=' + profdata + ' -Wno-profile-instr-unprofiled -Wno-profile-instr-out-of-date')
+        env.Append(LINKFLAGS=' -fprofile-use=' + profdata)
+        return True
+    if not list(iglob(os.path.join(profile_dir, "*.gcda"))):
+        return False
+    env.Append(CXXFLAGS=' -fprofile-use=' + profile_dir + ' -fprofile-correction -Wno-missing-profile -Wno-error=coverage-mismatch')
+    env.Append(LINKFLAGS=' -fprofile-use=' + profile_dir)
+    return True
+
+
+def profile_fingerprint(command):
+    """Return a string that changes when the profiles that the given compile command uses with -fprofile-use change"""
+    paths = []
+    for flag in command.split():
+        if flag == "-fprofile-use":
+            paths += sorted(chain(iglob("*.gcda"), iglob("*.profdata")))
+        elif flag.startswith("-fprofile-use="):
+            path = flag.split("=", 1)[1]
+            paths += sorted(iglob(os.path.join(path, "*"))) if os.path.isdir(path) else [path]
+    return " ".join(path + ":" + fingerprint(path) for path in paths)
+
+
+def pgo_main(src_files, main_executable, test_elves):
+    """Build with profile guided optimization. Instrumented executables are built and trained by running
+    the commands given with train="...", or else the tests, or else the main executable with the given args.
+    Then the recorded profiles are merged, and the executables are built again, optimized with the profiles.
+    The profiles are kept in the cache directory, see pgo_directory. Returns the exit status."""
+    targets = [target for target in [main_executable] + test_elves if target]
+    if not targets:
+        print("Nothing to optimize")
+        return 0
+    profile_dir = pgo_directory(src_files)
+    # Quote the arguments, since train="..." and args="..." may contain spaces
+    cmd = [shlex.quote(x) for x in argv if x != "pgo" and not x.startswith("pgo=")]
+
+    # Start with an empty profile, then build instrumented executables
+    if os.path.isdir(profile_dir):
+        shutil.rmtree(profile_dir)
+    os.makedirs(profile_dir)
+    print("[pgo] Building instrumented executables")
+    stdout.flush()
+    status, output = getstatusoutput(" ".join(cmd + ["pgo=generate"] + targets))
+    if output.strip():
+        print(output.strip())
+    if status != 0:
+        return status
+
+    # Run the training commands
+    training = build_argument('train', '').strip()
+    if training:
+        commands = [training]
+    elif test_elves:
+        commands = [os.path.join(".", test_elf) for test_elf in test_elves]
+    else:
+        commands = [(os.path.join(".", main_executable) + " " + build_argument('args', '')).strip()]
+    for command in commands:
+        print("[pgo] Training: " + command)
+        stdout.flush()
+        status = os.system(command)
+        if status != 0:
+            print("[pgo] Training failed: " + command)
+            return 1
+
+    # Merge the profiles
+    cxx = pgo_compiler()
+    if is_clang(cxx):
+        if not merge_profiles(cxx, profile_dir):
+            print("[pgo] No profiles were recorded in " + profile_dir)
+            return 1
+    elif not list(iglob(os.path.join(profile_dir, "*.gcda"))):
+        print("[pgo] No profiles were recorded in " + profile_dir)
+        return 1
+    print("[pgo] Recorded profiles in " + profile_dir)
+    # Let the following builds of this project look for the recorded profile
+    with cache_lock:
+        projects = load_cache("pgo")
+        projects[os.getcwd()] = profile_dir
+        save_cache("pgo", projects)
+
+    # Build the optimized executables
+    print("[pgo] Building optimized executables")
+    stdout.flush()
+    status, output = getstatusoutput(" ".join(cmd + ["pgo=use"] + targets))
+    if output.strip():
+        print(output.strip())
+    return status
+
+
+def write_compilation_database(env, src_files, module_src, clang, unity_outputs):
+    """Write compile_commands.json with the compile command of each source file, for clangd, clang-tidy and other tools.
+    Entries for source files that are not built this time are kept, as long as the files exist,
+    and the file is only written when an entry has changed.
+    unity_outputs gives the object of the unity file that a source is compiled in, with unity=1."""
+    filename = "compile_commands.json"
+    try:
+        with open(filename) as f:
+            old_entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        old_entries = []
+    entries = dict((entry["file"], entry) for entry in old_entries
+                   if isinstance(entry, dict) and os.path.exists(entry.get("file", "")))
+    for src_file in src_files:
+        obj = os.path.splitext(src_file)[0] + env.subst("$OBJSUFFIX")
+        if src_file in module_src:
+            # Module interface units are compiled by module_units, with the same flags
+            language = "c++-module" if clang else "c++"
+            command = "$CXX -o $TARGET -c $MODULEFLAGS $CXXFLAGS $CCFLAGS $_CCCOMCOM -x " + language + " $SOURCES"
+        elif src_file.endswith(".c"):
+            command = "$CCCOM"
+        else:
+            command = "$CXXCOM"
+        path = os.path.abspath(src_file)
+        entries[path] = {
+            "directory": os.getcwd(),
+            "file": path,
+            "output": unity_outputs.get(os.path.normpath(src_file), obj),
+            "command": env.subst(command, target=env.File(obj), source=env.File(src_file)),
+        }
+    new_entries = [entries[path] for path in sorted(entries)]
+    if new_entries != old_entries:
+        with open(filename, "w") as f:
+            json.dump(new_entries, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+def daemon_socket_path():
+    """Return the path to the Unix socket of the daemon"""
+    return os.path.join(cache_dir(), "daemon.sock")
+
+
+def daemon_environment():
+    """The daemon can only answer for clients with the same environment as itself"""
+    return [DAEMON_PROTOCOL] + [os.environ.get(var, "") for var in ("PATH", "PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR", "PKG_CONFIG_SYSROOT_DIR",
+                                                                           "CPATH", "C_INCLUDE_PATH", "CPLUS_INCLUDE_PATH")]
+
+
+def use_daemon():
+    """Check if build flags should be requested from a running daemon. This can be disabled with nodaemon=1"""
+    try:
+        if int(build_argument('nodaemon', 0)):
+            return False
+    except ValueError:
+        pass
+    return not daemon_mode and use_cache() and hasattr(socket, "AF_UNIX") and os.path.exists(daemon_socket_path())
+
+
+def ask_daemon(request, timeout=120):
+    """Send a request to the daemon and return the answer, or None if there is no daemon or it did not answer"""
+    client = None
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        client.connect(daemon_socket_path())
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode("utf-8"))
+    except (socket.error, OSError, ValueError):
+        return None
+    finally:
+        if client:
+            client.close()
+
+
+class Watcher(object):
+    """Watch directories for changes, with inotify when available, or else by polling"""
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400
+
+    def __init__(self):
+        self.watch_descriptors = {}  # inotify watch descriptor -> directory
+        self.polled = {}  # directory -> snapshot of the directory, for directories that are polled
+        self.libc = None
+        self.fd = -1
+        try:
+            import ctypes
+            import ctypes.util
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self.fd = self.libc.inotify_init1(0)
+        except (ImportError, OSError, AttributeError):
+            self.fd = -1
+
+    def snapshot(self, directory):
+        """Return something that changes when a file in the directory is added, removed or modified"""
+        try:
+            return sorted((name, fingerprint(os.path.join(directory, name))) for name in os.listdir(directory))
+        except OSError:
+            return None
+
+    def add(self, directory):
+        """Start watching the given directory, if it is not already watched"""
+        directory = os.path.abspath(directory)
+        if directory in self.watch_descriptors.values() or directory in self.polled:
+            return
+        if self.fd >= 0:
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode("utf-8"), self.INOTIFY_MASK)
+            if wd >= 0:
+                self.watch_descriptors[wd] = directory
+                return
+        self.polled[directory] = self.snapshot(directory)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for changes. Returns the set of directories that have changed."""
+        changed = set()
+        if self.fd >= 0 and self.watch_descriptors:
+            readable = select.select([self.fd], [], [], timeout)[0]
+            while readable:
+                data = os.read(self.fd, 65536)
+                offset = 0
+                while offset + 16 <= len(data):
+                    wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                    offset += 16 + length
+                    if wd in self.watch_descriptors:
+                        changed.add(self.watch_descriptors[wd])
+                # Editors often write several times in a row, collect those events too
+                readable = select.select([self.fd], [], [], 0.1)[0]
+        else:
+            time.sleep(timeout)
+        for directory, old_snapshot in list(self.polled.items()):
+            new_snapshot = self.snapshot(directory)
+            if new_snapshot != old_snapshot:
+                self.polled[directory] = new_snapshot
+                changed.add(directory)
+        return changed
+
+
+def forget_system_state():
+    """Forget what has been found out about the installed packages, since something has been installed or removed"""
+    global cached_pkg_config_defaults
+    for cached in (cached_pc_files, cached_owners, cached_header_indexes, cached_pc_fields, cached_pkg_config, cached_host_macros):
+        cached.clear()
+    cached_pkg_config_defaults = None
+
+
+def daemon_buildflags(request):
+    """Discover the build flags for a request from a client. Returns the answer for the client."""
+    global ARGUMENTS
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    os.chdir(request["cwd"])
+    ARGUMENTS = request["arguments"]
+    output = StringIO()
+    sys.stdout = output
+    exit_code = None
+    buildflags = {}
+    try:
+        buildflags = discover_all_buildflags(request["sources"], request["system_include_dirs"], request["win64"],
+                                             request["compiler_includes"], request["cxx"])
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 1
+    finally:
+        sys.stdout = sys.__stdout__
+    return {"buildflags": buildflags, "output": output.getvalue(), "exit": exit_code}
+
+
+def daemon_main(args):
+    """Keep the build flag discovery state warm between builds, by answering requests on a Unix socket.
+    The project directories of the clients are watched, and the build flags are discovered again when a file changes.
+    Started with "python3 build.py daemon" and stopped with "python3 build.py daemon stop"."""
+    global daemon_mode, ARGUMENTS
+    ARGUMENTS = {}
+    if not hasattr(socket, "AF_UNIX"):
+        print("error: the daemon requires Unix sockets")
+        exit(1)
+    if args and args[0] == "stop":
+        if ask_daemon({"stop": True}, 5) is None:
+            print("cxx daemon is not running")
+        else:
+            print("stopped cxx daemon")
+        return
+    if ask_daemon({"ping": True}, 5) is not None:
+        print("cxx daemon is already running")
+        return
+    daemon_mode = True
+    path = daemon_socket_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if os.path.exists(path):
+        # Left behind by a daemon that did not stop cleanly
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Create the socket with no access for other users from the start, instead of changing it after bind
+    umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    server.settimeout(DAEMON_IDLE_SECONDS)
+
+    lock = threading.Lock()
+    watcher = Watcher()
+    projects = {}  # project directory -> the latest request for that project, and the watched directories
+    system_state = [None]
+
+    def answer(request):
+        with lock:
+            # In-memory state about installed packages is only valid for as long as nothing is installed or removed
+            state = [fingerprint(path) for path in PACKAGE_DATABASES + PC_DIRS]
+            if state != system_state[0]:
+                forget_system_state()
+                system_state[0] = state
+            try:
+                return daemon_buildflags(request)
+            finally:
+                os.chdir("/")
+
+    def watch():
+        while True:
+            changed = watcher.wait(1.0)
+            with lock:
+                requests = [request for request, directories in projects.values() if changed & directories]
+            # Discover the flags for the changed projects right away, so that they are ready for the next build
+            for request in requests:
+                answer(request)
+
+    watch_thread = threading.Thread(target=watch)
+    watch_thread.daemon = True
+    watch_thread.start()
+
+    print("cxx daemon listening on " + path)
+    stdout.flush()
+    try:
+        while True:
+            try:
+                connection = server.accept()[0]
+            except socket.timeout:
+                # No builds for a long time
+                break
+            try:
+                connection.settimeout(10)
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                request = json.loads(data.decode("utf-8"))
+                if request.get("stop"):
+                    connection.sendall(b'{"stopped": true}\n')
+                    break
+                if request.get("ping"):
+                    reply = {"pong": True}
+                elif request.get("environment") != daemon_environment():
+                    reply = {"error": "the environment of the client differs from the environment of the daemon"}
+                else:
+                    reply = answer(request)
+                    with lock:
+                        project = os.path.abspath(request["cwd"])
+                        directories = set([os.path.normpath(os.path.join(project, directory)) for directory in [""] + LOCAL_INCLUDE_PATHS
+                                           if os.path.isdir(os.path.join(project, directory))])
+                        for directory in directories:
+                            watcher.add(directory)
+                        projects[project] = (request, directories)
+                connection.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+            except (socket.error, OSError, ValueError, KeyError):
+                pass
+            finally:
+                connection.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
 def supported(cxx, std):
     """Check if the given compiler supports the given standard. Example: supported("g++", "c++2a")"""
     # Tested with clang++ and g++-7
+    # The answer is cached per compiler binary, since this is checked for many standards and compilers
     cmd = "echo asdf | " + cxx + " -std=" + std + " -x c++ -E - 2>&1 | grep -q -v \"" + std + "\" && echo YES || echo NO"
     try:
-        return popen2(cmd)[1].read().strip() == "YES"
+        return probe(cxx, "-std=" + std, cmd).strip() == "YES"
     except OSError:
         # Assume that this is an unknown compiler and that it does support the given standard.
         # This lets the compiler fail by itself a bit further in the process, instead of stopping a working compiler from being used.
         return True
 
 
+# The -fuse-ld= names of the linkers that can be selected with linker=..., and the programs that provide them
+LINKERS = {"mold": "mold", "lld": "ld.lld", "gold": "ld.gold", "bfd": "ld.bfd"}
+
+# The linkers that are tried when linker=... is not given, fastest first
+FAST_LINKERS = ["mold", "lld", "gold"]
+
+
+def links(cxx, flags, tool="", packages=False):
+    """Check if a small program can be compiled and linked with the given compiler and flags.
+    tool is a space separated list of programs that the flags depend on, like a linker, and of linker plugins given
+    by their path, so that the answer is renewed when one of them is upgraded.
+    If packages is True, the answer is also renewed when packages are installed or removed, for flags like -static
+    that depend on which libraries are installed. The answer is cached per compiler binary, like for supported()."""
+    if not os.path.isdir(cache_dir()):
+        os.makedirs(cache_dir())
+    exe = os.path.join(cache_dir(), "trial." + str(os.getpid()))
+    cmd = "echo 'int main() { return 0; }' | " + cxx + " -x c++ " + flags + " - -o " + exe + \
+          " >/dev/null 2>&1 && echo YES || echo NO; rm -f " + exe
+    name = "link " + flags
+    for program in tool.split():
+        if os.path.isabs(program) and not which(program):
+            # A linker plugin, like LLVMgold.so
+            name += " " + program + ":" + fingerprint(program)
+        else:
+            name += " " + compiler_identity(program)
+    if packages:
+        name += " packages=" + packages_fingerprint()
+    try:
+        return probe(cxx, name, cmd).strip() == "YES"
+    except OSError:
+        return False
+
+
+def linker_flags(cxx, linker):
+    """Return the flag for linking with the given linker, like "-fuse-ld=mold" for "mold",
+    or an empty string if the compiler can not link with it"""
+    if linker not in LINKERS:
+        print("WARNING: unknown linker: " + linker + " (use one of: " + ", ".join(sorted(LINKERS)) + ")")
+        return ""
+    if not which(LINKERS[linker]):
+        print("WARNING: " + LINKERS[linker] + " is not installed, using the default linker")
+        return ""
+    if not links(cxx, "-fuse-ld=" + linker, LINKERS[linker]):
+        print("WARNING: " + cxx + " can not link with " + linker + ", using the default linker")
+        return ""
+    return "-fuse-ld=" + linker
+
+
+def fast_linker(cxx, flags=""):
+    """Return the -fuse-ld= flag for the fastest installed linker that the given compiler can link with,
+    using the given flags (like -flto), or an empty string if only the default linker works"""
+    for linker in FAST_LINKERS:
+        if which(LINKERS[linker]) and links(cxx, ("-fuse-ld=" + linker + " " + flags).strip(), LINKERS[linker]):
+            return "-fuse-ld=" + linker
+    return ""
+
+
+def lto_tools(cxx, clang, linkflags):
+    """Return the linker that the given link flags select, followed by the LTO plugin it loads, if there is one.
+    Whether a link-time optimization mode works depends on these, and not only on the compiler."""
+    linker = "ld"
+    for flag in linkflags.split():
+        if flag.startswith("-fuse-ld="):
+            linker = LINKERS.get(flag[len("-fuse-ld="):], flag[len("-fuse-ld="):])
+    # lld and mold link LLVM bitcode themselves, the other linkers load a plugin
+    plugin = "LLVMgold.so" if clang else "liblto_plugin.so"
+    if clang and linker in ("ld.lld", "mold"):
+        return linker
+    try:
+        path = probe(cxx, "-print-file-name=" + plugin, cxx + " -print-file-name=" + plugin).strip()
+    except OSError:
+        return linker
+    if os.path.isabs(path) and os.path.exists(path):
+        return linker + " " + path
+    return linker
+
+
+def lto_flags(cxx, mode, jobs, clang, linkflags=""):
+    """Return the compilation and linking flags for the given link-time optimization mode, as a tuple:
+    "full" for one serial link-time optimization step, "auto" for letting GCC use all cores (or thin-LTO with clang),
+    a number for the number of parallel GCC LTO jobs, or "thin" for clang thin-LTO with a cache directory.
+    Each mode is checked with a trial link, and the nearest supported mode is used if it does not work."""
+    if mode in ("1", "yes", "true"):
+        mode = "auto"
+    tools = lto_tools(cxx, clang, linkflags)
+    if clang:
+        if mode in ("auto", "thin") or mode.isdigit():
+            thinlto_dir = os.path.join(cache_dir(), "thinlto")
+            if platform.system() == "Darwin":
+                cache_flag = "-Wl,-cache_path_lto," + thinlto_dir
+            elif "-fuse-ld=gold" in linkflags:
+                cache_flag = "-Wl,-plugin-opt,cache-dir=" + thinlto_dir
+            else:
+                cache_flag = "-Wl,--thinlto-cache-dir=" + thinlto_dir
+            # Thin-LTO needs a linker that can do it, like lld
+            if links(cxx, (linkflags + " -flto=thin " + cache_flag).strip(), tools):
+                return "-flto=thin", "-flto=thin " + cache_flag
+            if mode == "thin":
+                print("WARNING: " + cxx + " can not link with -flto=thin, using -flto instead")
+    else:
+        if mode == "thin":
+            print("WARNING: -flto=thin is only for clang, using -flto=auto instead")
+            mode = "auto"
+        if mode == "auto" and links(cxx, (linkflags + " -flto=auto").strip(), tools):
+            return "-flto", "-flto=auto"
+        if mode in ("auto", "jobserver"):
+            # GCC older than 10 has no -flto=auto, and there is no make jobserver when building with SCons
+            mode = str(jobs)
+        if mode.isdigit() and int(mode) > 1 and links(cxx, (linkflags + " -flto=" + mode).strip(), tools):
+            return "-flto", "-flto=" + mode
+    if mode not in ("full", "auto", "thin", "jobserver") and not mode.isdigit():
+        print("WARNING: unknown lto mode: " + mode + " (use one of: full, auto, thin or a number of jobs)")
+    return "-flto", "-flto"
+
+
 # Only support Qt6 in /usr/include/qt6 and /usr/lib, for now
 qt6_cxx_flags = "-I/usr/include/qt6 -I/usr/include/qt6/Qt3DAnimation -I/usr/include/qt6/Qt3DCore -I/usr/include/qt6/Qt3DExtras -I/usr/include/qt6/Qt3DInput -I/usr/include/qt6/Qt3DLogic -I/usr/include/qt6/Qt3DQuick -I/usr/include/qt6/Qt3DQuickAnimation -I/usr/include/qt6/Qt3DQuickExtras -I/usr/include/qt6/Qt3DQuickInput -I/usr/include/qt6/Qt3DQuickRender -I/usr/include/qt6/Qt3DQuickScene2D -I/usr/include/qt6/Qt3DRender -I/usr/include/qt6/QtConcurrent -I/usr/include/qt6/QtCore -I/usr/include/qt6/QtCore5Compat -I/usr/include/qt6/QtDBus -I/usr/include/qt6/QtDesigner -I/usr/include/qt6/QtDesignerComponents -I/usr/include/qt6/QtDeviceDiscoverySupport -I/usr/include/qt6/QtEglFSDeviceIntegration -I/usr/include/qt6/QtEglFsKmsGbmSupport -I/usr/include/qt6/QtEglFsKmsSupport -I/usr/include/qt6/QtFbSupport -I/usr/include/qt6/QtGui -I/usr/include/qt6/QtHelp -I/usr/include/qt6/QtInputSupport -I/usr/include/qt6/QtKmsSupport -I/usr/include/qt6/QtLabsAnimation -I/usr/include/qt6/QtLabsFolderListModel -I/usr/include/qt6/QtLabsQmlModels -I/usr/include/qt6/QtLabsSettings -I/usr/include/qt6/QtLabsSharedImage -I/usr/include/qt6/QtLabsWavefrontMesh -I/usr/include/qt6/QtNetwork -I/usr/include/qt6/QtNetworkAuth -I/usr/include/qt6/QtOpenGL -I/usr/include/qt6/QtOpenGLWidgets -I/usr/include/qt6/QtPacketProtocol -I/usr/include/qt6/QtPrintSupport -I/usr/include/qt6/QtQml -I/usr/include/qt6/QtQmlCompiler -I/usr/include/qt6/QtQmlDebug -I/usr/include/qt6/QtQmlDom -I/usr/include/qt6/QtQmlLocalStorage -I/usr/include/qt6/QtQmlModels -I/usr/include/qt6/QtQmlWorkerScript -I/usr/include/qt6/QtQuick -I/usr/include/qt6/QtQuick3D -I/usr/include/qt6/QtQuick3DAssetImport -I/usr/include/qt6/QtQuick3DIblBaker -I/usr/include/qt6/QtQuick3DParticles -I/usr/include/qt6/QtQuick3DRuntimeRender -I/usr/include/qt6/QtQuick3DUtils -I/usr/include/qt6/QtQuickControls2 -I/usr/include/qt6/QtQuickControls2Impl -I/usr/include/qt6/QtQuickLayouts -I/usr/include/qt6/QtQuickParticles -I/usr/include/qt6/QtQuickShapes -I/usr/include/qt6/QtQuickTemplates2 -I/usr/include/qt6/QtQuickTest -I/usr/include/qt6/QtQuickWidgets -I/usr/include/qt6/QtShaderTools -I/usr/include/qt6/QtSql -I/usr/include/qt6/QtSvg -I/usr/include/qt6/QtSvgWidgets -I/usr/include/qt6/QtTest -I/usr/include/qt6/QtTools -I/usr/include/qt6/QtUiPlugin -I/usr/include/qt6/QtUiTools -I/usr/include/qt6/QtWaylandClient -I/usr/include/qt6/QtWaylandCompositor -I/usr/include/qt6/QtWidgets -I/usr/include/qt6/QtXml"
 qt6_link_flags = "-lQt6Concurrent -lQt6Core -lQt6DBus -lQt6EglFSDeviceIntegration -lQt6EglFsKmsGbmSupport -lQt6EglFsKmsSupport -lQt6Gui -lQt6Network -lQt6OpenGL -lQt6OpenGLWidgets -lQt6PrintSupport -lQt6Sql -lQt6Test -lQt6Widgets -lQt6XcbQpa -lQt6Xml"
@@ -1594,7 +4216,10 @@ def cxx_main():
     """The main function"""
 
     # Make sure to use the --compress and/or --tmpdir flag when using GNU parallel
-    SConsignFile("/tmp/cxx" + os.environ['LOGNAME'])  # will be stored as /tmp/cxx_$LOGNAME.dblite
+    # Each project gets its own signature database, keyed by the absolute project path, so that
+    # several projects can be built at once without overwriting each other's signatures.
+    project_key = hashlib.sha1(os.path.abspath(os.curdir).encode("utf-8")).hexdigest()[:12]
+    SConsignFile("/tmp/cxx" + os.environ['LOGNAME'] + "-" + project_key)  # stored as /tmp/cxx$LOGNAME-<key>.dblite
 
     # Include paths on the system, as reported by the compiler
     compiler_includes = []
@@ -1665,6 +4290,11 @@ def cxx_main():
 
     # Custom command line targets
     if 'clean' in COMMAND_LINE_TARGETS:  # Clean built executables and object files
+        # Remove the library and pkg-config file from lib=static or lib=shared
+        name = library_name()
+        for fn in list(chain(iglob("lib" + name + ".a"), iglob("lib" + name + ".so"), iglob("lib" + name + ".dylib"), iglob(name + ".pc"))):
+            os.remove(fn)
+            print("Removed {}".format(fn))
         if (not test_elves) and (not main_executable):
             print("Nothing to clean")
             exit(0)
@@ -1673,7 +4303,7 @@ def cxx_main():
             os.remove(main_executable + ".exe")
             print("Removed {}.exe".format(main_executable))
         # Remove all profiling files
-        for fn in list(chain(iglob("*.profraw"), iglob("*.gcda"), iglob("*.gcno"))):
+        for fn in list(chain(iglob("*.profraw"), iglob("*.profdata"), iglob("*.gcda"), iglob("*.gcno"), iglob("cxx-profile.json"))):
             os.remove(fn)
             print("Removed {}".format(fn))
         # Remove scons files
@@ -1691,6 +4321,11 @@ def cxx_main():
         output = output.strip()
         if output:
             print(output)
+        # Remove the generated unity files, precompiled header and compiled module interfaces
+        for generated_dir in (UNITY_DIR, PCH_DIR, MODULES_DIR, "gcm.cache"):
+            if os.path.isdir(generated_dir):
+                shutil.rmtree(generated_dir)
+                print("Removed {}".format(generated_dir))
         exit(status)
     elif 'testbuild' in COMMAND_LINE_TARGETS:  # Build and run tests, this is the default
         # Remove the "test" argument, and list all test-executable targets
@@ -1720,6 +4355,23 @@ def cxx_main():
         if not test_elves:
             print("Nothing to test")
             exit(0)
+        # Find the local files that each test depends on, and only run the tests that are affected by changes,
+        # if changed=1 or changed=REF is given
+        closures, orphans = test_closures(main_source_file, test_sources, dep_src)
+        closures = dict((os.path.splitext(test_src)[0], closure) for test_src, closure in closures.items())
+        changed = build_argument('changed', '')
+        if changed and changed not in ("0", "no", "false"):
+            test_elves = changed_tests(test_elves, closures, changed)
+            if not test_elves:
+                print("No tests are affected by the changes")
+                exit(0)
+        fingerprints = dict((test_elf, dict((fn, fingerprint(fn)) for fn in closures.get(test_elf, [])))
+                            for test_elf in test_elves)
+        # Only build and run the tests of the given shard, if shard=i/n is given
+        test_elves = test_shard(test_elves, build_argument('shard', ''))
+        if not test_elves:
+            print("Nothing to test in shard " + build_argument('shard', ''))
+            exit(0)
         # Remove the "test" argument, and list all test-executable targets
         cmd = [x for x in argv if x != "test"] + [elf for elf in test_elves if elf != "test"]
         # Build the tests
@@ -1731,16 +4383,33 @@ def cxx_main():
         output = os.linesep.join([line for line in output.split(os.linesep) if not "up to date" in line]).strip()
         if output:
             print(output)
-        # Run the tests
-        for test_elf in test_elves:
-            status, output = getstatusoutput(os.path.join(".", test_elf))
-            output = output.strip()
-            if output:
-                print(output)
-            # Exit on error
-            if status != 0:
-                exit(status)
+        # Run the tests, test_jobs at a time, and stop the ones that take more than test_timeout seconds
+        try:
+            test_jobs = int(build_argument('test_jobs', build_argument('jobs', cpu_count())))
+            test_timeout = float(build_argument('test_timeout', 0))
+        except ValueError:
+            print("WARNING: test_jobs and test_timeout must be numbers")
+            test_jobs, test_timeout = cpu_count(), 0
+        start = time.time()
+        results = run_tests(test_elves, test_jobs, test_timeout)
+        seconds = time.time() - start
+        if use_cache():
+            record_test_results(results, fingerprints)
+        if build_argument('junit', ''):
+            write_junit(build_argument('junit', ''), results, os.path.basename(os.getcwd()))
+        if build_argument('test_json', ''):
+            write_test_json(build_argument('test_json', ''), results, seconds)
+        # Report all failed tests, and exit with the exit code of the first one (or 1, if it was killed)
+        failed = [result for result in results if result["status"] != "passed"]
+        if len(test_elves) > 1 or failed or changed:
+            print("{} of {} tests passed in {:.2f}s".format(len(test_elves) - len(failed), len(test_elves), seconds))
+        if failed:
+            exit(max(1, failed[0]["returncode"]))
         exit(0)
+    elif 'pgo' in COMMAND_LINE_TARGETS:  # Build, train and build again with profile guided optimization
+        if os.path.exists(main_source_file):
+            dep_src = local_dep_sources(main_source_file, dep_src)
+        exit(pgo_main([main_source_file] + dep_src + module_sources(), main_executable, test_elves))
     elif 'run' in COMMAND_LINE_TARGETS:  # Build and run main
         # TODO: if win64==True, build an .exe and run it with wine
         # Remove the "run" argument, and add "main"
@@ -1776,8 +4445,12 @@ def cxx_main():
             os.execvp(executable, [executable] + given_args.split())
         exit(0)
 
-    # Set the number of jobs to the number of CPUs
-    SetOption('num_jobs', cpu_count())
+    # Set the number of jobs to the number of CPUs, unless jobs=N is given,
+    # for instance by tests/all.py when building several projects at once
+    try:
+        SetOption('num_jobs', max(1, int(build_argument('jobs', cpu_count()))))
+    except ValueError:
+        SetOption('num_jobs', cpu_count())
 
     # Random build-order, for the possibility of using the cache better
     SetOption('random', 1)
@@ -1788,6 +4461,29 @@ def cxx_main():
     # Faster checks of existing code
     env.Decider('MD5-timestamp')
 
+    # Time each compilation and link step, and write a report when done
+    if profiling():
+        env['SPAWN'] = profiled_spawn(env['SPAWN'])
+        atexit.register(write_profile)
+
+    # Share compiled objects between projects (and possibly machines), in a size bounded cache
+    if object_cache_dir() and not env.GetOption('clean'):
+        try:
+            if not os.path.isdir(object_cache_dir()):
+                os.makedirs(object_cache_dir())
+            try:
+                env.CacheDir(object_cache_dir(), object_cache_class())
+            except (TypeError, ImportError, AttributeError):
+                # Older versions of SCons, without custom CacheDir classes
+                env.CacheDir(object_cache_dir())
+            atexit.register(finish_object_cache, env)
+            # Keep the warnings of each compilation, for storing them together with the object
+            env['SPAWN'] = compiler_output_spawn(env['SPAWN'])
+        except Exception:
+            # The directory can not be created or written to, for instance on a read-only shared drive
+            print("WARNING: could not use the object cache in " + object_cache_dir())
+            env.CacheDir(None)
+
     # Use the given CXX as the default value for the C++ compiler
     if 'CXX' in ARGUMENTS:
         env.Replace(CXX=ARGUMENTS['CXX'])
@@ -1893,6 +4589,9 @@ def cxx_main():
     if platform.system() == "OpenBSD" and str(env["CXX"]) == "g++":
         env.Replace(CXX="/usr/local/bin/eg++")
 
+    # Set when a profile in the project directory, recorded by cxx rec, is used
+    local_profile = False
+
     if not cleaning:  # ) and (not main_source_file.endswith(".c")):
         if not bool(ARGUMENTS.get('std', '')):
             # std is not set, use the latest possible C++ standard flag
@@ -1923,12 +4622,7 @@ def cxx_main():
                             print("WARNING: " + value + " is not supported by " + str(env["CXX"]))
 
         # Use the selected C++ compiler to report back all system include paths it will search automatically
-        compiler_includes = []
-        try:
-            compiler_includes = [line.strip().split()[0] for line in popen2("echo | " + str(env["CXX"]) + " -E -Wp,-v - 2>&1")[
-                1].read().split("\n") if line.strip().startswith("/") and os.path.exists(line.strip().split()[0])]
-        except OSError:
-            pass
+        compiler_includes = compiler_include_dirs(str(env["CXX"]))
 
         # imgdir/datadir/shaderdir/sharedir/resourcedir is set?
         for dirname in ["img", "data", "shader", "share", "resource", "script"]:
@@ -1956,7 +4650,7 @@ def cxx_main():
         if os.path.exists("/usr/include"):
             system_include_dirs.append("/usr/include")
         if which(str(env["CXX"])):
-            machine_name = popen2(str(env["CXX"]) + " -dumpmachine")[1].read().strip()
+            machine_name = dumpmachine(str(env["CXX"]))
             if os.path.exists("/usr/include/" + machine_name):
                 system_include_dirs.append("/usr/include/" + machine_name)
         # Set system_include_dir[0] to the given value, or keep it as /usr/include
@@ -1993,9 +4687,6 @@ def cxx_main():
         elif int(ARGUMENTS.get('opt', 0)):
             # Enable more optimization flags than O3 + link time optimization
             env.Append(CXXFLAGS=' -Ofast')
-            # Use -flto for link-time optimization
-            env.Append(CXXFLAGS=' -flto')
-            env.Append(LINKFLAGS=' -Wl,-flto')
         elif openmp:
             # Use -O3 if OpenMP is in use
             env.Append(CXXFLAGS=' -O3')
@@ -2003,13 +4694,40 @@ def cxx_main():
             # Default optimization level
             env.Append(CXXFLAGS=' -O2')
 
+        # Use link-time optimization when opt is set, or when lto is given, like lto=thin.
+        # lto=0 turns it off.
+        lto = build_argument('lto', 'auto' if int(ARGUMENTS.get('opt', 0)) else '0')
+        use_lto = lto not in ("0", "no", "false") and not int(ARGUMENTS.get('debug', 0))
+
+        # linker is set? Like linker=mold or linker=lld. linker=default uses the default linker.
+        # If not, use the fastest of mold, lld and gold that can link, also with -flto if it is used.
+        # Project files for other build systems are for other systems, where the linker may be missing.
+        linker = build_argument('linker', '')
+        exporting = 'pro' in COMMAND_LINE_TARGETS or 'cmake' in COMMAND_LINE_TARGETS
+        if linker and linker not in ("default", "0"):
+            env.Append(LINKFLAGS=' ' + linker_flags(str(env["CXX"]), linker))
+        elif not linker and not win64 and not exporting and platform.system() not in ("Darwin", "Windows"):
+            env.Append(LINKFLAGS=' ' + fast_linker(str(env["CXX"]), "-flto" if use_lto else ""))
+
+        if use_lto:
+            lto_compile, lto_link = lto_flags(str(env["CXX"]), lto, GetOption('num_jobs'), is_clang(str(env["CXX"])),
+                                              str(env["LINKFLAGS"]))
+            env.Append(CXXFLAGS=' ' + lto_compile)
+            env.Append(LINKFLAGS=' ' + lto_link)
+
         # Use -pipe for a possible speed increase when compiling
         env.Append(CXXFLAGS=' -pipe')
 
         # and -fPIC for position independent code. May increase the size of the executable.
-        if not int(ARGUMENTS.get('small', 0)):
+        # Shared libraries always need it.
+        if not int(ARGUMENTS.get('small', 0)) or library_kind() == "shared":
             env.Append(CXXFLAGS=' -fPIC')
 
+        # With lib=shared and visibility=hidden, only export what is marked with the export macro, like FOO_EXPORT
+        if library_kind() == "shared" and build_argument('visibility', '') == "hidden" and not win64:
+            env.Append(CXXFLAGS=' -fvisibility=hidden -fvisibility-inlines-hidden')
+            env.Append(CPPDEFINES=[export_macro(library_name()) + "='__attribute__((visibility(\"default\")))'"])
+
         # if compiling for "tiny", don't use the standard library or exceptions
         if int(ARGUMENTS.get('tiny', 0)):
             env.Append(CXXFLAGS=' -s -nostdlib -fno-rtti -fno-ident -fomit-frame-pointer')
@@ -2093,19 +4811,18 @@ def cxx_main():
             elif env['CXX'] in ('clang++', 'zapcc++'):
                 env.Append(CXXFLAGS=' -fprofile-generate')
                 env.Append(LINKFLAGS=' -fprofile-generate')
-        else:
+        elif not pgo_mode():
             if env['CXX'] == 'g++':
                 if list(iglob("*.gcda")):
                     env.Append(CXXFLAGS=' -fprofile-use -fprofile-correction')
                     env.Append(LINKFLAGS=' -fprofile-use -fprofile-correction')
+                    local_profile = True
             elif env['CXX'] in ('clang++', 'zapcc++'):
-                # if list(iglob("*.profraw")):
-                # cmd = "llvm-profdata merge -output=default.profdata default-*.profraw"
-                # output = popen2(cmd)[1].read().strip()
-                # print(output)
-                if list(iglob("*.gcda")):
-                    env.Append(CXXFLAGS=' -fprofile-use')
-                    env.Append(LINKFLAGS=' -fprofile-use')
+                # The raw profiles that clang records must be merged into default.profdata first, with llvm-profdata
+                if os.path.exists("default.profdata"):
+                    env.Append(CXXFLAGS=' -fprofile-use=default.profdata')
+                    env.Append(LINKFLAGS=' -fprofile-use=default.profdata')
+                    local_profile = True
 
         # Windows related build flags
         if win64:
@@ -2173,41 +4890,31 @@ def cxx_main():
     # Find all included header files in ../include, then check if there are corresponding
     # sourcefiles in ../common and add them to dep_src, if there is a main source file
     if os.path.exists(main_source_file):
-        includes = []
-        has_new_include = True
-        examined = []
-        while has_new_include:
-            has_new_include = False
-            for INCLUDE_PATH in LOCAL_INCLUDE_PATHS:
-                for filename in dep_src + [main_source_file] + [os.path.join(INCLUDE_PATH, x) for x in includes]:
-                    if filename.lower() in examined:
-                        continue
-                    examined.append(filename.lower())
-                    if os.path.exists(filename):
-                        try:
-                            new_includes = [line.split("\"")[1] for line in open(filename).read().split(
-                                os.linesep)[:-1] if line.strip().startswith("#include \"")]
-                        except IOError:
-                            print("Can not read " + filename)
-                            exit(1)
-                    else:
-                        continue
-                    for new_include in [os.path.relpath(x) for x in new_includes]:
-                        if new_include not in includes:
-                            has_new_include = True
-                            includes.append(new_include)
-                for include in includes:
-                    for COMMON_PATH in LOCAL_COMMON_PATHS:
-                        for ext in [".cpp", ".cc", ".cxx", ".c"]:
-                            source_filename = os.path.join(COMMON_PATH, include.rsplit(".", 1)[0] + ext)
-                            if os.path.exists(source_filename):
-                                if source_filename.lower() not in [x.lower() for x in dep_src]:
-                                    dep_src.append(source_filename)
-
-    # Find extra CFLAGS for the sources, if not cleaning
+        with profile_span("configure", "local dependencies"):
+            dep_src = local_dep_sources(main_source_file, dep_src)
+
+    # C++20 module interface units, like math.cppm
+    module_src = module_sources()
+
+    # Profile guided optimization, with profiles recorded by cxx pgo, or given with pgo=generate or pgo=use.
+    # A profile recorded by cxx pgo is only looked for in projects where cxx pgo has been used, since finding it
+    # means hashing all the sources, and not when there already is a profile in the project directory, from cxx rec.
+    if not cleaning and not int(ARGUMENTS.get('rec', 0)) and pgo_mode() != "off":
+        if pgo_mode() in ("generate", "use"):
+            pgo_flags(env, pgo_directory([main_source_file] + dep_src + module_src), pgo_mode())
+        elif not local_profile and os.getcwd() in load_cache("pgo"):
+            if pgo_flags(env, pgo_directory([main_source_file] + dep_src + module_src), "use"):
+                print("[{}] Using the recorded profile for profile guided optimization".format(os.path.basename(os.getcwd())))
+
+    # Find extra CFLAGS for the main, dependency and test sources at once, if not cleaning.
+    # The flags are then added to the environment in the same order as before.
+    all_buildflags = {}
     if not env.GetOption('clean') and ('clean' not in COMMAND_LINE_TARGETS):
-        for src_file in [main_source_file] + dep_src:
-            add_flags(env, src_file, system_include_dirs, win64, compiler_includes)
+        with profile_span("configure", "build flags"):
+            all_buildflags = discover_all_buildflags([main_source_file] + dep_src + module_src + test_sources,
+                                                     system_include_dirs, win64, compiler_includes, str(env["CXX"]))
+        for src_file in [main_source_file] + dep_src + module_src:
+            add_flags(env, src_file, system_include_dirs, win64, compiler_includes, all_buildflags.get(src_file))
 
     # If libraries are linked to, skip unused shared object dependencies.
     if "LIBS" in env and env["LIBS"]:
@@ -2245,14 +4952,69 @@ def cxx_main():
         else:
             env["LIBS"] = ['stdc++fs']
 
+    # Link static executables with static=1, if the libraries are available as static libraries
+    if int(ARGUMENTS.get('static', 0)) and not cleaning:
+        libs = [str(lib) for lib in env.get("LIBS", [])]
+        libs += [flag[2:] for flag in str(env["LINKFLAGS"]).split() if flag.startswith("-l") and flag[2:] not in libs]
+        env.Append(LINKFLAGS=' ' + static_linkflags(str(env["CXX"]), libs))
+
+    # Build the C++20 module interface units before the sources that import them
+    module_objects, module_interfaces, module_needs = [], [], {}
+    if not cleaning:
+        module_objects, module_interfaces, module_needs = module_units(env, [main_source_file] + dep_src + test_sources,
+                                                                       module_src, is_clang(str(env["CXX"])))
+    dep_objects = [src_file for src_file in dep_src if src_file not in module_interfaces]
+    unity_outputs = {}
+
+    # With unity=1, compile the dependencies as a few larger translation units.
+    # Sources that import modules are compiled separately, since imports must come before other declarations.
+    if unity_build() and not cleaning and len(dep_objects) > 1:
+        importers = [src_file for src_file in dep_objects if module_needs.get(os.path.abspath(src_file))]
+        dep_objects = unity_objects(env, [src_file for src_file in dep_objects if src_file not in importers]) + importers
+        # The objects of the unity files, by the sources they include, for compile_commands.json
+        for obj in dep_objects:
+            if not isinstance(obj, str):
+                for source in obj.sources[1:]:
+                    unity_outputs[os.path.normpath(str(source))] = str(obj)
+    dep_objects = dep_objects + module_objects
+
+    # With lib=static or lib=shared, build the dependencies as a library that main and the tests are linked with
+    library = []
+    if library_kind() and dep_objects and not cleaning:
+        library = build_library(env, library_kind(), dep_objects)
+        dep_objects = library
+
     # Build main executable
     if main_source_file:
-        main = env.Program(main_executable, [main_source_file] + dep_src)
+        main = env.Program(main_executable, [main_source_file] + dep_objects)
+        # Linking is fast, only cache the objects
+        env.NoCache(main)
+
+    # Link each test only with the sources that it depends on, through the headers it includes, and the sources
+    # that are not reached from any header. testlink=all links all the dependencies with every test.
+    # With unity=1, the sources are compiled together, so all the dependencies are linked with every test.
+    # With a library, the linker picks what each test needs from it.
+    test_links = dict((test_src, dep_objects) for test_src in test_sources)
+    test_only_src = []
+    if test_sources and not cleaning and build_argument('testlink', '') != "all" and not unity_build():
+        closures = test_closures(main_source_file, test_sources, dep_src)[0]
+        known_src = set(os.path.normpath(src_file) for src_file in dep_src + test_sources)
+        for test_src in test_sources:
+            needed = closures[test_src]
+            # Sources that the tests depend on, but that were not found from the main source file
+            for fn in sorted(needed):
+                if os.path.splitext(fn)[1] in (".cpp", ".cc", ".cxx", ".c") and fn not in known_src and fn not in test_only_src:
+                    test_only_src.append(fn)
+            if library:
+                test_links[test_src] = [fn for fn in test_only_src if fn in needed] + library
+                continue
+            test_links[test_src] = [obj for obj in dep_objects if not isinstance(obj, str) or os.path.normpath(obj) in needed] + \
+                                   [fn for fn in test_only_src if fn in needed]
 
     # Find extra CFLAGS for the test sources, if not cleaning
     if not env.GetOption('clean') and ('clean' not in COMMAND_LINE_TARGETS):
-        for src_file in test_sources:
-            add_flags(env, src_file, system_include_dirs, win64, compiler_includes)
+        for src_file in test_sources + test_only_src:
+            add_flags(env, src_file, system_include_dirs, win64, compiler_includes, all_buildflags.get(src_file))
 
     # Remove non-existing includes
     includes = [include for include in env['CPPPATH'] if os.path.exists(include)]
@@ -2364,14 +5126,43 @@ def cxx_main():
         exit(0)
 
     # Set up non-default targets for all the test executables (based on *_test sources)
+    programs = ([main] if main_source_file else []) + ([library] if library else [])
     for test_src in test_sources:
         test_elf = os.path.splitext(test_src)[0]
-        env.Program(test_elf, [test_src] + dep_src)
-
-    # Only main is the default target
+        programs.append(env.Program(test_elf, [test_src] + test_links[test_src]))
+        env.NoCache(programs[-1])
+
+    # Let the objects that import modules depend on the compiled module interfaces
+    for program in programs:
+        for obj in program[0].sources:
+            if obj.sources and module_needs.get(obj.sources[0].abspath):
+                env.Depends(obj, module_needs[obj.sources[0].abspath])
+
+    # With pch=1, precompile the system headers that most sources include first, and let the C++ objects depend on it.
+    # Precompiled headers are not combined with modules.
+    if precompiled_headers() and not cleaning and not (module_objects or any(module_needs.values())):
+        pch, pch_users = precompiled_header(env, [main_source_file] + dep_src + test_sources)
+        if pch:
+            pch_users = set(os.path.abspath(src_file) for src_file in pch_users)
+            for program in programs:
+                for obj in program[0].sources:
+                    if obj.sources and obj.sources[0].abspath in pch_users:
+                        env.Depends(obj, pch)
+
+    # Write compile_commands.json for clangd and clang-tidy, unless compdb=0 is given
+    if not cleaning and build_argument('compdb', '1') not in ("0", "no", "false"):
+        src_files = [main_source_file] + dep_src + module_src + test_sources + test_only_src
+        write_compilation_database(env, [fn for i, fn in enumerate(src_files) if fn and fn not in src_files[:i]],
+                                   module_src, is_clang(str(env["CXX"])), unity_outputs)
+
+    # Only main is the default target, and the library, if lib=static or lib=shared is given
+    if library:
+        Default(library)
     try:
         Default(main)
     except UnboundLocalError:
+        if library:
+            return
         try:
             if env.GetOption('test') or 'test' in COMMAND_LINE_TARGETS:
                 print("Nothing to test")
@@ -2382,4 +5173,13 @@ def cxx_main():
             pass
 
 
-cxx_main()
+if __name__ == "__main__":
+    # Started directly instead of by SCons
+    if len(argv) > 1 and argv[1] == "daemon":
+        daemon_main(argv[2:])
+    else:
+        print("usage: " + argv[0] + " daemon [stop]")
+        exit(1)
+else:
+    cxx_main()
+    profile_event("scons", "read build.py", profile_start)
@@ -3,12 +3,19 @@
 #
 # Script for cleaning / building all examples, with the option to skip some of them
 #
+# Several examples are built at the same time. The total number of compilation jobs is limited
+# by -jN (the default is the number of CPUs), and is divided between the examples being built.
+#
 
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
 import platform
 import shutil
+import subprocess
 import sys
+import threading
+import time
 
 
 class CXX:
@@ -19,20 +26,25 @@ class CXX:
             print("error: cxx must exist in PATH")
             sys.exit(1)
         self.directory = None
+        self.print_lock = threading.Lock()
 
     def set_directory(self, directory):
         self.directory = str(directory)
 
+    def command_line(self, args, directory=None):
+        """Return the command line for running cxx with the given arguments, in the given directory"""
+        # Trim all arguments, and remove the empty ones
+        args = [arg.strip() for arg in args if arg.strip()]
+        directory = directory or self.directory
+        if directory:
+            return self.command + " -C " + directory + " " + " ".join(args)
+        return self.command + " " + " ".join(args)
+
     def run(self, args, dummy=False, verbose=True):
         """The first argument is the command given to cxx. If the first argument contains a ':'
         it is interpreted as being a list of commands to run cxx with. For example "fastclean:build"
         will first run "cxx fastclean" and then "cxx build"."""
-        # Trim all arguments, and remove the empty ones
-        args = [arg.strip() for arg in args if arg.strip()]
-        if self.directory:
-            cmd = self.command + " -C " + self.directory + " " + " ".join(args)
-        else:
-            cmd = self.command + " " + " ".join(args)
+        cmd = self.command_line(args)
         if dummy or verbose:
             print(cmd)
             if dummy:
@@ -41,6 +53,22 @@ class CXX:
             print("ERROR: " + cmd, file=sys.stderr)
             sys.exit(1)
 
+    def run_streamed(self, args, directory, prefix):
+        """Run cxx with the given arguments in the given directory, and print each line of output
+        as soon as it arrives, prefixed with the given prefix. Returns True if the command succeeded."""
+        cmd = self.command_line(args, directory)
+        self.output(prefix, cmd)
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True, errors="replace")
+        for line in process.stdout:
+            self.output(prefix, line.rstrip())
+        return process.wait() == 0
+
+    def output(self, prefix, line):
+        """Print a line of output, without mixing it up with lines from other threads"""
+        with self.print_lock:
+            print(prefix + line, flush=True)
+
     def version(self):
         self.run(["version"])
 
@@ -59,51 +87,97 @@ class Figlet:
             print('|\n|\n|  ' + message + '...\n|\n|')
 
 
-def run_all(f, cxx, command, exampledir, skiplist, dummyrun=False):
-    if command == "build":
+def build_project(cxx, commands, projectdir, jobs, dummyrun=False):
+    """Run the given cxx commands, one after the other, for one project.
+    Returns the name of the first command that failed (or an empty string) and the time it took."""
+    projectname = projectdir.name
+    reldir = os.path.relpath(projectdir, Path.cwd())
+
+    # special cases
+    extraflag = ""
+    if projectname == "sfml" and platform.system() == "Darwin":
+        extraflag = "clang=1"
+
+    start = time.time()
+    for command in commands:
+        args = [command, extraflag, "jobs=" + str(jobs)]
+        if dummyrun:
+            cxx.output("", cxx.command_line(args, reldir))
+            continue
+        if not cxx.run_streamed(args, reldir, "[" + projectname + "] "):
+            cxx.output("", "ERROR: " + cxx.command_line(args, reldir))
+            return command, time.time() - start
+    return "", time.time() - start
+
+
+def run_all(f, cxx, commands, exampledir, skiplist, jobs, dummyrun=False):
+    """Run the given list of cxx commands for all projects in exampledir, several projects at a time.
+    Returns a list of (project name, failed command, seconds) for all the projects that were not skipped."""
+    if commands[-1] == "build":
         f.msg("Building all examples")
-    elif command in ["clean", "fastclean"]:
+    elif commands[-1] in ["clean", "fastclean"]:
         f.msg("Cleaning all examples")
-    elif command == "rebuild":
+    elif commands[-1] == "rebuild":
         f.msg("Rebuilding all examples")
-    elif command == "run":
+    elif commands[-1] == "run":
         f.msg("Running all examples")
 
-    for projectdir in exampledir.iterdir():
+    projectdirs = []
+    for projectdir in sorted(exampledir.iterdir()):
         if projectdir.is_dir():
-            projectname = os.path.basename(projectdir)
-
-            # informative output
-            print("\n------- " + projectdir.name + " -------", flush=True)
-
             # skip, if needed
-            if projectname in skiplist:
-                if command not in ["clean", "fastclean"]:
-                    print("Skipping " + projectname + " at " + command, flush=True)
+            if projectdir.name in skiplist:
+                if [command for command in commands if command not in ["clean", "fastclean"]]:
+                    print("Skipping " + projectdir.name + " at " + ":".join(commands), flush=True)
                 continue
-
-            # special cases
-            extraflag = ""
-            if projectname == "sfml" and platform.system() == "Darwin":
-                extraflag = "clang=1"
-
-            # set the directory
-            reldir = os.path.relpath(projectdir, Path.cwd())
-            cxx.set_directory(reldir)
-
-            # run the command. Empty arguments are ignored
-            cxx.run([command, extraflag], dummy=dummyrun, verbose=True)
-            sys.stdout.flush()
+            projectdirs.append(projectdir)
+    if not projectdirs:
+        return []
+
+    # Divide the job budget between the projects that are built at the same time
+    workers = max(1, min(jobs, len(projectdirs)))
+    jobs_per_project = max(1, jobs // workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(projectdir.name, executor.submit(build_project, cxx, commands, projectdir, jobs_per_project, dummyrun))
+                   for projectdir in projectdirs]
+        return [(name,) + future.result() for name, future in futures]
+
+
+def summary(results):
+    """Print a table with the status and time of each project. Returns the number of failed projects."""
+    if not results:
+        return 0
+    statuses = ["FAILED (" + failed + ")" if failed else "ok" for _, failed, _ in results]
+    width = max(len(name) for name, _, _ in results)
+    statuswidth = max(len(status) for status in statuses + ["Status"])
+    print()
+    print("Project".ljust(width) + "  " + "Status".ljust(statuswidth) + "  Seconds")
+    print("-" * (width + statuswidth + 11))
+    for (name, _, seconds), status in zip(results, statuses):
+        print(name.ljust(width) + "  " + status.ljust(statuswidth) + "  " + "{:7.1f}".format(seconds))
+    failures = len([failed for _, failed, _ in results if failed])
+    print("-" * (width + statuswidth + 11))
+    print("{} projects, {} failed, {:.1f} seconds in total".format(len(results), failures, sum(seconds for _, _, seconds in results)))
+    return failures
 
 
 def main():
     # the first argument is a command, the rest are projects names to be skipped
     # possible commands: clean fastclean build run rebuild. All commands supported by cxx is ok.
+    # -jN sets the total number of jobs, use -j1 to build one project at a time.
 
     default_commands = ["fastclean", "build"]
     default_skiplist = ["boson"]
 
-    args = sys.argv[1:]
+    jobs = os.cpu_count() or 1
+    args = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("-j") and arg[2:].isdigit():
+            jobs = max(1, int(arg[2:]))
+        else:
+            args.append(arg)
+
     if len(args) < 1:
         command = ":".join(default_commands)
         skiplist = default_skiplist
@@ -122,13 +196,12 @@ def main():
 
     f = Figlet()
 
-    if ":" in command:
-        for cmd in command.split(":"):
-            run_all(f, cxx, cmd, exampledir, skiplist, dummyrun=False)
-    else:
-        run_all(f, cxx, command, exampledir, skiplist, dummyrun=False)
-
-    print("Done.", flush=True)
+    start = time.time()
+    results = run_all(f, cxx, command.split(":"), exampledir, skiplist, jobs, dummyrun=False)
+    failures = summary(results)
+    print("Done in {:.1f} seconds.".format(time.time() - start), flush=True)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
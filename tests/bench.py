@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Script for measuring how long cxx takes to configure and build the examples
+#
+# For each example, these scenarios are timed, a number of times each:
+#
+#   cold    - build an up-to-date project with an empty cache directory (only discovering the build flags)
+#   noop    - build an up-to-date project with a warm cache directory (the overhead of cxx itself)
+#   touch   - rebuild after changing the main source file
+#   clean   - build from scratch after "cxx clean", with a warm cache of build flags but no cached objects
+#
+# Usage:
+#
+#   tests/bench.py [-n REPEAT] [-o results.json] [--cxx PATH] [--skip NAME ...] [example ...]
+#   tests/bench.py --compare old.json new.json [--threshold PERCENT]
+#
+
+import argparse
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = ["cold", "noop", "touch", "clean"]
+SOURCE_EXTENSIONS = [".cpp", ".cc", ".cxx", ".c"]
+
+
+class Bench:
+
+    def __init__(self, command, tmpdir):
+        self.command = command
+        self.tmpdir = tmpdir
+        self.counter = 0
+
+    def cxx(self, projectdir, args, cachehome):
+        """Run cxx in the given project directory, with the given cache directory and an empty object cache.
+        Returns the number of seconds it took, and the output. Raises RuntimeError if cxx fails."""
+        self.counter += 1
+        objectdir = os.path.join(self.tmpdir, "objects-" + str(self.counter))
+        env = dict(os.environ, XDG_CACHE_HOME=cachehome)
+        env.setdefault("LOGNAME", "bench")
+        cmd = [self.command, "-C", str(projectdir)] + args + ["nodaemon=1", "cachedir=" + objectdir]
+        start = time.time()
+        process = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, errors="replace")
+        seconds = time.time() - start
+        shutil.rmtree(objectdir, ignore_errors=True)
+        if process.returncode != 0:
+            raise RuntimeError(" ".join(cmd) + "\n" + process.stdout)
+        return seconds, process.stdout
+
+    def version(self):
+        try:
+            return subprocess.check_output([self.command, "version"], universal_newlines=True).split("\n")[0]
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+
+def main_source(projectdir):
+    """Find the source file that is changed in the "touch" scenario, preferably main.cpp"""
+    sources = sorted(fn for fn in projectdir.iterdir() if fn.suffix in SOURCE_EXTENSIONS and not fn.stem.endswith("_test"))
+    for fn in sources:
+        if fn.stem == "main":
+            return fn
+    return sources[0] if sources else None
+
+
+def summarize(times):
+    return {
+        "times": [round(t, 4) for t in times],
+        "min": round(min(times), 4),
+        "median": round(statistics.median(times), 4),
+        "mean": round(statistics.mean(times), 4),
+        "stdev": round(statistics.stdev(times), 4) if len(times) > 1 else 0.0,
+    }
+
+
+def bench_project(bench, projectdir, repeat):
+    """Time all scenarios for one project. Returns a dict with a summary per scenario."""
+    warm = os.path.join(bench.tmpdir, "warm-" + projectdir.name)
+    source = main_source(projectdir)
+    times = dict((scenario, []) for scenario in SCENARIOS)
+
+    # Build once, so that the project is up to date and the cache of build flags is warm
+    bench.cxx(projectdir, ["clean"], warm)
+    bench.cxx(projectdir, ["build"], warm)
+
+    for i in range(repeat):
+        cold = os.path.join(bench.tmpdir, "cold-" + projectdir.name + "-" + str(i))
+        times["cold"].append(bench.cxx(projectdir, ["build"], cold)[0])
+        shutil.rmtree(cold, ignore_errors=True)
+
+        times["noop"].append(bench.cxx(projectdir, ["build"], warm)[0])
+
+        if source:
+            original = source.read_bytes()
+            try:
+                # Change the contents, not only the timestamp, since cxx checks the contents of changed files
+                source.write_bytes(original + ("\n// cxx benchmark {}\n".format(time.time())).encode())
+                times["touch"].append(bench.cxx(projectdir, ["build"], warm)[0])
+            finally:
+                source.write_bytes(original)
+            bench.cxx(projectdir, ["build"], warm)
+
+        bench.cxx(projectdir, ["clean"], warm)
+        times["clean"].append(bench.cxx(projectdir, ["build"], warm)[0])
+
+    bench.cxx(projectdir, ["clean"], warm)
+    return dict((scenario, summarize(t)) for scenario, t in times.items() if t)
+
+
+def run(args):
+    command = args.cxx or shutil.which("cxx")
+    if not command:
+        print("error: cxx must exist in PATH, or be given with --cxx")
+        sys.exit(1)
+
+    # directory of this source file
+    thisdir = Path(os.path.realpath(__file__)).parent
+
+    # ../examples
+    exampledir = Path(thisdir.parent.joinpath('examples'))
+
+    projectdirs = [projectdir for projectdir in sorted(exampledir.iterdir())
+                   if projectdir.is_dir() and projectdir.name not in args.skip
+                   and (not args.examples or projectdir.name in args.examples)]
+
+    tmpdir = tempfile.mkdtemp(prefix="cxx-bench-")
+    bench = Bench(command, tmpdir)
+    results = {
+        "version": bench.version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": args.repeat,
+        "projects": {},
+    }
+    try:
+        for projectdir in projectdirs:
+            print(projectdir.name + "...", end=" ", flush=True)
+            try:
+                results["projects"][projectdir.name] = bench_project(bench, projectdir, args.repeat)
+            except RuntimeError as e:
+                print("FAILED")
+                print("\n".join(str(e).strip().split("\n")[-10:]))
+                results["projects"][projectdir.name] = {"error": str(e).split("\n")[0]}
+                continue
+            print(", ".join("{} {:.3f}s".format(scenario, summary["median"])
+                            for scenario, summary in results["projects"][projectdir.name].items()))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Wrote " + args.output)
+
+
+def compare(old_filename, new_filename, threshold):
+    """Compare the medians of two benchmark results. Returns the number of scenarios that got slower than the threshold."""
+    with open(old_filename) as f:
+        old = json.load(f)
+    with open(new_filename) as f:
+        new = json.load(f)
+    print("old: " + old.get("version", "") + " " + old.get("date", ""))
+    print("new: " + new.get("version", "") + " " + new.get("date", ""))
+    print()
+    print("{:<16} {:<6} {:>9} {:>9} {:>8}".format("Project", "Step", "Old", "New", "Change"))
+    regressions = 0
+    for name in sorted(set(old["projects"]) & set(new["projects"])):
+        for scenario in SCENARIOS:
+            before = old["projects"][name].get(scenario)
+            after = new["projects"][name].get(scenario)
+            if not before or not after or not before["median"]:
+                continue
+            change = 100.0 * (after["median"] - before["median"]) / before["median"]
+            # Differences within the noise of the old measurements are not regressions
+            slower = change > threshold and after["median"] - before["median"] > 2 * before["stdev"]
+            if slower:
+                regressions += 1
+            print("{:<16} {:<6} {:8.3f}s {:8.3f}s {:+7.1f}%{}".format(name, scenario, before["median"], after["median"],
+                                                                    change, "  SLOWER" if slower else ""))
+    print()
+    print("{} steps got more than {}% slower".format(regressions, threshold))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long cxx takes to configure and build the examples")
+    parser.add_argument("examples", nargs="*", help="examples to benchmark (default: all)")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="number of times each step is timed (default: 5)")
+    parser.add_argument("-o", "--output", default="bench.json", help="where to write the results (default: bench.json)")
+    parser.add_argument("--cxx", help="the cxx command to benchmark (default: cxx in PATH)")
+    parser.add_argument("--skip", nargs="*", default=["boson"], help="examples to skip (default: boson)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results instead of benchmarking")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percentage that counts as slower (default: 10)")
+    args = parser.parse_args()
+
+    if args.compare:
+        if compare(args.compare[0], args.compare[1], args.threshold):
+            sys.exit(1)
+        return
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
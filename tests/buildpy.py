@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Load the functions in src/build.py for the unit tests, without starting a build
+#
+
+import os
+import types
+
+BUILD_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "build.py")
+
+
+def load():
+    """Return src/build.py as a module. The code at the end that starts the build needs SCons, so it is left out.
+    The persistent caches are disabled, as if nocache=1 was given."""
+    with open(BUILD_PY) as f:
+        source = f.read()
+    source = source[:source.index('\nif __name__ == "__main__":')]
+    build = types.ModuleType("build")
+    build.__file__ = BUILD_PY
+    build.ARGUMENTS = {"nocache": "1"}
+    exec(compile(source, BUILD_PY, "exec"), build.__dict__)
+    return build
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for interpreting .pc files in-process, compared with the output of pkg-config where it is installed
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import buildpy
+
+build = buildpy.load()
+
+# A small package graph, where libraries are required both publicly and privately, and more than once
+PC_FILES = {
+    "base": "prefix=/opt/base\nlibdir=${prefix}/lib\nincludedir=${prefix}/include\n\n"
+            "Name: base\nDescription: base\nVersion: 1.0\nCflags: -I${includedir}\nLibs: -L${libdir} -lbase -lm\n",
+    "middle": "Name: middle\nDescription: middle\nVersion: 2.1\nRequires: base >= 1.0\n"
+              "Cflags: -DMIDDLE=1\nLibs: -lmiddle\n",
+    "other": "Name: other\nDescription: other\nVersion: 0.5\nRequires: base\nLibs: -lother\n",
+    "hidden": "Name: hidden\nDescription: hidden\nVersion: 1\nCflags: -I/opt/hidden/include\nLibs: -lhidden\n",
+    "top": "Name: top\nDescription: top\nVersion: 3\nRequires: middle, other\nRequires.private: hidden\n"
+           "Cflags: -I/opt/top/include\nLibs: -ltop\n",
+}
+
+
+def linked_libraries(flags):
+    """The -l flags, in order, with the duplicates removed from the start like pkg-config does"""
+    return build.pc_unique_libs([flag for flag in flags.split() if flag.startswith("-l")])
+
+
+class PkgConfigTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pc_dir = tempfile.mkdtemp()
+        for name, contents in PC_FILES.items():
+            with open(os.path.join(cls.pc_dir, name + ".pc"), "w") as f:
+                f.write(contents)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.pc_dir)
+
+    def write_pc_file(self, name, contents):
+        filename = os.path.join(self.pc_dir, name + ".pc")
+        with open(filename, "w") as f:
+            f.write(contents)
+        return filename
+
+    def test_parse_pc_file_expands_variables(self):
+        filename = self.write_pc_file("variables", "prefix=/opt/v\nlibdir=${prefix}/lib64\ndatadir=${pcfiledir}/data\n"
+                                                   "Name: variables\nLibs: -L${libdir} -lv\nCflags: -DDATA=${datadir}\n")
+        fields = build.parse_pc_file(filename)
+        self.assertEqual(fields["libs"], "-L/opt/v/lib64 -lv")
+        self.assertEqual(fields["cflags"], "-DDATA=" + self.pc_dir + "/data")
+
+    def test_parse_pc_file_syntax(self):
+        filename = self.write_pc_file("syntax", "# a comment\nprefix=/usr # trailing comment\n\n"
+                                                "Name: syntax\nCFlags: -I${prefix}/include \\\n -DPRICE=$$5 ${undefined}\n")
+        fields = build.parse_pc_file(filename)
+        # Field names are case insensitive, lines can be continued with a backslash, and undefined variables are empty
+        self.assertEqual(fields["cflags"].split(), ["-I/usr/include", "-DPRICE=$5"])
+        self.assertEqual(fields["name"], "syntax")
+
+    def test_parse_pc_file_missing(self):
+        self.assertIsNone(build.parse_pc_file(os.path.join(self.pc_dir, "does-not-exist.pc")))
+
+    def test_pc_requires(self):
+        self.assertEqual(build.pc_requires("glib-2.0 >= 2.50, gobject-2.0"), ["glib-2.0", "gobject-2.0"])
+        self.assertEqual(build.pc_requires("a = 1 b,c != 2.0  d < 3"), ["a", "b", "c", "d"])
+        self.assertEqual(build.pc_requires(""), [])
+
+    def test_dependencies_are_linked_after_the_libraries_that_use_them(self):
+        flags = build.pkg_config("top", [self.pc_dir])
+        self.assertEqual(linked_libraries(flags), ["-ltop", "-lmiddle", "-lother", "-lbase", "-lm"])
+
+    def test_private_requirements_give_cflags_only(self):
+        flags = build.pkg_config("top", [self.pc_dir]).split()
+        self.assertIn("-I/opt/hidden/include", flags)
+        self.assertNotIn("-lhidden", flags)
+
+    def test_missing_requirement(self):
+        self.assertEqual(build.pkg_config("top missing", [self.pc_dir]), "")
+
+    @unittest.skipUnless(shutil.which("pkg-config"), "pkg-config is not installed")
+    def test_same_as_pkg_config(self):
+        # Packages with Requires, from the test directory and from the system if they are installed
+        names = ["top", "middle", "libexslt", "gtest_main", "xmlsec1", "gtk+-3.0", "grpc++"]
+        environment = dict(os.environ, PKG_CONFIG_PATH=self.pc_dir)
+        for name in names:
+            result = subprocess.run(["pkg-config", "--cflags", "--libs", name], env=environment,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+            if result.returncode != 0:
+                continue
+            flags = build.pkg_config(name, [self.pc_dir])
+            self.assertEqual(linked_libraries(flags), linked_libraries(result.stdout), name)
+            self.assertEqual(set(flag for flag in flags.split() if not flag.startswith("-l")),
+                             set(flag for flag in result.stdout.split() if not flag.startswith("-l")), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
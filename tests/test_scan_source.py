@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for scanning the includes of source files in-process, without running the preprocessor
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import buildpy
+
+build = buildpy.load()
+
+
+class StripCommentsTest(unittest.TestCase):
+
+    def test_comments_are_removed(self):
+        self.assertEqual(build.strip_comments("int a; // comment\nint b; /* comment */ int c;").split(),
+                         ["int", "a;", "int", "b;", "int", "c;"])
+
+    def test_newlines_in_comments_are_kept(self):
+        stripped = build.strip_comments("/* one\ntwo\nthree */#include <a.h>\n")
+        self.assertEqual(stripped.split("\n")[2].strip(), "#include <a.h>")
+
+    def test_string_literals_are_kept(self):
+        source = 'const char* s = "// not a comment /* either */";\nchar c = \'"\'; // "comment"\n'
+        self.assertEqual(build.strip_comments(source).split("\n")[0], source.split("\n")[0])
+        self.assertNotIn("comment\"", build.strip_comments(source))
+
+    def test_continued_lines_are_joined(self):
+        self.assertEqual(build.strip_comments("#define A \\\n  1\r\n").split("\n")[0], "#define A   1")
+
+
+class EvalConditionTest(unittest.TestCase):
+
+    def check(self, expression, macros=None, include_dirs=()):
+        return build.eval_condition(expression, macros or {}, list(include_dirs))
+
+    def test_arithmetic(self):
+        self.assertTrue(self.check("1 + 2 * 3 == 7"))
+        self.assertTrue(self.check("(1 + 2) * 3 == 9"))
+        self.assertTrue(self.check("-7 / 2 == -3 && -7 % 2 == -1"))
+        self.assertTrue(self.check("0x10 == 16 && 010 == 8 && 1UL << 4 == 16"))
+        self.assertTrue(self.check("'A' == 65"))
+        self.assertFalse(self.check("1 ? 0 : 1"))
+        self.assertTrue(self.check("!0 && ~0 == -1"))
+
+    def test_macros(self):
+        macros = {"VERSION": "3", "ALIAS": "VERSION", "EMPTY": ""}
+        self.assertTrue(self.check("defined(VERSION) && VERSION > 2", macros))
+        self.assertTrue(self.check("defined EMPTY", macros))
+        self.assertTrue(self.check("ALIAS == 3", macros))
+        self.assertFalse(self.check("defined(MISSING) || MISSING", macros))
+        # Function-like macro calls are not expanded, and count as 0
+        self.assertTrue(self.check("CHECK(1, (2)) == 0", macros))
+        # Recursive macros do not hang
+        self.assertFalse(self.check("LOOP", {"LOOP": "LOOP"}))
+
+    def test_has_include(self):
+        include_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(include_dir, "sub"))
+            open(os.path.join(include_dir, "sub", "found.h"), "w").close()
+            self.assertTrue(self.check("__has_include(<sub/found.h>)", include_dirs=[include_dir]))
+            self.assertTrue(self.check('__has_include("sub/found.h")', include_dirs=[include_dir]))
+            self.assertFalse(self.check("__has_include(<sub/missing.h>)", include_dirs=[include_dir]))
+        finally:
+            shutil.rmtree(include_dir)
+
+    def test_invalid_expressions_are_false(self):
+        for expression in ("", "1 +", "(1", "1 / 0", "1 ? 2"):
+            self.assertFalse(self.check(expression), expression)
+
+
+class ScanSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def scan(self, source, name="main.cpp"):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as f:
+            f.write(source)
+        return build.scan_source(filename)
+
+    def test_includes(self):
+        includes, local_includes, also_glu = self.scan('#include <vector>\n  #  include "local.h"\n#include <GL/gl.h>\n')
+        self.assertEqual(includes, ["vector", "local.h", "GL/gl.h"])
+        self.assertEqual(local_includes, ["local.h"])
+        self.assertFalse(also_glu)
+
+    def test_conditional_blocks(self):
+        includes = self.scan("#if 0\n#include <zero.h>\n#elif 1\n#include <one.h>\n#else\n#include <else.h>\n#endif\n"
+                             "#define FEATURE 2\n#if FEATURE >= 2\n#include <feature.h>\n#endif\n"
+                             "#ifdef NOT_DEFINED\n#include <skipped.h>\n#if 1\n#include <nested.h>\n#endif\n#endif\n"
+                             "#undef FEATURE\n#ifndef FEATURE\n#include <undefined.h>\n#endif\n")[0]
+        self.assertEqual(includes, ["one.h", "feature.h", "undefined.h"])
+
+    def test_predefined_macros(self):
+        includes = self.scan("#if __cplusplus\n#include <cxx.h>\n#endif\n")[0]
+        self.assertEqual(includes, ["cxx.h"])
+        includes = self.scan("#ifdef __cplusplus\n#include <cxx.h>\n#endif\n", "main.c")[0]
+        self.assertEqual(includes, [])
+
+    def test_comments_and_strings(self):
+        includes = self.scan('// #include <line.h>\n/*\n#include <block.h>\n*/\nconst char* s = "#include <string.h>";\n'
+                             "#include <real.h> // trailing\n")[0]
+        self.assertEqual(includes, ["real.h"])
+
+    def test_glu(self):
+        self.assertTrue(self.scan("#include <GL/glu.h>\n")[2])
+        self.assertTrue(self.scan("void f() { gluPerspective(1, 1, 1, 1); }\n")[2])
+        self.assertFalse(self.scan("#if 0\nvoid f() { gluPerspective(1, 1, 1, 1); }\n#endif\n")[2])
+
+    def test_unreadable(self):
+        self.assertIsNone(build.scan_source(os.path.join(self.directory, "missing.cpp")))
+
+
+if __name__ == "__main__":
+    unittest.main()
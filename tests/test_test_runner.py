@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for running the test executables, with timeouts, and for dividing them into shards
+#
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import buildpy
+
+build = buildpy.load()
+
+
+class RunTestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous_directory = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        shutil.rmtree(self.directory)
+
+    def write_test(self, name, script):
+        with open(name, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(name, 0o755)
+
+    def test_passed_and_failed(self):
+        self.write_test("good_test", "echo good\n")
+        self.write_test("bad_test", "exit 3\n")
+        results = build.run_tests(["good_test", "bad_test"], 2, 0)
+        self.assertEqual([result["status"] for result in results], ["passed", "failed"])
+        self.assertEqual(results[0]["stdout"], "good\n")
+        self.assertEqual(results[1]["returncode"], 3)
+
+    def test_missing_test_is_reported_as_failed(self):
+        self.write_test("good_test", "true\n")
+        results = build.run_tests(["missing_test", "good_test"], 2, 0)
+        self.assertEqual([result["status"] for result in results], ["failed", "passed"])
+        self.assertEqual(results[0]["returncode"], 127)
+
+    @unittest.skipUnless(os.name == "posix", "process groups are only used on POSIX")
+    def test_timeout_stops_child_processes(self):
+        # The child process keeps the output pipes open after the test itself is stopped
+        self.write_test("slow_test", "sleep 30 &\nsleep 30\n")
+        start = time.time()
+        results = build.run_tests(["slow_test"], 1, 1)
+        self.assertEqual(results[0]["status"], "timeout")
+        self.assertLess(time.time() - start, 10)
+
+
+
+class TestShardTest(unittest.TestCase):
+
+    names = ["m%d_test" % i for i in range(10)]
+
+    def test_no_shard(self):
+        self.assertEqual(build.test_shard(self.names, ""), self.names)
+
+    def test_shards_divide_the_tests(self):
+        shards = [build.test_shard(self.names, "%d/3" % index) for index in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.names))
+        self.assertEqual([len(shard) for shard in shards], [4, 3, 3])
+
+    def test_same_division_for_any_order(self):
+        self.assertEqual(build.test_shard(list(reversed(self.names)), "2/4"), build.test_shard(self.names, "2/4"))
+
+    def test_invalid_shards_run_all_tests(self):
+        for shard in ("1", "a/b", "1/2/3", "0/4", "5/4", "1/0"):
+            self.assertEqual(build.test_shard(self.names, shard), self.names, shard)
+
+if __name__ == "__main__":
+    unittest.main()